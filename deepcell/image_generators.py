@@ -38,11 +38,9 @@ import numpy as np
 from skimage.measure import label
 from skimage.measure import regionprops
 from skimage.transform import resize
-from skimage.io import imread
 
 from tensorflow.python.platform import tf_logging as logging
 from tensorflow.python.keras import backend as K
-from tensorflow.python.keras.utils import to_categorical
 from tensorflow.python.keras.preprocessing.image import random_channel_shift
 from tensorflow.python.keras.preprocessing.image import apply_transform
 from tensorflow.python.keras.preprocessing.image import flip_axis
@@ -59,12 +57,78 @@ from keras_retinanet.preprocessing.generator import Generator as _RetinaNetGener
 from keras_maskrcnn.preprocessing.generator import Generator as _MaskRCNNGenerator
 
 from deepcell.utils.data_utils import sample_label_matrix, sample_label_movie
+from deepcell.utils.io_utils import get_cached_image
+from deepcell.utils.io_utils import get_image
+from deepcell.utils.io_utils import listdir
 from deepcell.utils.transform_utils import transform_matrix_offset_center
 from deepcell.utils.transform_utils import deepcell_transform
 from deepcell.utils.transform_utils import distance_transform_2d, distance_transform_3d
+from deepcell.utils.transform_utils import get_transform_cache
 from deepcell.utils.retinanet_anchor_utils import anchor_targets_bbox
 
 
+def _read_grayscale(file_name):
+    """Read an image as 8-bit grayscale with OpenCV"""
+    return cv2.imread(file_name, 0)
+
+
+def _get_sample_array(X):
+    """Get the image data of an iterator without copying it.  Arrays and
+    memmaps keep their native dtype, and lazy arrays (e.g. an IndexedArray
+    from get_data) are only read when indexed, so samples are converted
+    to floats one batch at a time.
+    # Arguments:
+        X: array or array-like of images
+    # Returns:
+        X, or X as a numpy array if it is not array-like
+    """
+    if all(hasattr(X, attr) for attr in ('shape', 'ndim', 'dtype', '__getitem__')):
+        return X
+    return np.asarray(X)
+
+
+def _to_one_hot(y, num_classes=None):
+    """uint8 one-hot encoding of the class indices y along a new last axis,
+    with num_classes classes (by default, the largest class index + 1)"""
+    y = np.asarray(y)
+    if y.dtype.kind not in {'b', 'i', 'u'}:
+        y = y.astype('int')
+    if num_classes is None:
+        num_classes = int(y.max()) + 1 if y.size else 1
+    return np.eye(num_classes, dtype='uint8')[y]
+
+
+class _PackedOneHotArray(object):
+    """Array-like view of one-hot (or multi-hot) targets, stored with the
+    channel axis packed into bits, i.e. one byte per pixel for up to 8
+    classes.  Indexing unpacks only the selected samples, so targets are
+    expanded one batch at a time.
+    # Arguments:
+        y: one-hot targets
+        channel_axis: the channel (class) axis of y
+        dtype: dtype of the unpacked targets
+    """
+
+    def __init__(self, y, channel_axis, dtype='float64'):
+        y = np.asarray(y)
+        self.shape = y.shape
+        self.ndim = y.ndim
+        self.dtype = np.dtype(dtype)
+        # counted from the end, so it holds for samples and slices of samples
+        self.axis = channel_axis % y.ndim - y.ndim
+        self.packed = np.packbits(y != 0, axis=self.axis)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Keys may not index the channel axis, or any axis after it."""
+        unpacked = np.unpackbits(self.packed[key], axis=self.axis)
+        index = [slice(None)] * unpacked.ndim
+        index[self.axis] = slice(0, self.shape[self.axis])
+        return unpacked[tuple(index)].astype(self.dtype)
+
+
 def _transform_masks(y, transform, data_format=None, **kwargs):
     """Based on the transform key, apply a transform function to the masks
     # Arguments:
@@ -78,6 +142,9 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
     if data_format is None:
         data_format = K.image_data_format()
 
+    # read lazily loaded labels (e.g. an IndexedArray from get_data)
+    y = np.asarray(y)
+
     if y.ndim not in {4, 5}:
         raise ValueError('`labels` data must be of ndim 4 or 5.  Got', y.ndim)
 
@@ -92,6 +159,23 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
         if transform not in valid_transforms:
             raise ValueError('`{}` is not a valid transform'.format(transform))
 
+    # skip the transform if its result is in the transform cache
+    transform_cache = get_transform_cache()
+    if transform_cache is not None:
+        key = transform_cache.get_key(y, transform, data_format=data_format, **kwargs)
+        y_transform = transform_cache.get(key)
+        if y_transform is None:
+            y_transform = _apply_mask_transform(y, transform, data_format, **kwargs)
+            transform_cache.put(key, y_transform)
+        return y_transform
+
+    return _apply_mask_transform(y, transform, data_format, **kwargs)
+
+
+def _apply_mask_transform(y, transform, data_format, **kwargs):
+    """Apply the transform function of the validated transform key to the masks"""
+    channel_axis = 1 if data_format == 'channels_first' else -1
+
     if transform == 'deepcell':
         dilation_radius = kwargs.pop('dilation_radius', None)
         y_transform = deepcell_transform(y, dilation_radius, data_format=data_format)
@@ -100,10 +184,11 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
         distance_bins = kwargs.pop('distance_bins', 4)
         erosion = kwargs.pop('erosion_width', 0)
 
+        dtype = np.min_scalar_type(distance_bins)
         if data_format == 'channels_first':
-            y_transform = np.zeros((y.shape[0], *y.shape[2:]))
+            y_transform = np.zeros((y.shape[0], *y.shape[2:]), dtype=dtype)
         else:
-            y_transform = np.zeros(y.shape[0:-1])
+            y_transform = np.zeros(y.shape[0:-1], dtype=dtype)
 
         if y.ndim == 5:
             _distance_transform = distance_transform_3d
@@ -120,26 +205,24 @@ def _transform_masks(y, transform, data_format=None, **kwargs):
                 mask, distance_bins, erosion)
 
         # convert to one hot notation
-        y_transform = to_categorical(np.expand_dims(y_transform, axis=-1))
+        y_transform = _to_one_hot(y_transform)
         if data_format == 'channels_first':
             y_transform = np.rollaxis(y_transform, y.ndim - 1, 1)
 
     elif transform == 'disc':
-        y_transform = to_categorical(y.squeeze(channel_axis))
+        y_transform = _to_one_hot(y.squeeze(channel_axis))
         if data_format == 'channels_first':
             y_transform = np.rollaxis(y_transform, y.ndim - 1, 1)
 
     elif transform == 'fgbg':
         y_transform = np.where(y > 1, 1, y)
         # convert to one hot notation
-        if data_format == 'channels_first':
-            y_transform = np.rollaxis(y_transform, 1, y.ndim)
-        y_transform = to_categorical(y_transform)
+        y_transform = _to_one_hot(y_transform.squeeze(channel_axis))
         if data_format == 'channels_first':
             y_transform = np.rollaxis(y_transform, y.ndim - 1, 1)
 
     elif transform is None:
-        y_transform = to_categorical(y.squeeze(channel_axis))
+        y_transform = _to_one_hot(y.squeeze(channel_axis))
         if data_format == 'channels_first':
             y_transform = np.rollaxis(y_transform, y.ndim - 1, 1)
 
@@ -177,7 +260,7 @@ class ImageSampleArrayIterator(Iterator):
                                  X.shape, y.shape))
         if data_format is None:
             data_format = K.image_data_format()
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = _get_sample_array(X)
 
         if self.x.ndim != 4:
             raise ValueError('Input data in `ImageSampleArrayIterator` '
@@ -210,7 +293,8 @@ class ImageSampleArrayIterator(Iterator):
 
         self.class_balance(max_class_samples, balance_classes, seed=seed)
 
-        self.y = to_categorical(self.y).astype('int32')
+        # class labels are one-hot encoded one batch at a time
+        self.num_classes = int(self.y.max()) + 1 if self.y.size else 1
         super(ImageSampleArrayIterator, self).__init__(
             len(self.y), batch_size, shuffle, seed)
 
@@ -276,12 +360,12 @@ class ImageSampleArrayIterator(Iterator):
             batch_x = np.zeros((len(index_array),
                                 self.x.shape[self.channel_axis],
                                 2 * self.win_x + 1,
-                                2 * self.win_y + 1))
+                                2 * self.win_y + 1), dtype=K.floatx())
         else:
             batch_x = np.zeros((len(index_array),
                                 2 * self.win_x + 1,
                                 2 * self.win_y + 1,
-                                self.x.shape[self.channel_axis]))
+                                self.x.shape[self.channel_axis]), dtype=K.floatx())
 
         for i, j in enumerate(index_array):
             b, px, py = self.batch[j], self.pixels_x[j], self.pixels_y[j]
@@ -303,7 +387,7 @@ class ImageSampleArrayIterator(Iterator):
 
         if self.y is None:
             return batch_x
-        batch_y = self.y[index_array]
+        batch_y = _to_one_hot(self.y[index_array], self.num_classes).astype('int32')
         return batch_x, batch_y
 
     def next(self):
@@ -371,15 +455,16 @@ class ImageFullyConvIterator(Iterator):
                                  X.shape, y.shape))
         if data_format is None:
             data_format = K.image_data_format()
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = _get_sample_array(X)
 
         if self.x.ndim != 4:
             raise ValueError('Input data in `ImageFullyConvIterator` '
                              'should have rank 4. You passed an array '
                              'with shape', self.x.shape)
 
-        self.y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
         self.channel_axis = 3 if data_format == 'channels_last' else 1
+        y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
+        self.y = _PackedOneHotArray(y, self.channel_axis)
         self.skip = skip
         self.image_data_generator = image_data_generator
         self.data_format = data_format
@@ -390,7 +475,7 @@ class ImageFullyConvIterator(Iterator):
             self.x.shape[0], batch_size, shuffle, seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:]))
+        batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:]), dtype=K.floatx())
         batch_y = np.zeros(tuple([len(index_array)] + list(self.y.shape)[1:]))
 
         for i, j in enumerate(index_array):
@@ -947,8 +1032,11 @@ class MovieArrayIterator(Iterator):
 
         self.channel_axis = 4 if data_format == 'channels_last' else 1
         self.time_axis = 1 if data_format == 'channels_last' else 2
-        self.x = np.asarray(X, dtype=K.floatx())
-        self.y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
+        self.x = _get_sample_array(X)
+        self.y = None
+        if y is not None:
+            y = _transform_masks(y, transform, data_format=data_format, **transform_kwargs)
+            self.y = _PackedOneHotArray(y, self.channel_axis)
 
         if self.x.ndim != 5:
             raise ValueError('Input data in `MovieArrayIterator` '
@@ -968,7 +1056,7 @@ class MovieArrayIterator(Iterator):
         self.save_prefix = save_prefix
         self.save_format = save_format
         super(MovieArrayIterator, self).__init__(
-            len(self.y), batch_size, shuffle, seed)
+            self.x.shape[0], batch_size, shuffle, seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
         if self.data_format == 'channels_first':
@@ -976,7 +1064,7 @@ class MovieArrayIterator(Iterator):
                                 self.x.shape[1],
                                 self.frames_per_batch,
                                 self.x.shape[3],
-                                self.x.shape[4]))
+                                self.x.shape[4]), dtype=K.floatx())
             if self.y is not None:
                 batch_y = np.zeros((len(index_array),
                                     self.y.shape[1],
@@ -986,7 +1074,7 @@ class MovieArrayIterator(Iterator):
 
         else:
             batch_x = np.zeros(tuple([len(index_array), self.frames_per_batch] +
-                                     list(self.x.shape)[2:]))
+                                     list(self.x.shape)[2:]), dtype=K.floatx())
             if self.y is not None:
                 batch_y = np.zeros(tuple([len(index_array), self.frames_per_batch] +
                                          list(self.y.shape)[2:]))
@@ -1102,7 +1190,7 @@ class SampleMovieArrayIterator(Iterator):
 
         self.channel_axis = 4 if data_format == 'channels_last' else 1
         self.time_axis = 1 if data_format == 'channels_last' else 2
-        self.x = np.asarray(X, dtype=K.floatx())
+        self.x = _get_sample_array(X)
         y = _transform_masks(y, transform, data_format=data_format)
 
         if self.x.ndim != 5:
@@ -1135,7 +1223,8 @@ class SampleMovieArrayIterator(Iterator):
 
         self.class_balance(max_class_samples, balance_classes, seed=seed)
 
-        self.y = to_categorical(self.y).astype('int32')
+        # class labels are one-hot encoded one batch at a time
+        self.num_classes = int(self.y.max()) + 1 if self.y.size else 1
         super(SampleMovieArrayIterator, self).__init__(
             len(self.y), batch_size, shuffle, seed)
 
@@ -1205,13 +1294,13 @@ class SampleMovieArrayIterator(Iterator):
                                 self.x.shape[self.channel_axis],
                                 2 * self.win_z + 1,
                                 2 * self.win_x + 1,
-                                2 * self.win_y + 1))
+                                2 * self.win_y + 1), dtype=K.floatx())
         else:
             batch_x = np.zeros((len(index_array),
                                 2 * self.win_z + 1,
                                 2 * self.win_x + 1,
                                 2 * self.win_y + 1,
-                                self.x.shape[self.channel_axis]))
+                                self.x.shape[self.channel_axis]), dtype=K.floatx())
 
         for i, j in enumerate(index_array):
             b, pz, px, py = self.batch[j], self.pixels_z[j], self.pixels_x[j], self.pixels_y[j]
@@ -1239,7 +1328,7 @@ class SampleMovieArrayIterator(Iterator):
 
         if self.y is None:
             return batch_x
-        batch_y = self.y[index_array]
+        batch_y = _to_one_hot(self.y[index_array], self.num_classes).astype('int32')
         return batch_x, batch_y
 
     def next(self):
@@ -1343,8 +1432,11 @@ class SiameseIterator(Iterator):
             self.row_axis = 2
             self.col_axis = 3
             self.time_axis = 1
-        self.x = np.asarray(train_dict['X'], dtype=K.floatx())
-        self.y = np.array(train_dict['y'], dtype='int32')
+        self.x = _get_sample_array(train_dict['X'])
+        # instance labels keep their (compact) integer dtype
+        self.y = np.asarray(train_dict['y'])
+        if self.y.dtype.kind not in {'i', 'u'}:
+            self.y = self.y.astype('int32')
         self.crop_dim = crop_dim
         self.min_track_length = min_track_length
         self.image_data_generator = image_data_generator
@@ -1368,7 +1460,7 @@ class SiameseIterator(Iterator):
         track_ids = {}
         for batch in range(self.y.shape[0]):
             y_batch = self.y[batch]
-            num_cells = np.amax(y_batch)
+            num_cells = int(np.amax(y_batch))
             for cell in range(1, num_cells + 1):
                 # count number of pixels cell occupies in each frame
                 y_true = np.sum(y_batch == cell, axis=(self.row_axis - 1, self.col_axis - 1))
@@ -1409,7 +1501,7 @@ class SiameseIterator(Iterator):
             tracked_frames = track_id['frames']
             frame_1 = np.random.choice(tracked_frames)  # Select a frame from the track
 
-            X = self.x[batch]
+            X = self.x[batch].astype(K.floatx())
             y = self.y[batch]
 
             # Choose comparison cell
@@ -1530,7 +1622,7 @@ class BoundingBoxIterator(Iterator):
                  save_to_dir=None, save_prefix='', save_format='png'):
         if data_format is None:
             data_format = K.image_data_format()
-        self.x = np.asarray(train_dict['X'], dtype=K.floatx())
+        self.x = _get_sample_array(train_dict['X'])
 
         if self.x.ndim != 4:
             raise ValueError('Input data in `BoundingBoxIterator` '
@@ -1611,14 +1703,15 @@ class BoundingBoxIterator(Iterator):
     def _get_batches_of_transformed_samples(self, index_array):
         index_array = index_array[0]
         if self.channel_axis == 1:
-            batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:4]))
+            batch_x = np.zeros(tuple([len(index_array)] + list(self.x.shape)[1:4]),
+                               dtype=K.floatx())
             if self.y is not None:
                 batch_y = np.zeros(tuple([len(index_array)] + list(self.y.shape)[1:4]))
         else:
             batch_x = np.zeros((len(index_array),
                                 self.x.shape[2],
                                 self.x.shape[3],
-                                self.x.shape[1]))
+                                self.x.shape[1]), dtype=K.floatx())
             if self.y is not None:
                 batch_y = np.zeros((len(index_array),
                                     self.y.shape[2],
@@ -1697,6 +1790,7 @@ class RetinaNetGenerator(_RetinaNetGenerator):
                  channel_names,
                  annotation_dir,
                  annotation_names,
+                 manifest=None,
                  **kwargs):
         self.image_names = []
         self.image_data = {}
@@ -1708,13 +1802,15 @@ class RetinaNetGenerator(_RetinaNetGenerator):
             dir_name=direc_name,
             training_dirs=training_dirs,
             image_dir=raw_image_dir,
-            channel_names=channel_names)
+            channel_names=channel_names,
+            manifest=manifest)
 
         annotation_files = self.list_file_deepcell(
             dir_name=direc_name,
             training_dirs=training_dirs,
             image_dir=annotation_dir,
-            channel_names=annotation_names)
+            channel_names=annotation_names,
+            manifest=manifest)
 
         self.image_stack = self.generate_subimage(train_files, 3, 3, True)
         self.mask_stack = self.generate_subimage(annotation_files, 3, 3, False)
@@ -1729,14 +1825,16 @@ class RetinaNetGenerator(_RetinaNetGenerator):
         self.image_names = list(self.image_data.keys())
         super(RetinaNetGenerator, self).__init__(**kwargs)
 
-    def list_file_deepcell(self, dir_name, training_dirs, image_dir, channel_names):
+    def list_file_deepcell(self, dir_name, training_dirs, image_dir, channel_names,
+                           manifest=None):
         """
         List all image files inside each `dir_name/training_dir/image_dir`
         with "channel_name" in the filename.
+        If a FileManifest is given, the directories are listed from it.
         """
         filelist = []
         for direc in training_dirs:
-            imglist = os.listdir(os.path.join(dir_name, direc, image_dir))
+            imglist = listdir(os.path.join(dir_name, direc, image_dir), manifest=manifest)
 
             for channel in channel_names:
                 for img in imglist:
@@ -1765,7 +1863,7 @@ class RetinaNetGenerator(_RetinaNetGenerator):
     def generate_subimage(self, img_pathstack, horizontal, vertical, flag):
         sub_img = []
         for img_path in img_pathstack:
-            img = np.asarray(np.float32(imread(img_path)))
+            img = get_image(img_path)
             if flag:
                 img = (img / np.max(img))
             vway = np.zeros(vertical + 1)  # The dimentions of vertical cuts
@@ -1855,6 +1953,7 @@ class MaskRCNNGenerator(_MaskRCNNGenerator):
                  image_min_side=200,
                  image_max_side=200,
                  crop_iterations=1,
+                 manifest=None,
                  **kwargs):
         self.image_names = []
         self.image_data = {}
@@ -1865,13 +1964,15 @@ class MaskRCNNGenerator(_MaskRCNNGenerator):
             dir_name=direc_name,
             training_dirs=training_dirs,
             image_dir=raw_image_dir,
-            channel_names=channel_names)
+            channel_names=channel_names,
+            manifest=manifest)
 
         annotation_files = self.list_file_deepcell(
             dir_name=direc_name,
             training_dirs=training_dirs,
             image_dir=annotation_dir,
-            channel_names=annotation_names)
+            channel_names=annotation_names,
+            manifest=manifest)
 
         store = self.randomcrops(
             train_files,
@@ -1900,14 +2001,16 @@ class MaskRCNNGenerator(_MaskRCNNGenerator):
             image_max_side=image_max_side,
             **kwargs)
 
-    def list_file_deepcell(self, dir_name, training_dirs, image_dir, channel_names):
+    def list_file_deepcell(self, dir_name, training_dirs, image_dir, channel_names,
+                           manifest=None):
         """
         List all image files inside each `dir_name/training_dir/image_dir`
         with "channel_name" in the filename.
+        If a FileManifest is given, the directories are listed from it.
         """
         filelist = []
         for direc in training_dirs:
-            imglist = os.listdir(os.path.join(dir_name, direc, image_dir))
+            imglist = listdir(os.path.join(dir_name, direc, image_dir), manifest=manifest)
 
             for channel in channel_names:
                 for img in imglist:
@@ -1919,7 +2022,7 @@ class MaskRCNNGenerator(_MaskRCNNGenerator):
         return sorted(filelist)
 
     def randomcrops(self, dirpaths, maskpaths, size_x, size_y, iteration=1):
-        img = cv2.imread(dirpaths[0], 0)
+        img = get_cached_image(dirpaths[0], _read_grayscale, 'cv2_grayscale')
         img_y = img.shape[0]
         img_x = img.shape[1]
         act_x = img_x - size_x
@@ -1935,13 +2038,13 @@ class MaskRCNNGenerator(_MaskRCNNGenerator):
                 rand_x = np.random.randint(0, act_x)
                 rand_y = np.random.randint(0, act_y)
                 cropindex.append((rand_x, rand_y))
-                image = cv2.imread(path, 0)
+                image = get_cached_image(path, _read_grayscale, 'cv2_grayscale')
                 newimg = image[rand_y:rand_y + size_y, rand_x:rand_x + size_x]
                 newimg = np.tile(np.expand_dims(newimg, axis=-1), (1, 1, 3))
                 outputi.append(newimg)
 
             for i, path in enumerate(maskpaths):
-                image = cv2.imread(path, 0)
+                image = get_cached_image(path, _read_grayscale, 'cv2_grayscale')
                 rand_x = cropindex[i][0]
                 rand_y = cropindex[i][1]
                 newimg = image[rand_y:rand_y + size_y, rand_x:rand_x + size_x]
@@ -30,16 +30,22 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import asyncio
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
+from scipy import ndimage
 from skimage.external import tifffile as tiff
+from tensorflow.python.framework import ops
 from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.models import Model
 
 from deepcell.utils.data_utils import trim_padding
 from deepcell.utils.io_utils import get_images_from_directory
+from deepcell.utils.io_utils import ImageDirectoryIterator
 
 
 def get_cropped_input_shape(images, num_crops=4, receptive_field=61, data_format=None):
@@ -96,9 +102,123 @@ def get_padding_layers(model):
     return padding_layers
 
 
-def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=None):
-    """Slice images into num_crops * num_crops pieces, and use the model to
-    process each small image.
+def _get_whole_image_padding(model, padding=None):
+    """Infer the padding mode of process_whole_image from the model's padding layers
+    # Arguments:
+        model: model that will process each small image
+        padding: type of padding for input images, one of {'reflect', 'zero'}
+    # Returns:
+        padding: validated padding mode
+    """
+    if not padding:
+        padding_layers = get_padding_layers(model)
+        if padding_layers:
+            padding = 'reflect' if 'reflect' in padding_layers[0] else 'zero'
+
+    if str(padding).lower() not in {'reflect', 'zero'}:
+        raise ValueError('Expected `padding_mode` to be either `zero` or '
+                         '`reflect`.  Got ', padding)
+    return padding
+
+
+def _get_halo_runs(start, stop, size, padding='reflect'):
+    """Map the padded coordinates [start, stop) of an axis of length size onto
+    contiguous runs of the unpadded axis.
+    # Arguments:
+        start: first coordinate, may be negative
+        stop: last coordinate (exclusive), may be larger than size
+        size: length of the unpadded axis
+        padding: type of padding, one of {'reflect', 'zero'}
+    # Returns:
+        list of (destination slice, source slice) tuples.  The source slice
+        is None for runs that are zero padded.
+    """
+    index = np.arange(start, stop)
+    if str(padding).lower() == 'reflect':
+        # same indexing as np.pad(..., mode='reflect'), for any pad width
+        period = 2 * (size - 1)
+        index = np.abs(index) % period if period else np.zeros_like(index)
+        index = np.where(index >= size, period - index, index)
+        valid = np.ones(index.shape, dtype='bool')
+    else:
+        valid = (index >= 0) & (index < size)
+
+    runs = []
+    run_start = 0
+    for i in range(1, len(index) + 1):
+        # extend the current run while it is zero padded or has a step of +/-1
+        if i < len(index) and valid[i] == valid[run_start]:
+            if not valid[i]:
+                continue
+            step = index[i] - index[i - 1]
+            run_step = index[run_start + 1] - index[run_start] if i - run_start > 1 else step
+            if abs(step) == 1 and step == run_step:
+                continue
+
+        dst = slice(run_start, i)
+        if not valid[run_start]:
+            src = None
+        elif i - run_start > 1 and index[run_start + 1] < index[run_start]:
+            first, last = index[run_start], index[i - 1]
+            src = slice(first, last - 1 if last > 0 else None, -1)
+        else:
+            src = slice(index[run_start], index[i - 1] + 1)
+        runs.append((dst, src))
+        run_start = i
+    return runs
+
+
+def get_padded_tile(images, row_range, col_range, padding='reflect', out=None,
+                    data_format=None):
+    """Build a tile of the padded images directly from the unpadded images.
+    Equivalent to slicing np.pad(images, ...) in the x and y axes, without
+    creating the padded copy of the entire stack.
+    # Arguments:
+        images: numpy array of unpadded images
+        row_range: (start, stop) of the tile's rows, in unpadded coordinates.
+                   The range may extend past the borders of the images.
+        col_range: (start, stop) of the tile's columns, in unpadded coordinates
+        padding: type of padding for the halo, one of {'reflect', 'zero'}
+        out: optional array to write the tile into, which can be reused
+             between tiles of the same shape
+    # Returns:
+        tile: numpy array of the padded tile
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    if data_format == 'channels_first':
+        row_axis, col_axis = images.ndim - 2, images.ndim - 1
+    else:
+        row_axis, col_axis = images.ndim - 3, images.ndim - 2
+
+    tile_shape = list(images.shape)
+    tile_shape[row_axis] = row_range[1] - row_range[0]
+    tile_shape[col_axis] = col_range[1] - col_range[0]
+    if out is None:
+        out = np.empty(tile_shape, dtype=images.dtype)
+    elif list(out.shape) != tile_shape:
+        raise ValueError('Expected `out` to have shape {}. Got {}'.format(
+            tuple(tile_shape), out.shape))
+
+    row_runs = _get_halo_runs(row_range[0], row_range[1], images.shape[row_axis], padding)
+    col_runs = _get_halo_runs(col_range[0], col_range[1], images.shape[col_axis], padding)
+
+    for row_dst, row_src in row_runs:
+        for col_dst, col_src in col_runs:
+            dst = [slice(None)] * images.ndim
+            dst[row_axis], dst[col_axis] = row_dst, col_dst
+            if row_src is None or col_src is None:
+                out[tuple(dst)] = 0
+            else:
+                src = [slice(None)] * images.ndim
+                src[row_axis], src[col_axis] = row_src, col_src
+                out[tuple(dst)] = images[tuple(src)]
+    return out
+
+
+def _setup_whole_image(model, images, num_crops=4, receptive_field=61, padding=None):
+    """Validate the inputs of process_whole_image and get the location of
+    each padded sub-image and its location in the model output.
     # Arguments:
         model: model that will process each small image
         images: numpy array that is too big for model.predict(images)
@@ -106,7 +226,10 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
         receptive_field: receptive field used by model, required to pad images
         padding: type of padding for input images, one of {'reflect', 'zero'}
     # Returns:
-        model_output: numpy array containing model outputs for each sub-image
+        output: zeroed numpy array to hold the model output
+        crops: list of ((row_range, col_range), output index) for each sub-image,
+               where the ranges are the padded sub-image in unpadded coordinates
+        padding: validated padding mode
     """
     if K.image_data_format() == 'channels_first':
         channel_axis = 1
@@ -117,14 +240,7 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
         row_axis = len(images.shape) - 3
         col_axis = len(images.shape) - 2
 
-    if not padding:
-        padding_layers = get_padding_layers(model)
-        if padding_layers:
-            padding = 'reflect' if 'reflect' in padding_layers[0] else 'zero'
-
-    if str(padding).lower() not in {'reflect', 'zero'}:
-        raise ValueError('Expected `padding_mode` to be either `zero` or '
-                         '`reflect`.  Got ', padding)
+    padding = _get_whole_image_padding(model, padding)
 
     # Split the frames into quarters, as the full image size is too large
     crop_x = images.shape[row_axis] // num_crops
@@ -147,66 +263,240 @@ def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=
                          ' with the proper input_shape'.format(
                              expected_input_shape, model.input_shape[1:]))
 
-    # pad the images only in the x and y axes
-    pad_width = []
-    for i in range(len(images.shape)):
-        if i == row_axis:
-            pad_width.append((win_x, win_x))
-        elif i == col_axis:
-            pad_width.append((win_y, win_y))
-        else:
-            pad_width.append((0, 0))
-
-    if str(padding).lower() == 'reflect':
-        padded_images = np.pad(images, pad_width, mode='reflect')
-    else:
-        padded_images = np.pad(images, pad_width, mode='constant', constant_values=0)
-
+    # the halo of each sub-image is padded only in the x and y axes
+    crops = []
     for i in range(num_crops):
         for j in range(num_crops):
-            e, f = i * crop_x, (i + 1) * crop_x + 2 * win_x
-            g, h = j * crop_y, (j + 1) * crop_y + 2 * win_y
-
-            if images.ndim == 5:
-                if channel_axis == 1:
-                    predicted = model.predict(padded_images[:, :, :, e:f, g:h])
-                else:
-                    predicted = model.predict(padded_images[:, :, e:f, g:h, :])
-            else:
-                if channel_axis == 1:
-                    predicted = model.predict(padded_images[:, :, e:f, g:h])
-                else:
-                    predicted = model.predict(padded_images[:, e:f, g:h, :])
-
-            # if using skip_connections, get the final model output
-            if isinstance(predicted, list):
-                predicted = predicted[-1]
-
-            # if the model uses padding, trim the output images to proper shape
-            # if model does not use padding, images should already be correct
-            if padding:
-                predicted = trim_padding(predicted, win_x, win_y)
-
-            a, b = i * crop_x, (i + 1) * crop_x
-            c, d = j * crop_y, (j + 1) * crop_y
-
-            if images.ndim == 5:
-                if channel_axis == 1:
-                    output[:, :, :, a:b, c:d] = predicted
-                else:
-                    output[:, :, a:b, c:d, :] = predicted
-            else:
-                if channel_axis == 1:
-                    output[:, :, a:b, c:d] = predicted
-                else:
-                    output[:, a:b, c:d, :] = predicted
+            row_range = (i * crop_x - win_x, (i + 1) * crop_x + win_x)
+            col_range = (j * crop_y - win_y, (j + 1) * crop_y + win_y)
+
+            output_crop = [slice(None)] * images.ndim
+            output_crop[row_axis] = slice(i * crop_x, (i + 1) * crop_x)
+            output_crop[col_axis] = slice(j * crop_y, (j + 1) * crop_y)
+
+            crops.append(((row_range, col_range), tuple(output_crop)))
+
+    return output, crops, padding
+
+
+def _format_crop_prediction(predicted, padding, receptive_field=61):
+    """Get the final output of a sub-image prediction, trimmed to the crop size"""
+    # if using skip_connections, get the final model output
+    if isinstance(predicted, list):
+        predicted = predicted[-1]
+
+    # if the model uses padding, trim the output images to proper shape
+    # if model does not use padding, images should already be correct
+    if padding:
+        win_x, win_y = (receptive_field - 1) // 2, (receptive_field - 1) // 2
+        predicted = trim_padding(predicted, win_x, win_y)
+    return predicted
+
+
+def process_whole_image(model, images, num_crops=4, receptive_field=61, padding=None):
+    """Slice images into num_crops * num_crops pieces, and use the model to
+    process each small image.
+    # Arguments:
+        model: model that will process each small image
+        images: numpy array that is too big for model.predict(images)
+        num_crops: number of slices for the x and y axis to create sub-images
+        receptive_field: receptive field used by model, required to pad images
+        padding: type of padding for input images, one of {'reflect', 'zero'}
+    # Returns:
+        model_output: numpy array containing model outputs for each sub-image
+    """
+    output, crops, padding = _setup_whole_image(
+        model, images, num_crops, receptive_field, padding)
+
+    # every padded sub-image has the same shape, so a single buffer is reused
+    tile = None
+    for (row_range, col_range), output_crop in crops:
+        tile = get_padded_tile(images, row_range, col_range, padding, out=tile)
+        predicted = model.predict(tile)
+        output[output_crop] = _format_crop_prediction(predicted, padding, receptive_field)
 
     return output
 
 
-def run_model(image, model, win_x=30, win_y=30, split=True):
-    # pad_width = ((0, 0), (0, 0), (win_x, win_x), (win_y, win_y))
-    # image = np.pad(image, pad_width=pad_width , mode='constant', constant_values=0)
+def resize_images(images, size, data_format=None):
+    """Bilinearly resample the rows and columns of images with ndimage.zoom,
+    whose sampling grid aligns the corner pixels of the input and output.
+    # Arguments:
+        images: numpy array of images, of ndim 4 or 5
+        size: new (rows, cols) of the images
+    # Returns:
+        resized: numpy array of the resampled images
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    if data_format == 'channels_first':
+        row_axis, col_axis = images.ndim - 2, images.ndim - 1
+    else:
+        row_axis, col_axis = images.ndim - 3, images.ndim - 2
+
+    if (images.shape[row_axis], images.shape[col_axis]) == tuple(size):
+        return images
+
+    zoom = [1] * images.ndim
+    zoom[row_axis] = size[0] / images.shape[row_axis]
+    zoom[col_axis] = size[1] / images.shape[col_axis]
+    return ndimage.zoom(images, zoom, order=1, mode='nearest')
+
+
+def _get_scale_mismatch(rows, cols, tile_x, tile_y, num_crops, scale):
+    """Relative difference between `scale` and the scale of a pyramid level,
+    which resamples rows x cols images to num_crops tiles per axis"""
+    scale_x = num_crops * tile_x / rows
+    scale_y = num_crops * tile_y / cols
+    return max(abs(scale_x / scale - 1), abs(scale_y / scale - 1))
+
+
+def get_pyramid_levels(images, model, scale=1, receptive_field=61, tolerance=.1,
+                       num_levels=1):
+    """Get the number of crops of each level of process_whole_image_pyramid.
+    The model's input shape fixes the size of each sub-image, so a level with
+    num_crops crops resamples the images to num_crops sub-images per axis.
+    # Arguments:
+        images: numpy array of images at their native resolution
+        model: model that will process each small image
+        scale: factor to resize the images by to match the training data scale,
+               e.g. 0.5 for images at twice the training magnification
+        receptive_field: receptive field used by model
+        tolerance: maximum relative difference between the scale of the first
+                   level and `scale`
+        num_levels: number of levels, each with half the crops of the previous
+    # Returns:
+        levels: list of num_crops for each level, finest level first
+    """
+    if K.image_data_format() == 'channels_first':
+        row_axis, col_axis = images.ndim - 2, images.ndim - 1
+    else:
+        row_axis, col_axis = images.ndim - 3, images.ndim - 2
+
+    # size of each sub-image without its receptive field halo
+    tile_x = model.input_shape[row_axis] - (receptive_field - 1)
+    tile_y = model.input_shape[col_axis] - (receptive_field - 1)
+    if tile_x < 1 or tile_y < 1:
+        raise ValueError('The receptive field {} is larger than the model '
+                         'input shape {}'.format(receptive_field, model.input_shape))
+
+    def mismatch(num_crops):
+        return _get_scale_mismatch(images.shape[row_axis], images.shape[col_axis],
+                                   tile_x, tile_y, num_crops, scale)
+
+    # the cheapest level is the one with the fewest crops
+    max_crops = int(np.ceil(images.shape[row_axis] * scale * (1 + tolerance) / tile_x)) + 1
+    candidates = list(range(1, max(max_crops, 1) + 1))
+    matches = [n for n in candidates if mismatch(n) <= tolerance]
+    if matches:
+        num_crops = matches[0]
+    else:
+        num_crops = min(candidates, key=mismatch)
+        warnings.warn('No pyramid level is within {:.0%} of scale {}. Using '
+                      '{} crops with a mismatch of {:.0%}.'.format(
+                          tolerance, scale, num_crops, mismatch(num_crops)))
+
+    levels = [num_crops]
+    while len(levels) < num_levels and levels[-1] > 1:
+        levels.append(levels[-1] // 2)
+    return levels
+
+
+def process_whole_image_pyramid(model, images, scale=1, receptive_field=61, padding=None,
+                                tolerance=.1, num_levels=1):
+    """Resample images to the scale of the training data, process them with
+    process_whole_image and resample the output back to native resolution.
+    # Arguments:
+        model: model that will process each small image
+        images: numpy array of images at their native resolution
+        scale: factor to resize the images by to match the training data scale,
+               e.g. 0.5 for images at twice the training magnification.
+        receptive_field: receptive field used by model, required to pad images
+        padding: type of padding for input images, one of {'reflect', 'zero'}
+        tolerance: maximum relative difference between the scale of the
+                   finest level and `scale`.  The level with the fewest
+                   crops within the tolerance is used.
+        num_levels: number of pyramid levels, each with half the crops of
+                    the previous.  The outputs of the levels are averaged:
+                    levels within tolerance of `scale` have a weight of 1,
+                    and other levels a weight of tolerance / mismatch, where
+                    mismatch is their relative difference from `scale`.
+                    Coarser levels add context at the cost of accuracy, as
+                    the model sees them at a scale it was not trained on.
+    # Returns:
+        model_output: numpy array of the model output at native resolution
+    """
+    if K.image_data_format() == 'channels_first':
+        row_axis, col_axis = images.ndim - 2, images.ndim - 1
+    else:
+        row_axis, col_axis = images.ndim - 3, images.ndim - 2
+
+    levels = get_pyramid_levels(images, model, scale=scale, receptive_field=receptive_field,
+                                tolerance=tolerance, num_levels=num_levels)
+
+    tile_x = model.input_shape[row_axis] - (receptive_field - 1)
+    tile_y = model.input_shape[col_axis] - (receptive_field - 1)
+    native_size = (images.shape[row_axis], images.shape[col_axis])
+
+    def mismatch(num_crops):
+        return _get_scale_mismatch(native_size[0], native_size[1],
+                                   tile_x, tile_y, num_crops, scale)
+
+    # the finest level is the best match, so it always has a weight of 1
+    max_mismatch = max(tolerance, mismatch(levels[0]))
+
+    model_output, total_weight = None, 0
+    for num_crops in levels:
+        weight = min(1, max_mismatch / mismatch(num_crops)) if mismatch(num_crops) else 1
+
+        resized = resize_images(images, (num_crops * tile_x, num_crops * tile_y))
+        output = process_whole_image(model, resized, num_crops=num_crops,
+                                     receptive_field=receptive_field, padding=padding)
+        output = weight * resize_images(output, native_size)
+        if model_output is None:
+            model_output = output
+        else:
+            model_output += output
+        total_weight += weight
+
+    return model_output / total_weight
+
+
+def _get_split_tiles(image_shape, win_x=30, win_y=30):
+    """Get the overlapping quadrants of the images that are processed
+    separately when running a model with split=True.
+    # Arguments:
+        image_shape: shape of the batch of images
+        win_x: number of row pixels trimmed by the model on either side
+        win_y: number of column pixels trimmed by the model on either side
+    # Returns:
+        list of (image index, model output index) for each quadrant
+    """
+    is_channels_first = K.image_data_format() == 'channels_first'
+    x_axis = 2 if is_channels_first else 1
+    y_axis = 3 if is_channels_first else 2
+
+    image_size_x = image_shape[x_axis] // 2
+    image_size_y = image_shape[y_axis] // 2
+
+    x_tiles = [(slice(0, image_size_x + win_x), slice(0, image_size_x - win_x)),
+               (slice(image_size_x - win_x, None), slice(image_size_x - win_x, None))]
+    y_tiles = [(slice(0, image_size_y + win_y), slice(0, image_size_y - win_y)),
+               (slice(image_size_y - win_y, None), slice(image_size_y - win_y, None))]
+
+    tiles = []
+    for image_x, output_x in x_tiles:
+        for image_y, output_y in y_tiles:
+            image_index = [slice(None)] * len(image_shape)
+            image_index[x_axis], image_index[y_axis] = image_x, image_y
+            output_index = [slice(None)] * len(image_shape)
+            output_index[x_axis], output_index[y_axis] = output_x, output_y
+            tiles.append((tuple(image_index), tuple(output_index)))
+    return tiles
+
+
+def _get_model_output_shape(image_shape, model, win_x=30, win_y=30):
+    """Get the shape of the model output for a batch of images with split=True"""
     is_channels_first = K.image_data_format() == 'channels_first'
     channel_axis = 1 if is_channels_first else -1
     x_axis = 2 if is_channels_first else 1
@@ -214,76 +504,195 @@ def run_model(image, model, win_x=30, win_y=30, split=True):
 
     n_features = model.layers[-1].output_shape[channel_axis]
 
+    image_size_x = image_shape[x_axis] // 2
+    image_size_y = image_shape[y_axis] // 2
+
+    if is_channels_first:
+        shape = (n_features, 2 * image_size_x - win_x * 2, 2 * image_size_y - win_y * 2)
+    else:
+        shape = (2 * image_size_x - win_x * 2, 2 * image_size_y - win_y * 2, n_features)
+    return (image_shape[0],) + shape
+
+
+def _run_model_batch(images, model, win_x=30, win_y=30, split=True):
+    """Run the model on a batch of images of the same shape
+    # Arguments:
+        images: batch of images to process
+        model: model used to process the images
+        win_x: number of row pixels trimmed by the model on either side
+        win_y: number of column pixels trimmed by the model on either side
+        split: if True, process each quadrant of the images separately
+    # Returns:
+        model_output: numpy array of the model output for each image
+    """
     if split:
         warnings.warn('The split flag is deprecated and is designed to account '
                       'for a maximum tensor size.')
 
-        image_size_x = image.shape[x_axis] // 2
-        image_size_y = image.shape[y_axis] // 2
-
-        if is_channels_first:
-            shape = (n_features, 2 * image_size_x - win_x * 2, 2 * image_size_y - win_y * 2)
-        else:
-            shape = (2 * image_size_x - win_x * 2, 2 * image_size_y - win_y * 2, n_features)
-
+        shape = _get_model_output_shape(images.shape, model, win_x=win_x, win_y=win_y)
         model_output = np.zeros(shape, dtype=K.floatx())
 
-        if is_channels_first:
-            img_0 = image[:, :, 0:image_size_x + win_x, 0:image_size_y + win_y]
-            img_1 = image[:, :, 0:image_size_x + win_x, image_size_y - win_y:]
-            img_2 = image[:, :, image_size_x - win_x:, 0:image_size_y + win_y]
-            img_3 = image[:, :, image_size_x - win_x:, image_size_y - win_y:]
-
-            model_output[:, 0:image_size_x - win_x, 0:image_size_y - win_y] = model.predict(img_0)
-            model_output[:, 0:image_size_x - win_x, image_size_y - win_y:] = model.predict(img_1)
-            model_output[:, image_size_x - win_x:, 0:image_size_y - win_y] = model.predict(img_2)
-            model_output[:, image_size_x - win_x:, image_size_y - win_y:] = model.predict(img_3)
-        else:
-            img_0 = image[:, 0:image_size_x + win_x, 0:image_size_y + win_y, :]
-            img_1 = image[:, 0:image_size_x + win_x, image_size_y - win_y:, :]
-            img_2 = image[:, image_size_x - win_x:, 0:image_size_y + win_y, :]
-            img_3 = image[:, image_size_x - win_x:, image_size_y - win_y:, :]
-
-            model_output[0:image_size_x - win_x, 0:image_size_y - win_y, :] = model.predict(img_0)
-            model_output[0:image_size_x - win_x, image_size_y - win_y:, :] = model.predict(img_1)
-            model_output[image_size_x - win_x:, 0:image_size_y - win_y, :] = model.predict(img_2)
-            model_output[image_size_x - win_x:, image_size_y - win_y:, :] = model.predict(img_3)
+        for image_index, output_index in _get_split_tiles(images.shape, win_x, win_y):
+            model_output[output_index] = model.predict(images[image_index])
 
     else:
-        model_output = model.predict(image)
-        model_output = model_output[0, :, :, :]
+        model_output = model.predict(images)
 
     return model_output
 
 
-def run_model_on_directory(data_location, channel_names, output_location, model,
-                           win_x=30, win_y=30, split=True, save=True):
+def run_model(image, model, win_x=30, win_y=30, split=True):
+    # pad_width = ((0, 0), (0, 0), (win_x, win_x), (win_y, win_y))
+    # image = np.pad(image, pad_width=pad_width , mode='constant', constant_values=0)
+    model_output = _run_model_batch(image, model, win_x=win_x, win_y=win_y, split=split)
+    return model_output[0]
+
 
+def run_model_on_directory(data_location, channel_names, output_location, model,
+                           win_x=30, win_y=30, split=True, save=True, batch_size=1,
+                           prefetch=2, return_outputs=True):
+    """Run the model on every image in the directory.  Images are read
+    lazily, with the next `prefetch` batches read in the background, and
+    predicted in batches of up to batch_size consecutive images.
+    # Arguments:
+        data_location: directory of images with channel_names in the filename
+        channel_names: list of channel names to load for each image
+        output_location: directory to save the features of each model output
+        model: model used to process the images
+        win_x: number of row pixels trimmed by the model on either side
+        win_y: number of column pixels trimmed by the model on either side
+        split: if True, process each quadrant of the images separately
+        save: if True, save the model output features in output_location
+        batch_size: maximum number of images passed to each model.predict
+        prefetch: number of batches read ahead of the model
+        return_outputs: if False, model outputs are only saved, not kept,
+                        so memory use does not grow with the number of images
+    # Returns:
+        model_outputs: list of the model output for each image, in order,
+                       or None if return_outputs is False
+    """
     is_channels_first = K.image_data_format() == 'channels_first'
     channel_axis = 1 if is_channels_first else -1
     n_features = model.layers[-1].output_shape[channel_axis]
 
-    image_list = get_images_from_directory(data_location, channel_names)
-    model_outputs = []
+    image_batches = ImageDirectoryIterator(data_location, channel_names,
+                                           batch_size=batch_size, prefetch=prefetch)
+    n_images = image_batches.num_images
+
+    model_outputs = [] if return_outputs else None
+    frame = 0
+    for images in image_batches:
+        print('Processing image {} of {}'.format(
+            ', '.join(str(i + 1) for i in range(frame, frame + len(images))), n_images))
+        batch_output = _run_model_batch(images, model, win_x=win_x, win_y=win_y, split=split)
+        for model_output in batch_output:
+            if save:
+                _save_features(model_output, frame, n_features, output_location)
+            if return_outputs:
+                model_outputs.append(model_output)
+            frame += 1
+
+    return model_outputs
+
+
+def _save_features(model_output, frame, n_features, output_location):
+    """Save each feature of a single model output as a tiff image"""
+    is_channels_first = K.image_data_format() == 'channels_first'
+    for f in range(n_features):
+        feature = model_output[f, :, :] if is_channels_first else model_output[:, :, f]
+        cnnout_name = 'feature_{}_frame_{}.tif'.format(f, str(frame).zfill(3))
+        tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+
+
+def _run_ensemble_adaptive(image_list, model, list_of_weights, win_x=30, win_y=30,
+                           split=True, batch_size=1, tolerance=1e-3, criterion='mean',
+                           min_members=2):
+    """Average the outputs of an ensemble of weights, adding one member at a time.
+    Each tile (a quadrant of an image if split, otherwise the whole image)
+    stops being evaluated once it has converged within the tolerance.
+    # Arguments:
+        image_list: list of images of the same shape, each with a batch size of 1
+        model: model used to process the images
+        list_of_weights: list of paths to the weights of each ensemble member
+        win_x: number of row pixels trimmed by the model on either side
+        win_y: number of column pixels trimmed by the model on either side
+        split: if True, process each quadrant of the images separately
+        batch_size: maximum number of tiles passed to each model.predict
+        tolerance: a tile converges when its criterion is below tolerance
+        criterion: one of {'mean', 'variance'}.  'mean' is the largest change
+                   in the tile's running mean from the last member, and
+                   'variance' is the largest standard error of the mean
+        min_members: minimum number of members evaluated for each tile
+    # Returns:
+        model_output: numpy array of the mean model output of each image
+        member_counts: number of members evaluated for each (image, tile)
+    """
+    if criterion not in {'mean', 'variance'}:
+        raise ValueError('`criterion` must be either `mean` or `variance`. '
+                         'Got {}'.format(criterion))
 
+    if not image_list:
+        raise ValueError('No images to process')
+
+    image_shape = image_list[0].shape
     for i, image in enumerate(image_list):
-        print('Processing image {} of {}'.format(i + 1, len(image_list)))
-        model_output = run_model(image, model, win_x=win_x, win_y=win_y, split=split)
-        model_outputs.append(model_output)
+        if image.shape != image_shape:
+            raise ValueError('All images must have the same shape, but image {} has '
+                             'shape {} and image 0 has shape {}'.format(
+                                 i, image.shape, image_shape))
 
-        # Save images
-        if save:
-            for f in range(n_features):
-                feature = model_output[f, :, :] if is_channels_first else model_output[:, :, f]
-                cnnout_name = 'feature_{}_frame_{}.tif'.format(f, str(i).zfill(3))
-                tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+    min_members = max(int(min_members), 2)
+    if split:
+        shape = _get_model_output_shape(image_shape, model, win_x=win_x, win_y=win_y)
+        tiles = _get_split_tiles(image_shape, win_x, win_y)
+    else:
+        shape = (1,) + tuple(model.layers[-1].output_shape[1:])
+        tiles = [(tuple([slice(None)] * len(image_shape)),) * 2]
 
-    return model_outputs
+    # running mean and sum of squared differences (Welford's algorithm)
+    mean = np.zeros((len(image_list),) + shape[1:], dtype='float64')
+    sum_sq = np.zeros(mean.shape, dtype='float64')
+    member_counts = np.zeros((len(image_list), len(tiles)), dtype='int32')
+    active = np.ones(member_counts.shape, dtype='bool')
 
+    for weights_path in list_of_weights:
+        if not active.any():
+            break
+        model.load_weights(weights_path)
 
-def run_models_on_directory(data_location, channel_names, output_location, model_fn,
-                            list_of_weights, n_features=3, win_x=30, win_y=30,
-                            image_size_x=1080, image_size_y=1280, save=True, split=True):
+        for t, (image_index, output_index) in enumerate(tiles):
+            output_index = output_index[1:]
+            indices = np.where(active[:, t])[0]
+            for b in range(0, len(indices), batch_size):
+                batch = indices[b:b + batch_size]
+                images = np.concatenate([image_list[i][image_index] for i in batch], axis=0)
+                predicted = model.predict(images)
+
+                for i, prediction in zip(batch, predicted):
+                    n = member_counts[i, t] + 1
+                    old_mean = mean[i][output_index].copy()
+                    delta = prediction - old_mean
+                    mean[i][output_index] += delta / n
+                    sum_sq[i][output_index] += delta * (prediction - mean[i][output_index])
+                    member_counts[i, t] = n
+
+                    if n < min_members:
+                        continue
+                    if criterion == 'mean':
+                        change = np.amax(np.abs(mean[i][output_index] - old_mean))
+                    else:
+                        change = np.sqrt(np.amax(sum_sq[i][output_index]) / (n * (n - 1)))
+                    if change < tolerance:
+                        active[i, t] = False
+
+    print('Evaluated {:.2f} of {} ensemble members per tile on average'.format(
+        member_counts.mean(), len(list_of_weights)))
+    return mean.astype(K.floatx()), member_counts
+
+
+def _get_ensemble_model(model_fn, channel_names, n_features=3, win_x=30, win_y=30,
+                        image_size_x=1080, image_size_y=1280, split=True):
+    """Build the model shared by the members of an ensemble"""
     if split:
         input_shape = (len(channel_names), image_size_x // 2 + win_x, image_size_y // 2 + win_y)
     else:
@@ -292,24 +701,51 @@ def run_models_on_directory(data_location, channel_names, output_location, model
     is_channels_first = K.image_data_format() == 'channels_first'
     if not is_channels_first:
         input_shape = (input_shape[1], input_shape[2], input_shape[0])
-        batch_shape = (1, input_shape[1], input_shape[2], input_shape[0])
-    else:
-        batch_shape = (1, input_shape[0], input_shape[1], input_shape[2])
 
     model = model_fn(input_shape=input_shape, n_features=n_features)
 
     for layer in model.layers:
         print(layer.name)
 
+    return model
+
+
+def _save_ensemble_output(model_output, model, output_location):
+    """Save each feature of the mean model output of each image"""
+    is_channels_first = K.image_data_format() == 'channels_first'
     channel_axis = 1 if is_channels_first else -1
     n_features = model.layers[-1].output_shape[channel_axis]
+    for i in range(model_output.shape[0]):
+        for f in range(n_features):
+            if is_channels_first:
+                feature = model_output[i, f, :, :]
+            else:
+                feature = model_output[i, :, :, f]
+            cnnout_name = 'feature_{}_frame_{}.tif'.format(f, i)
+            tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+
+
+def run_models_on_directory(data_location, channel_names, output_location, model_fn,
+                            list_of_weights, n_features=3, win_x=30, win_y=30,
+                            image_size_x=1080, image_size_y=1280, save=True, split=True,
+                            batch_size=1):
+    """Average the outputs of an ensemble of model weights on every image
+    in the directory.
+    # Arguments:
+        batch_size: maximum number of images passed to each model.predict
+    # Returns:
+        model_output: the mean model output of each image
+    """
+    model = _get_ensemble_model(model_fn, channel_names, n_features=n_features,
+                                win_x=win_x, win_y=win_y, image_size_x=image_size_x,
+                                image_size_y=image_size_y, split=split)
 
     model_outputs = []
     for weights_path in list_of_weights:
         model.load_weights(weights_path)
         processed_image_list = run_model_on_directory(
             data_location, channel_names, output_location, model,
-            win_x=win_x, win_y=win_y, save=False, split=split)
+            win_x=win_x, win_y=win_y, save=False, split=split, batch_size=batch_size)
 
         model_outputs.append(np.stack(processed_image_list, axis=0))
 
@@ -319,13 +755,182 @@ def run_models_on_directory(data_location, channel_names, output_location, model
 
     # Save images
     if save:
-        for i in range(model_output.shape[0]):
-            for f in range(n_features):
-                if is_channels_first:
-                    feature = model_output[i, f, :, :]
-                else:
-                    feature = model_output[i, :, :, f]
-                cnnout_name = 'feature_{}_frame_{}.tif'.format(f, i)
-                tiff.imsave(os.path.join(output_location, cnnout_name), feature)
+        _save_ensemble_output(model_output, model, output_location)
 
     return model_output
+
+
+def run_models_on_directory_adaptive(data_location, channel_names, output_location,
+                                     model_fn, list_of_weights, n_features=3, win_x=30,
+                                     win_y=30, image_size_x=1080, image_size_y=1280,
+                                     save=True, split=True, batch_size=1, tolerance=1e-3,
+                                     criterion='mean', min_members=2):
+    """Average the outputs of an ensemble of model weights on every image
+    in the directory, like run_models_on_directory, but add ensemble members
+    one at a time and stop evaluating each tile once it has converged.
+    All images must have the same shape.
+    # Arguments:
+        batch_size: maximum number of tiles passed to each model.predict
+        tolerance: convergence tolerance
+        criterion: convergence criterion, one of {'mean', 'variance'}.
+                   'mean' is the largest change in a tile's running mean from
+                   the last member, 'variance' is its largest standard error.
+        min_members: minimum number of members evaluated for each tile
+    # Returns:
+        model_output: the mean model output of each image
+        member_counts: the number of members evaluated for each (image, tile),
+                       where tiles are the image quadrants if split, or the
+                       whole image otherwise.
+    """
+    model = _get_ensemble_model(model_fn, channel_names, n_features=n_features,
+                                win_x=win_x, win_y=win_y, image_size_x=image_size_x,
+                                image_size_y=image_size_y, split=split)
+
+    image_list = get_images_from_directory(data_location, channel_names)
+    model_output, member_counts = _run_ensemble_adaptive(
+        image_list, model, list_of_weights, win_x=win_x, win_y=win_y,
+        split=split, batch_size=batch_size, tolerance=tolerance,
+        criterion=criterion, min_members=min_members)
+
+    # Save images
+    if save:
+        _save_ensemble_output(model_output, model, output_location)
+
+    return model_output, member_counts
+
+
+class AsyncModelRunner(object):
+    """Run a shared model from asyncio coroutines without blocking the event loop.
+    Every CPU-bound step (padding, reading and saving images, model.predict)
+    is offloaded to a dedicated executor, and at most `max_concurrent`
+    predictions run against the model at any time.
+    # Arguments:
+        model: model used for every prediction
+        max_concurrent: maximum number of concurrent calls to the model
+        executor: executor for CPU-bound steps.  If None, a ThreadPoolExecutor
+                  with `max_concurrent + 1` workers is created and owned by
+                  the runner.
+    """
+
+    def __init__(self, model, max_concurrent=1, executor=None):
+        if max_concurrent < 1:
+            raise ValueError('`max_concurrent` must be a positive integer. '
+                             'Got {}'.format(max_concurrent))
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_concurrent + 1)
+        self.executor = executor
+        # the model must be called with its graph from the executor threads
+        self._graph = ops.get_default_graph()
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        # created lazily to bind to the event loop running the coroutines
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    def _call_model(self, fn, *args, **kwargs):
+        with self._graph.as_default():
+            return fn(*args, **kwargs)
+
+    async def _run_in_executor(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def _run_model(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs), which uses the model, in the executor.
+        A call that has already started cannot be interrupted, so if the
+        coroutine is cancelled, its slot is held until the call has finished.
+        """
+        async with self._get_semaphore():
+            future = asyncio.ensure_future(
+                self._run_in_executor(self._call_model, fn, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait([future])
+                raise
+
+    async def predict(self, x, timeout=None):
+        """Coroutine version of model.predict
+        # Arguments:
+            x: input data for the model
+            timeout: seconds to wait for the prediction before raising
+                     asyncio.TimeoutError.  If None, wait forever.
+        # Returns:
+            the model prediction
+        """
+        return await asyncio.wait_for(self._run_model(self.model.predict, x), timeout)
+
+    async def _process_whole_image(self, images, num_crops, receptive_field, padding):
+        output, crops, padding = await self._run_in_executor(
+            _setup_whole_image, self.model, images, num_crops, receptive_field, padding)
+
+        async def process_crop(tile_ranges, output_crop):
+            # each concurrent sub-image needs its own tile
+            tile = await self._run_in_executor(get_padded_tile, images, *tile_ranges,
+                                               padding=padding)
+            predicted = await self._run_model(self.model.predict, tile)
+            output[output_crop] = _format_crop_prediction(predicted, padding, receptive_field)
+
+        await asyncio.gather(*[process_crop(p, o) for p, o in crops])
+        return output
+
+    async def process_whole_image(self, images, num_crops=4, receptive_field=61,
+                                  padding=None, timeout=None):
+        """Coroutine version of process_whole_image.  Sub-images are predicted
+        concurrently, up to the runner's `max_concurrent` limit.
+        # Arguments:
+            images: numpy array that is too big for model.predict(images)
+            num_crops: number of slices for the x and y axis to create sub-images
+            receptive_field: receptive field used by model, required to pad images
+            padding: type of padding for input images, one of {'reflect', 'zero'}
+            timeout: seconds to wait for the whole image before raising
+                     asyncio.TimeoutError.  If None, wait forever.
+        # Returns:
+            model_output: numpy array containing model outputs for each sub-image
+        """
+        coro = self._process_whole_image(images, num_crops, receptive_field, padding)
+        return await asyncio.wait_for(coro, timeout)
+
+    async def _run_model_on_directory(self, data_location, channel_names, output_location,
+                                      win_x, win_y, split, save):
+        is_channels_first = K.image_data_format() == 'channels_first'
+        channel_axis = 1 if is_channels_first else -1
+        n_features = self.model.layers[-1].output_shape[channel_axis]
+
+        image_list = await self._run_in_executor(
+            get_images_from_directory, data_location, channel_names)
+
+        async def process_image(i, image):
+            model_output = await self._run_model(
+                run_model, image, self.model, win_x=win_x, win_y=win_y, split=split)
+            if save:
+                await self._run_in_executor(
+                    _save_features, model_output, i, n_features, output_location)
+            return model_output
+
+        return await asyncio.gather(*[process_image(i, image)
+                                      for i, image in enumerate(image_list)])
+
+    async def run_model_on_directory(self, data_location, channel_names, output_location,
+                                     win_x=30, win_y=30, split=True, save=True, timeout=None):
+        """Coroutine version of run_model_on_directory.  Images are predicted
+        concurrently, up to the runner's `max_concurrent` limit.
+        # Arguments:
+            timeout: seconds to wait for the whole directory before raising
+                     asyncio.TimeoutError.  If None, wait forever.
+        # Returns:
+            model_outputs: list of the model outputs for each image, in order
+        """
+        coro = self._run_model_on_directory(data_location, channel_names, output_location,
+                                            win_x, win_y, split, save)
+        return list(await asyncio.wait_for(coro, timeout))
+
+    def shutdown(self, wait=True):
+        """Shut down the executor if it was created by the runner"""
+        if self._owns_executor:
+            self.executor.shutdown(wait=wait)
@@ -24,8 +24,23 @@
 # limitations under the License.
 # ==============================================================================
 """Settings file for saving shared constants"""
+import os
+
 from tensorflow.python.keras import backend as K
 
 IMAGE_DATA_FORMAT = K.image_data_format()
 CHANNELS_FIRST = IMAGE_DATA_FORMAT == 'channels_first'
 CHANNELS_LAST = IMAGE_DATA_FORMAT == 'channels_last'
+
+# Directory where transformed training targets are cached (disabled if None)
+TRANSFORM_CACHE_DIR = os.environ.get('DEEPCELL_TRANSFORM_CACHE_DIR')
+# Size limit of the transform cache, least recently used entries are evicted
+TRANSFORM_CACHE_MAX_BYTES = int(os.environ.get('DEEPCELL_TRANSFORM_CACHE_MAX_BYTES', 10 * 2 ** 30))
+
+# Size limit of the in-memory cache of decoded images shared by the loaders
+# (disabled if 0), least recently used images are evicted
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('DEEPCELL_IMAGE_CACHE_MAX_BYTES', 2 ** 29))
+
+# Directory with local copies of the builtin datasets, used instead of
+# downloading them (e.g. on air-gapped machines)
+DATASETS_MIRROR_DIR = os.environ.get('DEEPCELL_DATASETS_MIRROR_DIR')
@@ -39,13 +39,24 @@ from deepcell.utils import retinanet_anchor_utils
 
 # Globally-importable utils.
 from deepcell.utils.data_utils import get_data
+from deepcell.utils.data_utils import get_shard_data
 from deepcell.utils.data_utils import make_training_data
+from deepcell.utils.data_utils import make_training_data_sharded
+from deepcell.utils.data_utils import make_training_data_streaming
+from deepcell.utils.data_utils import merge_shards
+from deepcell.utils.data_utils import shard_dataset
 from deepcell.utils.export_utils import export_model
 from deepcell.utils.io_utils import get_immediate_subdirs
 from deepcell.utils.io_utils import get_image
+from deepcell.utils.io_utils import get_image_dtype
+from deepcell.utils.io_utils import get_image_region
+from deepcell.utils.io_utils import get_image_stack
+from deepcell.utils.io_utils import get_image_shape
 from deepcell.utils.io_utils import nikon_getfiles
 from deepcell.utils.io_utils import get_image_sizes
 from deepcell.utils.io_utils import get_images_from_directory
+from deepcell.utils.io_utils import ImageDirectoryIterator
+from deepcell.utils.io_utils import build_file_manifest
 from deepcell.utils.misc_utils import sorted_nicely
 from deepcell.utils.train_utils import rate_scheduler
 from deepcell.utils.transform_utils import distance_transform_2d
@@ -30,9 +30,19 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
+import json
 import os
 import random
+import shutil
+import zipfile
+
+try:
+    from urllib.request import pathname2url
+except ImportError:  # python 2
+    from urllib import pathname2url
 
 import numpy as np
 from sklearn.model_selection import train_test_split
@@ -43,25 +53,238 @@ try:
 except ImportError:
     from tensorflow.python.keras._impl.keras.utils import conv_utils
 
+try:
+    from tensorflow.python.keras.utils.data_utils import get_file
+except ImportError:  # tf v1.9 moves conv_utils from _impl to keras.utils
+    from tensorflow.python.keras._impl.keras.utils.data_utils import get_file
+
+from deepcell import settings
+from deepcell.utils.io_utils import filter_channel_files
 from deepcell.utils.io_utils import get_image
+from deepcell.utils.io_utils import get_image_dtype
+from deepcell.utils.io_utils import get_image_region
 from deepcell.utils.io_utils import get_image_sizes
+from deepcell.utils.io_utils import get_image_stack
+from deepcell.utils.io_utils import get_num_pages
 from deepcell.utils.io_utils import nikon_getfiles
 from deepcell.utils.io_utils import get_immediate_subdirs
+from deepcell.utils.io_utils import listdir
 from deepcell.utils.misc_utils import sorted_nicely
 
 
-def get_data(file_name, mode='sample', test_size=.1, seed=None):
+def _split_sample_key(key, ndim):
+    """Split the index of an array-like of samples into the index of its
+    samples and the index of the other axes.  An Ellipsis is expanded to
+    the axes it stands for, so that view[..., 0] indexes the last axis.
+    # Arguments
+        key: index passed to __getitem__
+        ndim: number of dimensions of the array-like
+    # Returns
+        sample_key, rest: rest is a tuple, empty if only samples are indexed
+    """
+    key = key if isinstance(key, tuple) else (key,)
+    ellipses = [i for i, k in enumerate(key) if k is Ellipsis]
+    if len(ellipses) > 1:
+        raise IndexError("an index can only have a single ellipsis ('...')")
+    if ellipses:
+        # boolean arrays index as many axes as they have, np.newaxis none
+        num_indexed = sum(np.ndim(k) if np.asarray(k).dtype == np.bool_ else 1
+                          for k in key if k is not None and k is not Ellipsis)
+        i = ellipses[0]
+        key = key[:i] + (slice(None),) * max(ndim - num_indexed, 0) + key[i + 1:]
+
+    if not key:
+        return slice(None), ()
+    if key[0] is None:
+        raise IndexError('np.newaxis cannot be the first index of an array of samples')
+    return key[0], key[1:]
+
+
+class IndexedArray(object):
+    """Array-like view of the samples of an array selected by an index array.
+    Samples are only read from the underlying array when they are indexed,
+    so views of a memory-mapped array never load the full dataset.
+    # Arguments
+        array: numpy array or memmap of all samples
+        indices: index array of the samples in this view
+    """
+
+    def __init__(self, array, indices):
+        self.array = array
+        self.indices = np.asarray(indices)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.array.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        sample_key, rest = _split_sample_key(key, self.ndim)
+        return self.array[(self.indices[sample_key],) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        # reads every sample of the view into memory
+        array = self.array[self.indices]
+        return array if dtype is None else array.astype(dtype)
+
+
+class ConcatenatedArray(object):
+    """Array-like view of arrays concatenated along the first axis.
+    Samples are only read from the underlying arrays when they are indexed,
+    so views of memory-mapped arrays never load the full dataset.
+    # Arguments
+        arrays: list of numpy arrays or memmaps with the same sample shape
+    """
+
+    def __init__(self, arrays):
+        self.arrays = list(arrays)
+        if not self.arrays:
+            raise ValueError('ConcatenatedArray needs at least one array')
+        sample_shapes = set(tuple(a.shape[1:]) for a in self.arrays)
+        if len(sample_shapes) > 1:
+            raise ValueError('Arrays must have the same sample shape, '
+                             'got {}'.format(sorted(sample_shapes)))
+        self.offsets = np.cumsum([0] + [len(a) for a in self.arrays])
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),) + tuple(self.arrays[0].shape[1:])
+
+    @property
+    def dtype(self):
+        return np.result_type(*[a.dtype for a in self.arrays])
+
+    @property
+    def ndim(self):
+        return self.arrays[0].ndim
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _take(self, indices):
+        """Gather the samples at the given indices, one array at a time"""
+        out = np.empty(indices.shape + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, indices, side='right') - 1
+        for i in np.unique(which):
+            mask = which == i
+            out[mask] = self.arrays[i][indices[mask] - self.offsets[i]]
+        return out
+
+    def __getitem__(self, key):
+        key, rest = _split_sample_key(key, self.ndim)
+        if rest:
+            samples = self[key]
+            if isinstance(key, (int, np.integer)):
+                return samples[rest]
+            return samples[(slice(None),) + rest]
+
+        if isinstance(key, (int, np.integer)):
+            index = int(key) + len(self) if key < 0 else int(key)
+            if not 0 <= index < len(self):
+                raise IndexError('index {} is out of bounds for ConcatenatedArray '
+                                 'of length {}'.format(key, len(self)))
+            i = np.searchsorted(self.offsets, index, side='right') - 1
+            return self.arrays[i][index - self.offsets[i]]
+
+        # normalizes slices, negative indices and boolean masks
+        return self._take(np.arange(len(self))[key])
+
+    def __array__(self, dtype=None, copy=None):
+        # reads every sample of the view into memory
+        array = np.concatenate([np.asarray(a) for a in self.arrays])
+        return array if dtype is None else array.astype(dtype)
+
+
+def get_dataset_npy_dir(file_name):
+    """Get a directory with X.npy and y.npy files of the dataset, which can be
+    memory-mapped.  NPZ files are extracted once into a directory next to
+    the file, one array at a time without loading them into memory.
+    # Arguments
+        file_name: path to an NPZ file or a directory with X.npy and y.npy
+    # Returns
+        path to the directory with X.npy and y.npy
+    """
+    if os.path.isdir(file_name):
+        return file_name
+
+    dataset_dir = '{}_npy'.format(os.path.splitext(file_name)[0])
+    with zipfile.ZipFile(file_name) as archive:
+        for key in ('X', 'y'):
+            # raises a KeyError if the array is not in the NPZ file
+            info = archive.getinfo('{}.npy'.format(key))
+            npy_path = os.path.join(dataset_dir, info.filename)
+            if os.path.isfile(npy_path) and \
+                    os.path.getmtime(npy_path) >= os.path.getmtime(file_name):
+                continue
+
+            if not os.path.isdir(dataset_dir):
+                os.makedirs(dataset_dir)
+            temp_path = '{}.tmp'.format(npy_path)
+            with archive.open(info) as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(temp_path, npy_path)
+
+    return dataset_dir
+
+
+def get_data(file_name, mode='sample', test_size=.1, seed=None, lazy=False):
     """Load data from NPZ file and split into train and test sets
     # Arguments
-        file_name: path to NPZ file to load
+        file_name: path to NPZ file to load, or a dataset directory with
+                   X.npy and y.npy (e.g. from make_training_data_streaming)
         mode: if 'sample', will return datapoints for each pixel,
               otherwise, returns the same data that was loaded
         test_size: percent of data to leave as testing holdout
         seed: seed number for random train/test split repeatability
+        lazy: if True, X and y are memory-mapped from uncompressed .npy files
+              and the splits are IndexedArray views, which only read the
+              samples that are indexed.  Always True for dataset directories.
     # Returns
         dict of training data, and a dict of testing data:
         train_dict, test_dict
     """
+    if read_dataset_index(file_name) is not None:
+        return get_shard_data(file_name, test_size=test_size, seed=seed)
+
+    if lazy or os.path.isdir(file_name):
+        dataset_dir = get_dataset_npy_dir(file_name)
+        X = np.load(os.path.join(dataset_dir, 'X.npy'), mmap_mode='r')
+        y = np.load(os.path.join(dataset_dir, 'y.npy'), mmap_mode='r')
+
+        # same split as the eager mode, but of the indices only
+        train_idx, test_idx = train_test_split(
+            np.arange(X.shape[0]), test_size=test_size, random_state=seed)
+
+        train_dict = {
+            'X': IndexedArray(X, train_idx),
+            'y': IndexedArray(y, train_idx)
+        }
+
+        test_dict = {
+            'X': IndexedArray(X, test_idx),
+            'y': IndexedArray(y, test_idx)
+        }
+
+        return train_dict, test_dict
+
     training_data = np.load(file_name)
     X = training_data['X']
     y = training_data['y']
@@ -82,6 +305,305 @@ def get_data(file_name, mode='sample', test_size=.1, seed=None):
     return train_dict, test_dict
 
 
+def _get_split_dir(file_name):
+    """Get the directory of the cached train/test split of a dataset file"""
+    return '{}_split'.format(os.path.splitext(file_name)[0])
+
+
+def _read_split_data(split_dir, config):
+    """Memory-map the cached train/test split in split_dir, if it was made
+    with the same config.  Arrays are copy-on-write, so they can be modified
+    in memory without changing the cache.
+    # Returns
+        train_dict, test_dict or None if there is no valid cached split
+    """
+    config_path = os.path.join(split_dir, 'split.json')
+    if not os.path.isfile(config_path):
+        return None
+    with open(config_path, 'r') as f:
+        if json.load(f) != config:
+            return None
+
+    data = {}
+    for split in ('train', 'test'):
+        data[split] = {
+            key: np.load(os.path.join(split_dir, '{}_{}.npy'.format(key, split)),
+                         mmap_mode='c')
+            for key in ('X', 'y')
+        }
+    return data['train'], data['test']
+
+
+def _get_split_config(file_name, test_size, seed, origin=None, file_hash=None):
+    """Config of the train/test split of file_name, which identifies a cached
+    split.  The origin and hash of a downloaded file are part of the config,
+    so a different dataset cached under the same name never reuses the split.
+    """
+    config = {
+        'file_size': os.path.getsize(file_name),
+        'file_mtime': os.path.getmtime(file_name),
+        'test_size': test_size,
+        'seed': seed,
+    }
+    if origin is not None:
+        config['origin'] = origin
+        config['file_hash'] = file_hash
+    return config
+
+
+def _cache_split_data(file_name, config):
+    """Load the cached train/test split of file_name with the given config,
+    splitting the file and saving the split first if it is not cached.
+    # Returns
+        train_dict, test_dict
+    """
+    split_dir = _get_split_dir(file_name)
+    split_data = _read_split_data(split_dir, config)
+    if split_data is not None:
+        return split_data
+
+    # the same split as get_data, saved into a temporary directory
+    train_dict, test_dict = get_data(
+        file_name, test_size=config['test_size'], seed=config['seed'])
+    temp_dir = '{}.{}.tmp'.format(split_dir, os.getpid())
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    for split, split_dict in (('train', train_dict), ('test', test_dict)):
+        for key in ('X', 'y'):
+            np.save(os.path.join(temp_dir, '{}_{}.npy'.format(key, split)), split_dict[key])
+    _write_json(os.path.join(temp_dir, 'split.json'), config)
+
+    # swap in the complete split, replacing any outdated one
+    if os.path.isdir(split_dir):
+        shutil.rmtree(split_dir, ignore_errors=True)
+    try:
+        os.rename(temp_dir, split_dir)
+    except OSError:  # another process cached the split first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return _read_split_data(split_dir, config)
+
+
+def get_split_data(file_name, test_size=.1, seed=None):
+    """Load the train and test sets of an NPZ file, splitting it only once.
+    On the first call, the split arrays are saved as .npy files in a
+    directory next to file_name.  Later calls memory-map these files, without
+    decompressing or splitting the NPZ file again.
+    # Arguments
+        file_name: path to NPZ file to load
+        test_size: percent of data to leave as testing holdout
+        seed: seed number for random train/test split repeatability
+    # Returns
+        dict of training data, and a dict of testing data:
+        train_dict, test_dict
+    """
+    config = _get_split_config(file_name, test_size, seed)
+    return _cache_split_data(file_name, config)
+
+
+def _get_keras_dataset_path(fname, cache_dir=None):
+    """Path where get_file caches fname, in ~/.keras/datasets by default"""
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.keras')
+        if not os.access(cache_dir, os.W_OK):
+            cache_dir = os.path.join('/tmp', '.keras')
+    return os.path.join(cache_dir, 'datasets', fname)
+
+
+def load_dataset(fname, origin, file_hash=None, test_size=.1, seed=None, cache_dir=None):
+    """Load the train and test sets of a builtin dataset.
+    The dataset is downloaded into ~/.keras/datasets once, or copied from
+    settings.DATASETS_MIRROR_DIR if it holds a file with the name of the
+    last component of origin (e.g. HeLa_S3.npz).
+    The split is cached as .npy files next to the NPZ file and memory-mapped,
+    so later calls skip the download, hash check and decompression.
+    The cached split records origin and file_hash, so it is only reused
+    for the same dataset.
+    # Arguments
+        fname: name of the NPZ file in ~/.keras/datasets
+        origin: URL of the NPZ file
+        file_hash: expected hash of the NPZ file
+        test_size: percent of data to leave as testing holdout
+        seed: seed number for random train/test split repeatability
+        cache_dir: directory of the datasets directory, ~/.keras by default
+    # Returns
+        dict of training data, and a dict of testing data:
+        train_dict, test_dict
+    """
+    path = _get_keras_dataset_path(fname, cache_dir)
+    if os.path.isfile(path):
+        # the file hash was already checked when the split was cached
+        config = _get_split_config(path, test_size, seed, origin, file_hash)
+        split_data = _read_split_data(_get_split_dir(path), config)
+        if split_data is not None:
+            return split_data
+
+    download_origin = origin
+    if settings.DATASETS_MIRROR_DIR:
+        mirror_path = os.path.join(settings.DATASETS_MIRROR_DIR, os.path.basename(origin))
+        if os.path.isfile(mirror_path):
+            download_origin = 'file://' + pathname2url(os.path.abspath(mirror_path))
+
+    path = get_file(fname, origin=download_origin, file_hash=file_hash, cache_dir=cache_dir)
+    config = _get_split_config(path, test_size, seed, origin, file_hash)
+    return _cache_split_data(path, config)
+
+
+def read_dataset_index(shard_dir):
+    """Read the index of a sharded dataset directory
+    # Arguments
+        shard_dir: directory created by shard_dataset
+    # Returns
+        dict of the dataset index, or None if shard_dir is not a sharded dataset
+    """
+    index_path = os.path.join(shard_dir, 'index.json')
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    """Atomically write data to a JSON file, so an interrupted write
+    never leaves a corrupt file behind."""
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def shard_dataset(file_name, shard_dir, num_shards, seed=None, chunk_bytes=2 ** 28):
+    """Split a dataset into num_shards shards of X and y .npy files, plus
+    an index.json of the sample counts and shapes of every shard.  Shards
+    are written one chunk of samples at a time, so datasets larger than
+    memory can be sharded.
+    # Arguments
+        file_name: path to an NPZ file or a dataset directory with X.npy and
+                   y.npy (e.g. from make_training_data_streaming)
+        shard_dir: directory where the shards and index.json are saved
+        num_shards: number of shards
+        seed: if not None, samples are shuffled with this seed before being
+              split, so every shard is a random sample of the dataset
+        chunk_bytes: approximate number of bytes of X copied at a time
+    # Returns
+        dict of the dataset index
+    """
+    num_shards = int(num_shards)
+    dataset_dir = get_dataset_npy_dir(file_name)
+    X = np.load(os.path.join(dataset_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(dataset_dir, 'y.npy'), mmap_mode='r')
+    if len(X) != len(y):
+        raise ValueError('X and y have different numbers of samples: '
+                         '{} and {}'.format(len(X), len(y)))
+    if not 0 < num_shards <= len(X):
+        raise ValueError('num_shards must be between 1 and the number of '
+                         'samples ({}), got {}'.format(len(X), num_shards))
+
+    indices = np.arange(len(X))
+    if seed is not None:
+        indices = np.random.RandomState(seed).permutation(indices)
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    sample_bytes = max(1, X[0].nbytes)
+    chunk_size = max(1, int(chunk_bytes // sample_bytes))
+
+    shards, start = [], 0
+    for shard_num, shard_idx in enumerate(np.array_split(indices, num_shards)):
+        shard = {'start': start, 'num_samples': len(shard_idx)}
+        for key, arr in (('X', X), ('y', y)):
+            shard[key] = '{}-{:05d}.npy'.format(key, shard_num)
+            out = np.lib.format.open_memmap(
+                os.path.join(shard_dir, shard[key]), mode='w+',
+                dtype=arr.dtype, shape=(len(shard_idx),) + arr.shape[1:])
+            for i in range(0, len(shard_idx), chunk_size):
+                # sorted reads are sequential in the source memmap
+                chunk_idx = shard_idx[i:i + chunk_size]
+                order = np.argsort(chunk_idx)
+                out[i + order] = arr[chunk_idx[order]]
+            out.flush()
+            del out
+        shards.append(shard)
+        start += len(shard_idx)
+
+    index = {
+        'num_samples': len(X),
+        'num_shards': num_shards,
+        'seed': seed,
+        'shards': shards,
+        'X': {'sample_shape': list(X.shape[1:]), 'dtype': str(X.dtype)},
+        'y': {'sample_shape': list(y.shape[1:]), 'dtype': str(y.dtype)},
+    }
+    # the index is written last and marks the sharded dataset as complete
+    _write_json(os.path.join(shard_dir, 'index.json'), index)
+    return index
+
+
+def get_worker_shards(index, rank=0, num_workers=1):
+    """Get the shards of a sharded dataset assigned to a worker.
+    Shards are assigned round-robin, so worker rank gets the shards
+    rank, rank + num_workers, rank + 2 * num_workers, ...
+    # Arguments
+        index: dict of the dataset index, from read_dataset_index
+        rank: rank of the worker, from 0 to num_workers - 1
+        num_workers: total number of workers
+    # Returns
+        list of the shards of the worker
+    """
+    num_workers = int(num_workers)
+    if num_workers < 1 or not 0 <= rank < num_workers:
+        raise ValueError('rank must be between 0 and num_workers - 1 ({}), '
+                         'got {}'.format(num_workers - 1, rank))
+    if index['num_shards'] < num_workers:
+        raise ValueError('Dataset has {} shards, which cannot be split between '
+                         '{} workers'.format(index['num_shards'], num_workers))
+    return index['shards'][rank::num_workers]
+
+
+def get_shard_data(shard_dir, rank=0, num_workers=1, test_size=.1, seed=None):
+    """Load the shards of a sharded dataset assigned to a worker and split
+    them into train and test sets.  Only the worker's shards are
+    memory-mapped, so startup time does not grow with the dataset size.
+    # Arguments
+        shard_dir: directory created by shard_dataset
+        rank: rank of the worker, from 0 to num_workers - 1
+        num_workers: total number of workers, e.g. data-parallel processes
+        test_size: percent of data to leave as testing holdout
+        seed: seed number for random train/test split repeatability
+    # Returns
+        dict of training data, and a dict of testing data:
+        train_dict, test_dict
+    """
+    index = read_dataset_index(shard_dir)
+    if index is None:
+        raise FileNotFoundError('{} is not a sharded dataset, '
+                                'index.json not found'.format(shard_dir))
+
+    shards = get_worker_shards(index, rank=rank, num_workers=num_workers)
+    data = {}
+    for key in ('X', 'y'):
+        arrays = [np.load(os.path.join(shard_dir, shard[key]), mmap_mode='r')
+                  for shard in shards]
+        data[key] = arrays[0] if len(arrays) == 1 else ConcatenatedArray(arrays)
+
+    train_idx, test_idx = train_test_split(
+        np.arange(len(data['X'])), test_size=test_size, random_state=seed)
+
+    train_dict = {
+        'X': IndexedArray(data['X'], train_idx),
+        'y': IndexedArray(data['y'], train_idx)
+    }
+
+    test_dict = {
+        'X': IndexedArray(data['X'], test_idx),
+        'y': IndexedArray(data['y'], test_idx)
+    }
+
+    return train_dict, test_dict
+
+
 def get_max_sample_num_list(y, edge_feature, output_mode='sample', padding='valid',
                             window_size_x=30, window_size_y=30):
     """For each set of images and each feature, find the maximum number
@@ -116,65 +638,80 @@ def get_max_sample_num_list(y, edge_feature, output_mode='sample', padding='vali
     return list_of_max_sample_numbers
 
 
-def sample_label_matrix(y, window_size=(30, 30), padding='valid',
-                        max_training_examples=1e7, data_format=None):
-    """Create a list of the maximum pixels to sample
-    from each feature in each data set.
+def _get_index_dtype(size):
+    """Smallest of int16 and int32 that can index an axis of the given size,
+    leaving headroom for window arithmetic on the sampled coordinates"""
+    return np.dtype('int16') if size <= np.iinfo('int16').max // 2 else np.dtype('int32')
+
+
+def _sample_label_pixels(y, windows, padding='valid',
+                         max_training_examples=1e7, data_format=None):
+    """Vectorized sampling of the labeled pixels of every feature of y.
+    Candidate pixels are found with one boolean bound mask per image and are
+    shuffled with a single random permutation.
+    # Arguments
+        y: one-hot label array of ndim 4 (images) or 5 (movies)
+        windows: half window size along each spatial axis of y
+        padding: 'valid' only samples pixels whose window fits in the image,
+                 'same' samples every pixel
+        max_training_examples: maximum number of pixels to sample,
+                               if falsy all pixels are sampled
+        data_format: 'channels_first' or 'channels_last'
+    # Returns
+        the coordinates of the sampled pixels along each spatial axis,
+        followed by their batch index and feature label
     """
-    data_format = conv_utils.normalize_data_format(data_format)
     is_channels_first = data_format == 'channels_first'
-    if is_channels_first:
-        num_dirs, num_features, image_size_x, image_size_y = y.shape
-    else:
-        num_dirs, image_size_x, image_size_y, num_features = y.shape
+    spatial_shape = y.shape[2:] if is_channels_first else y.shape[1:-1]
+    num_features = y.shape[1] if is_channels_first else y.shape[-1]
 
-    window_size = conv_utils.normalize_tuple(window_size, 2, 'window_size')
-    window_size_x, window_size_y = window_size
+    # mask of the pixels whose window fits in the image, for every feature
+    bounds = None
+    if padding == 'valid':
+        bounds = np.zeros(spatial_shape, dtype='bool')
+        bounds[tuple(slice(w + 1, s - w) for w, s in zip(windows, spatial_shape))] = True
+        bounds = bounds[None] if is_channels_first else bounds[..., None]
+
+    dtypes = [_get_index_dtype(s) for s in spatial_shape]
+    label_dtype = _get_index_dtype(num_features)
+    coords, counts = [], []
+    for b in range(len(y)):
+        mask = np.asarray(y[b]) == 1
+        if bounds is not None:
+            mask &= bounds
+        found = np.nonzero(mask)
+        if is_channels_first:
+            found = found[1:] + found[:1]
+        coords.append([f.astype(d) for f, d in zip(found, dtypes + [label_dtype])])
+        counts.append(len(found[0]))
 
-    feature_rows, feature_cols, feature_batch, feature_label = [], [], [], []
+    total = sum(counts)
+    limit = total if not max_training_examples else min(total, int(max_training_examples))
+    rand_ind = np.arange(total, dtype='int32' if total < 2 ** 31 else 'int64')
+    np.random.shuffle(rand_ind)
+    rand_ind = rand_ind[:limit]
 
-    for direc in range(num_dirs):
-        for k in range(num_features):
-            if is_channels_first:
-                feature_rows_temp, feature_cols_temp = np.where(y[direc, k, :, :] == 1)
-            else:
-                feature_rows_temp, feature_cols_temp = np.where(y[direc, :, :, k] == 1)
+    sampled = [np.concatenate([c[i] for c in coords])[rand_ind]
+               for i in range(len(spatial_shape) + 1)]
+    batch_dtype = np.dtype('int32') if len(y) > np.iinfo('int16').max else np.dtype('int16')
+    batch = np.repeat(np.arange(len(y), dtype=batch_dtype), counts)[rand_ind]
+    return sampled[:-1] + [batch, sampled[-1]]
 
-            # Check to make sure the features are actually present
-            if not feature_rows_temp.size > 0:
-                continue
 
-            # Randomly permute index vector
-            non_rand_ind = np.arange(len(feature_rows_temp))
-            rand_ind = np.random.choice(non_rand_ind, size=len(feature_rows_temp), replace=False)
-
-            for i in rand_ind:
-                condition = padding == 'valid' and \
-                    feature_rows_temp[i] - window_size_x > 0 and \
-                    feature_rows_temp[i] + window_size_x < image_size_x and \
-                    feature_cols_temp[i] - window_size_y > 0 and \
-                    feature_cols_temp[i] + window_size_y < image_size_y
-
-                if padding == 'same' or condition:
-                    feature_rows.append(feature_rows_temp[i])
-                    feature_cols.append(feature_cols_temp[i])
-                    feature_batch.append(direc)
-                    feature_label.append(k)
-
-    # Randomize
-    non_rand_ind = np.arange(len(feature_rows), dtype='int32')
-    if not max_training_examples:
-        max_training_examples = non_rand_ind.size
-    else:
-        max_training_examples = int(max_training_examples)
-
-    limit = min(non_rand_ind.size, max_training_examples)
-    rand_ind = np.random.choice(non_rand_ind, size=limit, replace=False)
+def sample_label_matrix(y, window_size=(30, 30), padding='valid',
+                        max_training_examples=1e7, data_format=None):
+    """Create a list of the maximum pixels to sample
+    from each feature in each data set.
+    Returns compact (int16 or int32) arrays of the rows, columns,
+    batch indices and feature labels of the sampled pixels.
+    """
+    data_format = conv_utils.normalize_data_format(data_format)
+    window_size = conv_utils.normalize_tuple(window_size, 2, 'window_size')
 
-    feature_rows = np.array(feature_rows, dtype='int32')[rand_ind]
-    feature_cols = np.array(feature_cols, dtype='int32')[rand_ind]
-    feature_batch = np.array(feature_batch, dtype='int32')[rand_ind]
-    feature_label = np.array(feature_label, dtype='int32')[rand_ind]
+    feature_rows, feature_cols, feature_batch, feature_label = _sample_label_pixels(
+        y, window_size, padding=padding,
+        max_training_examples=max_training_examples,
+        data_format=data_format)
 
     return feature_rows, feature_cols, feature_batch, feature_label
 
@@ -184,65 +721,18 @@ def sample_label_movie(y, window_size=(30, 30, 5), padding='valid',
     """Create a list of the maximum pixels to sample from each feature in each
     data set. If output_mode is 'sample', then this will be set to the number
     of edge pixels. If not, it will be set to np.Inf, i.e. sampling everything.
+    Returns compact (int16 or int32) arrays of the frames, rows, columns,
+    batch indices and feature labels of the sampled pixels.
     """
     data_format = conv_utils.normalize_data_format(data_format)
-    is_channels_first = data_format == 'channels_first'
-    if is_channels_first:
-        num_dirs, num_features, image_size_z, image_size_x, image_size_y = y.shape
-    else:
-        num_dirs, image_size_z, image_size_x, image_size_y, num_features = y.shape
-
     window_size = conv_utils.normalize_tuple(window_size, 3, 'window_size')
     window_size_x, window_size_y, window_size_z = window_size
 
-    feature_rows, feature_cols, feature_frames, feature_batch, feature_label = [], [], [], [], []
-
-    for d in range(num_dirs):
-        for k in range(num_features):
-            if is_channels_first:
-                frames_temp, rows_temp, cols_temp = np.where(y[d, k, :, :, :] == 1)
-            else:
-                frames_temp, rows_temp, cols_temp = np.where(y[d, :, :, :, k] == 1)
-
-            # Check to make sure the features are actually present
-            if not rows_temp.size > 0:
-                continue
-
-            # Randomly permute index vector
-            non_rand_ind = np.arange(len(rows_temp))
-            rand_ind = np.random.choice(non_rand_ind, size=len(rows_temp), replace=False)
-
-            for i in rand_ind:
-                condition = padding == 'valid' and \
-                    frames_temp[i] - window_size_z > 0 and \
-                    frames_temp[i] + window_size_z < image_size_z and \
-                    rows_temp[i] - window_size_x > 0 and \
-                    rows_temp[i] + window_size_x < image_size_x and \
-                    cols_temp[i] - window_size_y > 0 and \
-                    cols_temp[i] + window_size_y < image_size_y
-
-                if padding == 'same' or condition:
-                    feature_rows.append(rows_temp[i])
-                    feature_cols.append(cols_temp[i])
-                    feature_frames.append(frames_temp[i])
-                    feature_batch.append(d)
-                    feature_label.append(k)
-
-    # Randomize
-    non_rand_ind = np.arange(len(feature_rows), dtype='int32')
-    if not max_training_examples:
-        max_training_examples = non_rand_ind.size
-    else:
-        max_training_examples = int(max_training_examples)
-
-    limit = min(non_rand_ind.size, max_training_examples)
-    rand_ind = np.random.choice(non_rand_ind, size=limit, replace=False)
-
-    feature_frames = np.array(feature_frames, dtype='int32')[rand_ind]
-    feature_rows = np.array(feature_rows, dtype='int32')[rand_ind]
-    feature_cols = np.array(feature_cols, dtype='int32')[rand_ind]
-    feature_batch = np.array(feature_batch, dtype='int32')[rand_ind]
-    feature_label = np.array(feature_label, dtype='int32')[rand_ind]
+    feature_frames, feature_rows, feature_cols, feature_batch, feature_label = \
+        _sample_label_pixels(
+            y, (window_size_z, window_size_x, window_size_y), padding=padding,
+            max_training_examples=max_training_examples,
+            data_format=data_format)
 
     return feature_frames, feature_rows, feature_cols, feature_batch, feature_label
 
@@ -282,131 +772,326 @@ def trim_padding(nparr, win_x, win_y, win_z=None):
     return trimmed
 
 
-def reshape_matrix(X, y, reshape_size=256):
+def _get_tile_starts(length, reshape_size, rep_number):
+    """Get the start of each of rep_number tiles along an axis.  Tiles are
+    spaced by reshape_size, and the final tile is aligned to the end."""
+    starts = np.arange(rep_number) * reshape_size
+    starts[-1] = length - reshape_size
+    return starts
+
+
+class TiledArray(object):
+    """Array-like view of the overlapping square tiles of a batch of images
+    (ndim 4) or movies (ndim 5), as made by reshape_matrix and reshape_movie.
+    The tile origins are computed once, and tiles are copied from views of
+    the underlying array only when they are indexed or materialized.
+    # Arguments
+        array: numpy array or memmap of images or movies
+        reshape_size: size of the tiles
+        dtype: dtype of the gathered tiles.  If None, the dtype of array.
+        tile_fn: optional function applied to every batch of gathered tiles,
+                 returning the (possibly modified in place) tiles
+        data_format: 'channels_first' or 'channels_last'
+    """
+
+    def __init__(self, array, reshape_size, dtype=None, tile_fn=None, data_format=None):
+        if data_format is None:
+            data_format = K.image_data_format()
+
+        self.array = array
+        self.reshape_size = reshape_size
+        self.dtype = np.dtype(array.dtype if dtype is None else dtype)
+        self.tile_fn = tile_fn
+
+        self.row_axis = array.ndim - (2 if data_format == 'channels_first' else 3)
+        self.col_axis = self.row_axis + 1
+        rows, cols = array.shape[self.row_axis], array.shape[self.col_axis]
+        if reshape_size > rows or reshape_size > cols:
+            raise ValueError('reshape_size {} is larger than the image size {}'.format(
+                reshape_size, (rows, cols)))
+
+        # the number of tiles along both axes is set by the number of rows
+        self.rep_number = int(np.ceil(float(rows) / float(reshape_size)))
+        self.row_starts = _get_tile_starts(rows, reshape_size, self.rep_number)
+        self.col_starts = _get_tile_starts(cols, reshape_size, self.rep_number)
+        self.tiles_per_image = self.rep_number ** 2
+
+    @property
+    def shape(self):
+        shape = list(self.array.shape)
+        shape[0] *= self.tiles_per_image
+        shape[self.row_axis] = shape[self.col_axis] = self.reshape_size
+        return tuple(shape)
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _gather(self, indices, out=None):
+        """Copy the tiles of each index into out, through views of the array"""
+        indices = np.asarray(indices, dtype='int64')
+        if out is None:
+            out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+
+        batches, tiles = np.divmod(indices, self.tiles_per_image)
+        row_starts = self.row_starts[tiles // self.rep_number]
+        col_starts = self.col_starts[tiles % self.rep_number]
+
+        index = [slice(None)] * self.array.ndim
+        for i, (b, row, col) in enumerate(zip(batches, row_starts, col_starts)):
+            index[0] = b
+            index[self.row_axis] = slice(row, row + self.reshape_size)
+            index[self.col_axis] = slice(col, col + self.reshape_size)
+            out[i] = self.array[tuple(index)]
+
+        if self.tile_fn is not None:
+            tiles = self.tile_fn(out)
+            if tiles is not out:
+                out[...] = tiles
+        return out
+
+    def __getitem__(self, key):
+        key, rest = _split_sample_key(key, self.ndim)
+        if rest:
+            tiles = self[key]
+            if isinstance(key, (int, np.integer)):
+                return tiles[rest]
+            return tiles[(slice(None),) + rest]
+
+        if isinstance(key, (int, np.integer)):
+            if not -len(self) <= key < len(self):
+                raise IndexError('index {} is out of bounds for {} tiles'.format(key, len(self)))
+            return self._gather([key % len(self)])[0]
+
+        return self._gather(np.arange(len(self))[key])
+
+    def __array__(self, dtype=None, copy=None):
+        # gathers every tile into memory
+        array = self.materialize()
+        return array if dtype is None else array.astype(dtype)
+
+    def materialize(self, out=None):
+        """Gather every tile, one source image at a time.
+        # Arguments
+            out: optional array (e.g. a memmap) of the same shape to write into
+        # Returns
+            out: array of all tiles
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        elif tuple(out.shape) != self.shape:
+            raise ValueError('Expected output of shape {}, got {}'.format(
+                self.shape, out.shape))
+
+        for start in range(0, len(self), self.tiles_per_image):
+            stop = start + self.tiles_per_image
+            self._gather(np.arange(start, stop), out=out[start:stop])
+        return out
+
+
+def reshape_matrix(X, y, reshape_size=256, lazy=False, X_out=None, y_out=None):
     """
     Reshape matrix of dimension 4 to have x and y of size reshape_size.
     Adds overlapping slices to batches.
     E.g. reshape_size of 256 yields (1, 1024, 1024, 1) -> (16, 256, 256, 1)
+    # Arguments
+        X: images of ndim 4
+        y: masks of ndim 4
+        reshape_size: size of the square tiles
+        lazy: if True, return TiledArray views that gather tiles on demand
+        X_out: optional array (e.g. a memmap) to write the tiles of X into
+        y_out: optional array (e.g. a memmap) to write the tiles of y into
+    # Returns
+        new_X, new_y: the tiles of X and y
     """
-    is_channels_first = K.image_data_format() == 'channels_first'
     if X.ndim != 4:
         raise ValueError('reshape_matrix expects X dim to be 4, got', X.ndim)
     elif y.ndim != 4:
         raise ValueError('reshape_matrix expects y dim to be 4, got', y.ndim)
 
-    image_size_x, _ = X.shape[2:] if is_channels_first else X.shape[1:3]
-    rep_number = np.int(np.ceil(np.float(image_size_x) / np.float(reshape_size)))
-    new_batch_size = X.shape[0] * (rep_number) ** 2
-
-    if is_channels_first:
-        new_X_shape = (new_batch_size, X.shape[1], reshape_size, reshape_size)
-        new_y_shape = (new_batch_size, y.shape[1], reshape_size, reshape_size)
-    else:
-        new_X_shape = (new_batch_size, reshape_size, reshape_size, X.shape[3])
-        new_y_shape = (new_batch_size, reshape_size, reshape_size, y.shape[3])
-
-    new_X = np.zeros(new_X_shape, dtype=K.floatx())
-    new_y = np.zeros(new_y_shape, dtype='int32')
-
-    counter = 0
-    for b in range(X.shape[0]):
-        for i in range(rep_number):
-            for j in range(rep_number):
-                if i != rep_number - 1:
-                    x_start, x_end = i * reshape_size, (i + 1) * reshape_size
-                else:
-                    x_start, x_end = -reshape_size, X.shape[2 if is_channels_first else 1]
-
-                if j != rep_number - 1:
-                    y_start, y_end = j * reshape_size, (j + 1) * reshape_size
-                else:
-                    y_start, y_end = -reshape_size, y.shape[3 if is_channels_first else 2]
-
-                if is_channels_first:
-                    new_X[counter] = X[b, :, x_start:x_end, y_start:y_end]
-                    new_y[counter] = y[b, :, x_start:x_end, y_start:y_end]
-                else:
-                    new_X[counter] = X[b, x_start:x_end, y_start:y_end, :]
-                    new_y[counter] = y[b, x_start:x_end, y_start:y_end, :]
-
-                counter += 1
+    new_X = TiledArray(X, reshape_size, dtype=K.floatx())
+    new_y = TiledArray(y, reshape_size, dtype=_get_label_dtype(y))
+    if not lazy:
+        new_X = new_X.materialize(out=X_out)
+        new_y = new_y.materialize(out=y_out)
 
     print('Reshaped feature data from {} to {}'.format(y.shape, new_y.shape))
     print('Reshaped training data from {} to {}'.format(X.shape, new_X.shape))
     return new_X, new_y
 
 
+def _rank_labels(labels):
+    """Get the rank of every value of labels among its sorted unique values.
+    Integer labels spanning a compact range are ranked in O(N) with a lookup
+    table, any other labels are ranked by sorting with np.unique."""
+    labels = np.ravel(labels)
+    if labels.size and labels.dtype.kind in {'i', 'u', 'b'}:
+        low = int(labels.min())
+        span = int(labels.max()) - low + 1
+        if span <= max(labels.size, 2 ** 16):
+            offsets = labels.astype('int64') - low
+            ranks = np.cumsum(np.bincount(offsets, minlength=span) > 0) - 1
+            return ranks[offsets]
+    return np.unique(labels, return_inverse=True)[1].ravel()
+
+
+def _get_label_dtype(y):
+    """Integer labels keep their dtype, any other labels become int32"""
+    return y.dtype if y.dtype.kind in {'i', 'u'} else np.dtype('int32')
+
+
+def _get_compact_label_dtype(max_label):
+    """Smallest unsigned integer dtype that holds labels up to max_label"""
+    for dtype in ('uint8', 'uint16', 'uint32'):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
+
+
+def compact_labels(y):
+    """Cast instance labels to the smallest unsigned integer dtype that
+    holds them, e.g. uint8 for up to 255 instances.
+    Labels that are not non-negative integers are returned unchanged.
+    # Arguments
+        y: array of labels
+    # Returns
+        the labels in their compact dtype
+    """
+    y = np.asarray(y)
+    if not y.size or y.dtype.kind not in {'i', 'u', 'b'} or y.min() < 0:
+        return y
+    dtype = _get_compact_label_dtype(int(y.max()))
+    return y if dtype == y.dtype else y.astype(dtype)
+
+
+def _get_annotation_dtype(files):
+    """Get the dtype to load label images into: the unsigned integer dtype
+    of the files (read from their headers), or int32 for any other files."""
+    if not files:
+        return np.dtype('uint8')
+    dtype = np.result_type(*[get_image_dtype(f) for f in files])
+    return dtype if dtype.kind == 'u' else np.dtype('int32')
+
+
 def relabel_movie(y):
-    """Relabels unique instance IDs to be from 1 to N"""
-    new_y = np.zeros(y.shape)
-    unique_cells = np.unique(y)  # get all unique values of y
-    unique_cells = np.delete(unique_cells, 0)  # remove 0, as it is background
-    relabel_ids = np.arange(1, len(unique_cells) + 1)
-    for cell_id, relabel_id in zip(unique_cells, relabel_ids):
-        cell_loc = np.where(y == cell_id)
-        new_y[cell_loc] = relabel_id
-    return new_y
+    """Relabels unique instance IDs to be from 1 to N.
+    The smallest value (the background, 0) is relabeled to 0.
+    Integer labels keep their dtype, any other labels are returned as int32."""
+    y = np.asarray(y)
+    return _rank_labels(y).reshape(y.shape).astype(_get_label_dtype(y))
 
 
-def reshape_movie(X, y, reshape_size=256):
+def relabel_movies(y):
+    """Relabels the unique instance IDs of every movie in a batch to be from
+    1 to N, in a single pass over the whole batch.
+    Equivalent to np.stack([relabel_movie(movie) for movie in y]).
+    # Arguments
+        y: batch of label movies or images, e.g. the tiles of reshape_movie
+    # Returns
+        the relabeled batch, of the same shape
+    """
+    y = np.asarray(y)
+    dtype = _get_label_dtype(y)
+    if not y.size or y.dtype.kind not in {'i', 'u', 'b'}:
+        return np.array([relabel_movie(movie) for movie in y], dtype=dtype).reshape(y.shape)
+
+    # offset the labels of each movie so they are unique across the batch
+    flat = y.reshape(len(y), -1).astype('int64')
+    low = flat.min()
+    span = flat.max() - low + 1
+    keys = flat - low + np.arange(len(y), dtype='int64')[:, None] * span
+
+    # rank all labels at once, then rank each movie from its own background
+    ranks = _rank_labels(keys).reshape(flat.shape)
+    ranks -= ranks.min(axis=1, keepdims=True)
+    return ranks.reshape(y.shape).astype(dtype)
+
+
+def reshape_movie(X, y, reshape_size=256, lazy=False, X_out=None, y_out=None):
     """
     Reshape tensor of dimension 5 to have x and y of size reshape_size.
     Adds overlapping slices to batches.
     E.g. reshape_size of 256 yields (1, 5, 1024, 1024, 1) -> (16, 5, 256, 256, 1)
+    The instance IDs of each tile of y are relabeled from 1 to N.
+    # Arguments
+        X: movies of ndim 5
+        y: masks of ndim 5
+        reshape_size: size of the square tiles
+        lazy: if True, return TiledArray views that gather tiles on demand
+        X_out: optional array (e.g. a memmap) to write the tiles of X into
+        y_out: optional array (e.g. a memmap) to write the tiles of y into
+    # Returns
+        new_X, new_y: the tiles of X and y
     """
-    is_channels_first = K.image_data_format() == 'channels_first'
     if X.ndim != 5:
         raise ValueError('reshape_movie expects X dim to be 5, got {}'.format(X.ndim))
     elif y.ndim != 5:
         raise ValueError('reshape_movie expects y dim to be 5, got {}'.format(y.ndim))
-    image_size_x, image_size_y = X.shape[3:] if is_channels_first else X.shape[2:4]
-    rep_number = np.int(np.ceil(np.float(image_size_x) / np.float(reshape_size)))
-    new_batch_size = X.shape[0] * (rep_number) ** 2
 
-    if is_channels_first:
-        new_X_shape = (new_batch_size, X.shape[1], X.shape[2], reshape_size, reshape_size)
-        new_y_shape = (new_batch_size, y.shape[1], y.shape[2], reshape_size, reshape_size)
-    else:
-        new_X_shape = (new_batch_size, X.shape[1], reshape_size, reshape_size, X.shape[4])
-        new_y_shape = (new_batch_size, y.shape[1], reshape_size, reshape_size, y.shape[4])
-
-    new_X = np.zeros(new_X_shape, dtype=K.floatx())
-    new_y = np.zeros(new_y_shape, dtype='int32')
-
-    counter = 0
-    row_axis = 3 if is_channels_first else 2
-    col_axis = 4 if is_channels_first else 3
-    for b in range(X.shape[0]):
-        for i in range(rep_number):
-            for j in range(rep_number):
-                if i != rep_number - 1:
-                    x_start, x_end = i * reshape_size, (i + 1) * reshape_size
-                else:
-                    x_start, x_end = -reshape_size, X.shape[row_axis]
-                if j != rep_number - 1:
-                    y_start, y_end = j * reshape_size, (j + 1) * reshape_size
-                else:
-                    y_start, y_end = -reshape_size, y.shape[col_axis]
-
-                if is_channels_first:
-                    new_X[counter] = X[b, :, :, x_start:x_end, y_start:y_end]
-                    new_y[counter] = relabel_movie(y[b, :, :, x_start:x_end, y_start:y_end])
-                else:
-                    new_X[counter] = X[b, :, x_start:x_end, y_start:y_end, :]
-                    new_y[counter] = relabel_movie(y[b, :, x_start:x_end, y_start:y_end, :])
-
-                counter += 1
+    new_X = TiledArray(X, reshape_size, dtype=K.floatx())
+    new_y = TiledArray(y, reshape_size, dtype=_get_label_dtype(y), tile_fn=relabel_movies)
+    if not lazy:
+        new_X = new_X.materialize(out=X_out)
+        new_y = new_y.materialize(out=y_out)
 
     print('Reshaped feature data from {} to {}'.format(y.shape, new_y.shape))
     print('Reshaped training data from {} to {}'.format(X.shape, new_X.shape))
     return new_X, new_y
 
 
+def load_images_into(arr, jobs, num_workers=None, region=None):
+    """Decode image files concurrently, straight into a preallocated array.
+    # Arguments
+        arr: numpy array to fill with the decoded images
+        jobs: list of (index, file path) tuples, arr[index] is set to the image.
+              A job of (index, file path, (start, stop)) reads the pages
+              start to stop of a multi-page stack into arr[index].
+        num_workers: number of threads decoding images.  If 1, images are
+                     decoded sequentially.  If None, uses the
+                     ThreadPoolExecutor default.
+        region: optional ((row_start, row_stop), (col_start, col_stop)) window
+                of each image to load.  Only the window is decoded.
+    # Returns
+        arr: the filled numpy array
+    """
+    # each image is decoded once, straight into arr, so the image cache
+    # would only hold images that are never read again
+    def load_image(job):
+        index, image_file = job[:2]
+        if len(job) > 2:
+            window = (None, None) if region is None else region
+            get_image_stack(image_file, job[2], *window, out=arr[index], cache=False)
+        elif region is None:
+            arr[index] = get_image(image_file, native_dtype=True, cache=False)
+        else:
+            arr[index] = get_image_region(image_file, *region, native_dtype=True, cache=False)
+
+    if num_workers == 1:
+        for job in jobs:
+            load_image(job)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # consume the results to raise any decoding errors
+            list(executor.map(load_image, jobs))
+
+    return arr
+
+
 def load_training_images_2d(direc_name,
                             training_direcs,
                             raw_image_direc,
                             channel_names,
-                            image_size):
+                            image_size,
+                            num_workers=None,
+                            manifest=None,
+                            region=None):
     """Load each image in the training_direcs into a numpy array.
     # Arguments
         direc_name: directory containing folders of training data
@@ -414,6 +1099,10 @@ def load_training_images_2d(direc_name,
         raw_image_direc: directory name inside each training dir with raw images
         channel_names: Loads all raw images with a channel_name in the filename
         image_size: size of each image as tuple (x, y)
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+        region: optional ((row_start, row_stop), (col_start, col_stop))
+                window of each image to load, image_size is its size
     """
     is_channels_first = K.image_data_format() == 'channels_first'
     # Unpack size tuples
@@ -427,40 +1116,54 @@ def load_training_images_2d(direc_name,
 
     X = np.zeros(X_shape, dtype=K.floatx())
 
-    # Load training images
+    # Find the image of each channel in each training directory
+    jobs = []
     for b, direc in enumerate(training_direcs):
         # e.g. "/data/ecoli/kc", "set1", "RawImages",
-        imglist = os.listdir(os.path.join(direc_name, direc, raw_image_direc))
+        imglist = listdir(os.path.join(direc_name, direc, raw_image_direc), manifest=manifest)
 
         for c, channel in enumerate(channel_names):
-            for img in imglist:
-                # if channel string is NOT in image file name, skip it.
-                if not fnmatch(img, '*{}*'.format(channel)):
-                    continue
+            # if channel string is NOT in image file name, skip it.
+            # if several images match, the last one listed is loaded.
+            matches = [img for img in imglist if fnmatch(img, '*{}*'.format(channel))]
+            if not matches:
+                continue
+
+            image_file = os.path.join(direc_name, direc, raw_image_direc, matches[-1])
+            index = (b, c) if is_channels_first else (b, Ellipsis, c)
+            jobs.append((index, image_file))
 
-                image_file = os.path.join(direc_name, direc, raw_image_direc, img)
-                image_data = np.asarray(get_image(image_file), dtype=K.floatx())
+    # Load training images
+    return load_images_into(X, jobs, num_workers=num_workers, region=region)
 
-                if is_channels_first:
-                    X[b, c, :, :] = image_data
-                else:
-                    X[b, :, :, c] = image_data
 
-    return X
+def _get_annotation_file_2d(imglist, annotation):
+    """Get the filename in imglist loaded as the annotation mask: the last
+    one listed with annotation in its name, or None if there is none."""
+    matches = [img for img in imglist if fnmatch(img, '*{}*'.format(annotation))]
+    return matches[-1] if matches else None
 
 
 def load_annotated_images_2d(direc_name,
                              training_direcs,
                              annotation_direc,
                              annotation_name,
-                             image_size):
+                             image_size,
+                             num_workers=None,
+                             manifest=None,
+                             region=None):
     """Load each annotated image in the training_direcs into a numpy array.
+    Labels are returned in the smallest unsigned integer dtype that holds them.
     # Arguments
         direc_name: directory containing folders of training data
         training_direcs: list of directories of images inside direc_name.
         annotation_direc: directory name inside each training dir with masks
         annotation_name: Loads all masks with annotation_name in the filename
         image_size: size of each image as tuple (x, y)
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+        region: optional ((row_start, row_stop), (col_start, col_stop))
+                window of each image to load, image_size is its size
     """
     is_channels_first = K.image_data_format() == 'channels_first'
     # Unpack size tuple
@@ -476,25 +1179,23 @@ def load_annotated_images_2d(direc_name,
     else:
         y_shape = (len(training_direcs), image_size_x, image_size_y, len(annotation_name))
 
-    y = np.zeros(y_shape, dtype='int32')
-
+    jobs = []
     for b, direc in enumerate(training_direcs):
-        imglist = os.listdir(os.path.join(direc_name, direc, annotation_direc))
+        imglist = listdir(os.path.join(direc_name, direc, annotation_direc), manifest=manifest)
 
         for l, annotation in enumerate(annotation_name):
-            for img in imglist:
-                # if annotation_name is NOT in image file name, skip it.
-                if not fnmatch(img, '*{}*'.format(annotation)):
-                    continue
-
-                image_data = get_image(os.path.join(direc_name, direc, annotation_direc, img))
+            # if annotation_name is NOT in image file name, skip it.
+            match = _get_annotation_file_2d(imglist, annotation)
+            if match is None:
+                continue
 
-                if is_channels_first:
-                    y[b, l, :, :] = image_data
-                else:
-                    y[b, :, :, l] = image_data
+            image_file = os.path.join(direc_name, direc, annotation_direc, match)
+            index = (b, l) if is_channels_first else (b, Ellipsis, l)
+            jobs.append((index, image_file))
 
-    return y
+    y = np.zeros(y_shape, dtype=_get_annotation_dtype([job[1] for job in jobs]))
+    y = load_images_into(y, jobs, num_workers=num_workers, region=region)
+    return compact_labels(y)
 
 
 def make_training_data_2d(direc_name,
@@ -504,7 +1205,9 @@ def make_training_data_2d(direc_name,
                           annotation_direc='annotated',
                           annotation_name='feature',
                           training_direcs=None,
-                          reshape_size=None):
+                          reshape_size=None,
+                          num_workers=None,
+                          manifest=None):
     """
     Read all images in training directories and save as npz file
     # Arguments
@@ -517,20 +1220,27 @@ def make_training_data_2d(direc_name,
         channel_names: Loads all raw images with a channel_name in the filename
         annotation_name: Loads all masks with annotation_name in the filename
         reshape_size: If provided, will reshape the images to the given size
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+                  and read the image size
     """
     # Load one file to get image sizes (assumes all images same size)
     image_path = os.path.join(direc_name, random.choice(training_direcs), raw_image_direc)
-    image_size = get_image_sizes(image_path, channel_names)
+    image_size = get_image_sizes(image_path, channel_names, manifest=manifest)
 
     X = load_training_images_2d(direc_name, training_direcs,
                                 raw_image_direc=raw_image_direc,
                                 channel_names=channel_names,
-                                image_size=image_size)
+                                image_size=image_size,
+                                num_workers=num_workers,
+                                manifest=manifest)
 
     y = load_annotated_images_2d(direc_name, training_direcs,
                                  annotation_direc=annotation_direc,
                                  annotation_name=annotation_name,
-                                 image_size=image_size)
+                                 image_size=image_size,
+                                 num_workers=num_workers,
+                                 manifest=manifest)
 
     if reshape_size is not None:
         X, y = reshape_matrix(X, y, reshape_size=reshape_size)
@@ -539,14 +1249,54 @@ def make_training_data_2d(direc_name,
     np.savez(file_name_save, X=X, y=y)
 
 
+def _get_frame_jobs(direc, imglist, name, num_frames, index_fn):
+    """Get the (index, file path) of each frame of name in a directory,
+    skipping any frames past num_frames.  If name matches a single
+    multi-page TIFF stack, its frames are read by one
+    (index, file path, (start, stop)) job.
+    # Arguments
+        direc: directory containing the frames
+        imglist: list of all filenames in direc
+        name: loads all frames with name in the filename
+        num_frames: maximum number of frames to load
+        index_fn: function of the frame number (or a slice of frames),
+                  returns its array index
+    """
+    frames = filter_channel_files(imglist, name)
+    num_pages = 1
+    if len(frames) == 1:
+        num_pages = get_num_pages(os.path.join(direc, frames[0]))
+
+    total = num_pages if num_pages > 1 else len(frames)
+    if total > num_frames:
+        print('Skipped final {skip} frames of {dir}, as num_frames '
+              'is {num} but there are {total} total frames'.format(
+                  skip=total - num_frames,
+                  dir=direc,
+                  num=num_frames,
+                  total=total))
+
+    if num_pages > 1:
+        stop = min(num_pages, num_frames)
+        return [(index_fn(slice(0, stop)), os.path.join(direc, frames[0]), (0, stop))]
+
+    return [(index_fn(i), os.path.join(direc, img))
+            for i, img in enumerate(frames[:num_frames])]
+
+
 def load_training_images_3d(direc_name,
                             training_direcs,
                             raw_image_direc,
                             channel_names,
                             image_size,
                             num_frames,
-                            montage_mode=False):
+                            montage_mode=False,
+                            num_workers=None,
+                            manifest=None,
+                            region=None):
     """Load each image in the training_direcs into a numpy array.
+    Frames are one file per frame, or a single multi-page TIFF stack per
+    channel, whose pages are read directly and decoded in parallel.
     # Arguments
         direc_name: directory containing folders of training data
         training_direcs: list of directories of images inside direc_name.
@@ -555,6 +1305,10 @@ def load_training_images_3d(direc_name,
         image_size: size of each image as tuple (x, y)
         num_frames: number of frames to load from each training directory
         montage_mode: load masks from "montaged" subdirs inside annotation_direc
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+        region: optional ((row_start, row_stop), (col_start, col_stop))
+                window of each image to load, image_size is its size
     """
     is_channels_first = K.image_data_format() == 'channels_first'
     image_size_x, image_size_y = image_size
@@ -562,7 +1316,7 @@ def load_training_images_3d(direc_name,
     # flatten list of lists
     X_dirs = [os.path.join(direc_name, t, raw_image_direc) for t in training_direcs]
     if montage_mode:
-        X_dirs = [os.path.join(t, p) for t in X_dirs for p in os.listdir(t)]
+        X_dirs = [os.path.join(t, p) for t in X_dirs for p in listdir(t, manifest=manifest)]
         X_dirs = sorted_nicely(X_dirs)
 
     # Initialize training data array
@@ -573,31 +1327,20 @@ def load_training_images_3d(direc_name,
 
     X = np.zeros(X_shape, dtype=K.floatx())
 
-    # Load 3D training images
+    # Find each frame of each channel, listing every directory only once
+    jobs = []
     for b, direc in enumerate(X_dirs):
+        imglist = listdir(direc, manifest=manifest)
 
         for c, channel in enumerate(channel_names):
+            if is_channels_first:
+                index_fn = lambda i, b=b, c=c: (b, c, i)
+            else:
+                index_fn = lambda i, b=b, c=c: (b, i, Ellipsis, c)
+            jobs.extend(_get_frame_jobs(direc, imglist, channel, num_frames, index_fn))
 
-            imglist = nikon_getfiles(direc, channel)
-
-            for i, img in enumerate(imglist):
-                if i >= num_frames:
-                    print('Skipped final {skip} frames of {dir}, as num_frames '
-                          'is {num} but there are {total} total frames'.format(
-                              skip=len(imglist) - num_frames,
-                              dir=direc,
-                              num=num_frames,
-                              total=len(imglist)))
-                    break
-
-                image_data = np.asarray(get_image(os.path.join(direc, img)))
-
-                if is_channels_first:
-                    X[b, c, i, :, :] = image_data
-                else:
-                    X[b, i, :, :, c] = image_data
-
-    return X
+    # Load 3D training images
+    return load_images_into(X, jobs, num_workers=num_workers, region=region)
 
 
 def load_annotated_images_3d(direc_name,
@@ -606,8 +1349,14 @@ def load_annotated_images_3d(direc_name,
                              annotation_name,
                              image_size,
                              num_frames,
-                             montage_mode=False):
+                             montage_mode=False,
+                             num_workers=None,
+                             manifest=None,
+                             region=None):
     """Load each annotated image in the training_direcs into a numpy array.
+    Frames are one file per frame, or a single multi-page TIFF stack per
+    channel, whose pages are read directly and decoded in parallel.
+    Labels are returned in the smallest unsigned integer dtype that holds them.
     # Arguments
         direc_name: directory containing folders of training data
         training_direcs: list of directories of images inside direc_name.
@@ -616,6 +1365,10 @@ def load_annotated_images_3d(direc_name,
         image_size: size of each image as tuple (x, y)
         num_frames: number of frames to load from each training directory
         montage_mode: load masks from "montaged" subdirs inside annotation_direc
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+        region: optional ((row_start, row_stop), (col_start, col_stop))
+                window of each image to load, image_size is its size
     """
     is_channels_first = K.image_data_format() == 'channels_first'
     image_size_x, image_size_y = image_size
@@ -626,7 +1379,7 @@ def load_annotated_images_3d(direc_name,
 
     y_dirs = [os.path.join(direc_name, t, annotation_direc) for t in training_direcs]
     if montage_mode:
-        y_dirs = [os.path.join(t, p) for t in y_dirs for p in os.listdir(t)]
+        y_dirs = [os.path.join(t, p) for t in y_dirs for p in listdir(t, manifest=manifest)]
         y_dirs = sorted_nicely(y_dirs)
 
     if is_channels_first:
@@ -634,29 +1387,20 @@ def load_annotated_images_3d(direc_name,
     else:
         y_shape = (len(y_dirs), num_frames, image_size_x, image_size_y, len(annotation_name))
 
-    y = np.zeros(y_shape, dtype='int32')
-
+    jobs = []
     for b, direc in enumerate(y_dirs):
-        for c, name in enumerate(annotation_name):
-            imglist = nikon_getfiles(direc, name)
+        imglist = listdir(direc, manifest=manifest)
 
-            for z, img_file in enumerate(imglist):
-                if z >= num_frames:
-                    print('Skipped final {skip} frames of {dir}, as num_frames '
-                          'is {num} but there are {total} total frames'.format(
-                              skip=len(imglist) - num_frames,
-                              dir=direc,
-                              num=num_frames,
-                              total=len(imglist)))
-                    break
-
-                annotation_img = get_image(os.path.join(direc, img_file))
-                if is_channels_first:
-                    y[b, c, z, :, :] = annotation_img
-                else:
-                    y[b, z, :, :, c] = annotation_img
+        for c, name in enumerate(annotation_name):
+            if is_channels_first:
+                index_fn = lambda z, b=b, c=c: (b, c, z)
+            else:
+                index_fn = lambda z, b=b, c=c: (b, z, Ellipsis, c)
+            jobs.extend(_get_frame_jobs(direc, imglist, name, num_frames, index_fn))
 
-    return y
+    y = np.zeros(y_shape, dtype=_get_annotation_dtype([job[1] for job in jobs]))
+    y = load_images_into(y, jobs, num_workers=num_workers, region=region)
+    return compact_labels(y)
 
 
 def make_training_data_3d(direc_name,
@@ -668,7 +1412,9 @@ def make_training_data_3d(direc_name,
                           annotation_direc='annotated',
                           reshape_size=None,
                           num_frames=50,
-                          montage_mode=True):
+                          montage_mode=True,
+                          num_workers=None,
+                          manifest=None):
     """
     Read all images in training directories and save as npz file
     3D image sets are "stacks" of images. For annotation purposes, these images
@@ -687,27 +1433,35 @@ def make_training_data_3d(direc_name,
         reshape_size: If provided, will reshape the images to the given size.
         num_frames: number of frames to load from each training directory
         montage_mode: load masks from "montaged" subdirs inside annotation_direc
+        num_workers: number of threads decoding images
+        manifest: optional FileManifest used to list the directories
+                  and read the image size
     """
     # Load one file to get image sizes
     rand_train_dir = os.path.join(direc_name, random.choice(training_direcs), raw_image_direc)
     if montage_mode:
-        rand_train_dir = os.path.join(rand_train_dir, random.choice(os.listdir(rand_train_dir)))
+        rand_train_dir = os.path.join(rand_train_dir, random.choice(
+            listdir(rand_train_dir, manifest=manifest)))
 
-    image_size = get_image_sizes(rand_train_dir, channel_names)
+    image_size = get_image_sizes(rand_train_dir, channel_names, manifest=manifest)
 
     X = load_training_images_3d(direc_name, training_direcs,
                                 raw_image_direc=raw_image_direc,
                                 channel_names=channel_names,
                                 image_size=image_size,
                                 num_frames=num_frames,
-                                montage_mode=montage_mode)
+                                montage_mode=montage_mode,
+                                num_workers=num_workers,
+                                manifest=manifest)
 
     y = load_annotated_images_3d(direc_name, training_direcs,
                                  annotation_direc=annotation_direc,
                                  annotation_name=annotation_name,
                                  image_size=image_size,
                                  num_frames=num_frames,
-                                 montage_mode=montage_mode)
+                                 montage_mode=montage_mode,
+                                 num_workers=num_workers,
+                                 manifest=manifest)
 
     # Reshape X and y
     if reshape_size is not None:
@@ -727,10 +1481,14 @@ def make_training_data(direc_name,
                        annotation_direc='annotated',
                        annotation_name='feature',
                        reshape_size=None,
+                       num_workers=None,
+                       manifest=None,
                        **kwargs):
     """
     Wrapper function for other make_training_data functions (2d, 3d)
     Calls one of the above functions based on the dimensionality of the data
+    num_workers is the number of threads decoding images.
+    manifest is an optional FileManifest used to list the directories.
     """
     # Validate Arguments
     if not isinstance(dimensionality, int) and not isinstance(dimensionality, float):
@@ -752,7 +1510,9 @@ def make_training_data(direc_name,
                               reshape_size=reshape_size,
                               raw_image_direc=raw_image_direc,
                               annotation_name=annotation_name,
-                              annotation_direc=annotation_direc)
+                              annotation_direc=annotation_direc,
+                              num_workers=num_workers,
+                              manifest=manifest)
 
     elif dimensionality == 3:
         make_training_data_3d(direc_name, file_name_save, channel_names,
@@ -762,10 +1522,741 @@ def make_training_data(direc_name,
                               annotation_direc=annotation_direc,
                               reshape_size=reshape_size,
                               montage_mode=kwargs.get('montage_mode', False),
-                              num_frames=kwargs.get('num_frames', 50))
+                              num_frames=kwargs.get('num_frames', 50),
+                              num_workers=num_workers,
+                              manifest=manifest)
 
     else:
         raise NotImplementedError('make_training_data is not implemented for '
                                   'dimensionality {}'.format(dimensionality))
 
     return None
+
+
+def read_dataset_manifest(dataset_dir):
+    """Read the manifest of a dataset directory
+    # Arguments
+        dataset_dir: directory created by make_training_data_streaming
+    # Returns
+        dict of the dataset manifest, or None if there is no manifest
+    """
+    manifest_path = os.path.join(dataset_dir, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_dataset_manifest(dataset_dir, manifest):
+    """Atomically write the manifest of a dataset directory, so an
+    interrupted write never leaves a corrupt manifest behind.
+    # Arguments
+        dataset_dir: directory of the dataset
+        manifest: dict of the dataset manifest
+    """
+    _write_json(os.path.join(dataset_dir, 'manifest.json'), manifest)
+
+
+def _get_raw_image_dirs(direc_name, direc, raw_image_direc, dimensionality, montage_mode):
+    """Get the directories of raw images loaded for a single training directory"""
+    raw_dir = os.path.join(direc_name, direc, raw_image_direc)
+    if dimensionality == 3 and montage_mode:
+        return sorted_nicely([os.path.join(raw_dir, p) for p in os.listdir(raw_dir)])
+    return [raw_dir]
+
+
+def _load_training_direc(direc_name, direc, channel_names, dimensionality,
+                         raw_image_direc, annotation_direc, annotation_name,
+                         image_size, reshape_size=None, num_workers=None,
+                         num_frames=50, montage_mode=False):
+    """Load the X and y arrays of a single training directory.  If
+    reshape_size is given, they are TiledArray views of the tiles."""
+    if dimensionality == 2:
+        X = load_training_images_2d(direc_name, [direc],
+                                    raw_image_direc=raw_image_direc,
+                                    channel_names=channel_names,
+                                    image_size=image_size,
+                                    num_workers=num_workers)
+
+        y = load_annotated_images_2d(direc_name, [direc],
+                                     annotation_direc=annotation_direc,
+                                     annotation_name=annotation_name,
+                                     image_size=image_size,
+                                     num_workers=num_workers)
+
+        if reshape_size is not None:
+            X, y = reshape_matrix(X, y, reshape_size=reshape_size, lazy=True)
+    else:
+        X = load_training_images_3d(direc_name, [direc],
+                                    raw_image_direc=raw_image_direc,
+                                    channel_names=channel_names,
+                                    image_size=image_size,
+                                    num_frames=num_frames,
+                                    montage_mode=montage_mode,
+                                    num_workers=num_workers)
+
+        y = load_annotated_images_3d(direc_name, [direc],
+                                     annotation_direc=annotation_direc,
+                                     annotation_name=annotation_name,
+                                     image_size=image_size,
+                                     num_frames=num_frames,
+                                     montage_mode=montage_mode,
+                                     num_workers=num_workers)
+
+        if reshape_size is not None:
+            X, y = reshape_movie(X, y, reshape_size=reshape_size, lazy=True)
+
+    return X, y
+
+
+def _get_training_data_config(direc_name,
+                              channel_names,
+                              dimensionality,
+                              training_direcs=None,
+                              raw_image_direc='raw',
+                              annotation_direc='annotated',
+                              annotation_name='feature',
+                              reshape_size=None,
+                              **kwargs):
+    """Validate the arguments of a dataset build and gather them in a dict,
+    which is saved with the dataset so interrupted builds can be resumed.
+    # Returns
+        dict of the dataset arguments
+    """
+    if not isinstance(dimensionality, int) and not isinstance(dimensionality, float):
+        raise ValueError('Data dimensionality should be an integer value, typically 2 or 3. '
+                         'Recieved {}'.format(type(dimensionality).__name__))
+
+    if not isinstance(channel_names, list):
+        raise ValueError('channel_names should be a list of strings (e.g. [\'DAPI\']). '
+                         'Found {}'.format(type(channel_names).__name__))
+
+    dimensionality = int(dimensionality)
+    if dimensionality not in {2, 3}:
+        raise NotImplementedError('Building datasets is not implemented for '
+                                  'dimensionality {}'.format(dimensionality))
+
+    if training_direcs is None:
+        training_direcs = get_immediate_subdirs(direc_name)
+
+    num_frames = kwargs.get('num_frames', 50)
+    montage_mode = kwargs.get('montage_mode', False)
+
+    return {
+        'direc_name': direc_name,
+        'dimensionality': dimensionality,
+        'channel_names': channel_names,
+        'training_direcs': list(training_direcs),
+        'raw_image_direc': raw_image_direc,
+        'annotation_direc': annotation_direc,
+        'annotation_name': annotation_name,
+        'reshape_size': reshape_size,
+        'num_frames': num_frames if dimensionality == 3 else None,
+        'montage_mode': montage_mode if dimensionality == 3 else None,
+        'data_format': K.image_data_format(),
+    }
+
+
+def _get_annotation_files(config, direc):
+    """Get the paths of the annotation files of a single training directory,
+    matched the same way as load_annotated_images_2d and _3d load them."""
+    annotation_dir = os.path.join(config['direc_name'], direc, config['annotation_direc'])
+    annotation_name = config['annotation_name']
+    names = annotation_name if isinstance(annotation_name, list) else [annotation_name]
+
+    if config['dimensionality'] == 2:
+        imglist = listdir(annotation_dir)
+        matches = [_get_annotation_file_2d(imglist, name) for name in names]
+        return [os.path.join(annotation_dir, m) for m in matches if m is not None]
+
+    y_dirs = [annotation_dir]
+    if config['montage_mode']:
+        y_dirs = [os.path.join(annotation_dir, p) for p in listdir(annotation_dir)]
+
+    files = []
+    for y_dir in y_dirs:
+        imglist = listdir(y_dir)
+        for name in names:
+            frames = filter_channel_files(imglist, name)[:config['num_frames'] or 50]
+            files.extend(os.path.join(y_dir, f) for f in frames)
+    return files
+
+
+def _plan_training_chunks(config, training_direcs):
+    """Count the batches of each training directory, so X and y can be
+    preallocated before any image is loaded.
+    # Arguments
+        config: dict of the dataset arguments, as in make_training_data_streaming
+        training_direcs: training directories to plan
+    # Returns
+        image_size: size of the images (assumes all images are the same size)
+        chunks: list of dicts of each directory and its start and stop batch
+        X_shape, y_shape: shapes of X and y
+        y_dtype: dtype of y, the unsigned integer dtype of the annotation
+                 files of all training_direcs (or int32)
+    """
+    direc_name = config['direc_name']
+    dimensionality = config['dimensionality']
+    raw_image_direc = config['raw_image_direc']
+    montage_mode = config['montage_mode']
+    reshape_size = config['reshape_size']
+
+    # Load one file to get image sizes (assumes all images same size)
+    image_dirs = _get_raw_image_dirs(direc_name, training_direcs[0], raw_image_direc,
+                                     dimensionality, montage_mode)
+    image_size = get_image_sizes(image_dirs[0], config['channel_names'])
+
+    reps = 1
+    if reshape_size is not None:
+        reps = int(np.ceil(float(image_size[0]) / float(reshape_size))) ** 2
+        tile_size = (reshape_size, reshape_size)
+    else:
+        tile_size = tuple(image_size)
+
+    chunks, start = [], 0
+    for direc in training_direcs:
+        image_dirs = _get_raw_image_dirs(direc_name, direc, raw_image_direc,
+                                         dimensionality, montage_mode)
+        stop = start + len(image_dirs) * reps
+        chunks.append({'direc': direc, 'start': start, 'stop': stop})
+        start = stop
+
+    annotation_name = config['annotation_name']
+    n_channels = len(config['channel_names'])
+    n_annotations = len(annotation_name) if isinstance(annotation_name, list) else 1
+    frames = (config['num_frames'],) if dimensionality == 3 else ()
+    if config['data_format'] == 'channels_first':
+        X_shape = (start, n_channels) + frames + tile_size
+        y_shape = (start, n_annotations) + frames + tile_size
+    else:
+        X_shape = (start,) + frames + tile_size + (n_channels,)
+        y_shape = (start,) + frames + tile_size + (n_annotations,)
+
+    # labels are stored in the dtype of the annotation files, if it is unsigned.
+    # Only the file headers are read, so every directory is checked up front.
+    annotation_files = []
+    for direc in training_direcs:
+        annotation_files.extend(_get_annotation_files(config, direc))
+    y_dtype = _get_annotation_dtype(annotation_files)
+
+    return list(image_size), chunks, X_shape, y_shape, y_dtype
+
+
+def _write_training_direc(config, chunk, X, y, image_size, num_workers=None):
+    """Load a single training directory into its chunk of X and y.
+    Tiles are gathered straight into X and y (e.g. memory-mapped files)."""
+    X_direc, y_direc = _load_training_direc(
+        config['direc_name'], chunk['direc'], config['channel_names'],
+        config['dimensionality'],
+        raw_image_direc=config['raw_image_direc'],
+        annotation_direc=config['annotation_direc'],
+        annotation_name=config['annotation_name'],
+        image_size=image_size,
+        reshape_size=config['reshape_size'],
+        num_workers=num_workers,
+        num_frames=config['num_frames'] or 50,
+        montage_mode=config['montage_mode'] or False)
+
+    if not np.can_cast(y_direc.dtype, y.dtype):
+        raise ValueError('The labels of {} ({}) do not fit in the {} labels of the '
+                         'dataset'.format(chunk['direc'], y_direc.dtype, y.dtype))
+
+    for arr, arr_direc in ((X, X_direc), (y, y_direc)):
+        if isinstance(arr_direc, TiledArray):
+            arr_direc.materialize(out=arr[chunk['start']:chunk['stop']])
+        else:
+            arr[chunk['start']:chunk['stop']] = arr_direc
+
+
+def _grow_npy(file_name, num_samples, chunk_bytes=2 ** 28):
+    """Grow the first axis of a .npy file to num_samples samples, keeping
+    its data.  The header is rewritten in place if the new shape fits in
+    its padding, and the file is extended, so only the new samples are
+    written.  Otherwise the file is copied once, chunk_bytes at a time.
+    # Arguments
+        file_name: path to the .npy file
+        num_samples: new number of samples
+        chunk_bytes: approximate number of bytes copied at a time
+    # Returns
+        the grown array, memory-mapped in r+ mode
+    """
+    with open(file_name, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        new_shape = (num_samples,) + tuple(shape[1:])
+
+        prefix = len(np.lib.format.MAGIC_PREFIX) + 2 + (2 if version == (1, 0) else 4)
+        header_len = data_offset - prefix
+        header = "{{'descr': {!r}, 'fortran_order': {!r}, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(dtype), fortran_order, new_shape)
+
+        if not fortran_order and len(header) < header_len:
+            f.seek(prefix)
+            f.write((header.ljust(header_len - 1) + '\n').encode('latin1'))
+            f.truncate(data_offset + int(np.prod(new_shape)) * dtype.itemsize)
+            return np.load(file_name, mmap_mode='r+')
+
+    # the header has no room for the new shape, copy the data to a new file
+    old = np.load(file_name, mmap_mode='r')
+    temp_path = '{}.tmp'.format(file_name)
+    new = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=new_shape)
+    chunk_size = max(1, int(chunk_bytes // max(1, old[:1].nbytes)))
+    for i in range(0, len(old), chunk_size):
+        stop = min(i + chunk_size, len(old))
+        new[i:stop] = old[i:stop]
+    new.flush()
+    del old, new
+    os.replace(temp_path, file_name)
+    return np.load(file_name, mmap_mode='r+')
+
+
+def _append_training_chunks(dataset_dir, manifest, config):
+    """Add the training directories of config that are not yet in the
+    dataset to its manifest, and grow X.npy and y.npy to hold them.
+    # Arguments
+        dataset_dir: directory of the dataset
+        manifest: dict of the dataset manifest, updated in place
+        config: dict of the arguments of the appended directories
+    # Returns
+        the config of the whole dataset
+    """
+    existing = manifest['config']
+    different = sorted(k for k in set(existing) | set(config)
+                       if k != 'training_direcs' and existing.get(k) != config.get(k))
+    if different:
+        raise ValueError('Cannot append to {}, it was built with different '
+                         'arguments: {}'.format(dataset_dir, ', '.join(different)))
+
+    built = set(chunk['direc'] for chunk in manifest['chunks'])
+    new_direcs = [d for d in config['training_direcs'] if d not in built]
+    config = dict(existing, training_direcs=existing['training_direcs'] + new_direcs)
+    if not new_direcs:
+        return config
+
+    image_size, chunks, X_shape, y_shape, y_dtype = _plan_training_chunks(config, new_direcs)
+    if list(image_size) != manifest['image_size']:
+        raise ValueError('Cannot append images of size {} to a dataset of images of '
+                         'size {}'.format(image_size, manifest['image_size']))
+    if not np.can_cast(y_dtype, manifest['y']['dtype']):
+        raise ValueError('Cannot append {} labels to a dataset of {} labels'.format(
+            y_dtype, manifest['y']['dtype']))
+
+    offset = manifest['X']['shape'][0]
+    for chunk in chunks:
+        chunk['start'] += offset
+        chunk['stop'] += offset
+
+    # grow the arrays before recording the chunks, so an interrupted
+    # append is grown again to the same size when it is resumed
+    num_samples = offset + X_shape[0]
+    for key in ('X', 'y'):
+        arr = _grow_npy(os.path.join(dataset_dir, manifest[key]['file']), num_samples)
+        manifest[key]['shape'] = list(arr.shape)
+        del arr
+
+    print('Appending {} training directories to {}'.format(len(new_direcs), dataset_dir))
+    manifest['config'] = config
+    manifest['chunks'].extend(chunks)
+    manifest['complete'] = False
+    write_dataset_manifest(dataset_dir, manifest)
+    return config
+
+
+def _get_chunk_stats(X, y, chunk, data_format):
+    """Get the per-channel pixel count, sum, sum of squares, minimum and
+    maximum of the samples of a chunk of X, and the number of labeled
+    pixels and largest label of each feature of y.  Samples are read one
+    at a time.  Returns None for an empty chunk."""
+    if chunk['stop'] <= chunk['start']:
+        return None
+
+    channel_axis = 0 if data_format == 'channels_first' else -1
+    X_stats, y_stats = [], []
+    for i in range(chunk['start'], chunk['stop']):
+        x = np.moveaxis(np.asarray(X[i], dtype='float64'), channel_axis, 0)
+        x = x.reshape(len(x), -1)
+        X_stats.append([np.full(len(x), x.shape[1]), x.sum(axis=1),
+                        np.square(x).sum(axis=1), x.min(axis=1), x.max(axis=1)])
+        labels = np.moveaxis(np.asarray(y[i]), channel_axis, 0)
+        labels = labels.reshape(len(labels), -1)
+        y_stats.append([np.count_nonzero(labels, axis=1), labels.max(axis=1)])
+
+    X_stats, y_stats = np.array(X_stats), np.array(y_stats)
+    return {
+        'X': {'count': X_stats[:, 0].sum(axis=0).astype('int64').tolist(),
+              'sum': X_stats[:, 1].sum(axis=0).tolist(),
+              'sum_sq': X_stats[:, 2].sum(axis=0).tolist(),
+              'min': X_stats[:, 3].min(axis=0).tolist(),
+              'max': X_stats[:, 4].max(axis=0).tolist()},
+        'y': {'labeled_pixels': y_stats[:, 0].sum(axis=0).astype('int64').tolist(),
+              'max_label': y_stats[:, 1].max(axis=0).astype('int64').tolist()},
+    }
+
+
+def _get_dataset_stats(X, y, manifest):
+    """Combine the cached statistics of every chunk of the dataset into
+    the per-channel mean, standard deviation, minimum and maximum of X,
+    and the labeled pixels and largest label of each feature of y.
+    Chunks without cached statistics (e.g. built before they were
+    recorded) are read once."""
+    data_format = manifest['config']['data_format']
+    for chunk in manifest['chunks']:
+        if 'stats' not in chunk:
+            chunk['stats'] = _get_chunk_stats(X, y, chunk, data_format)
+
+    chunk_stats = [chunk['stats'] for chunk in manifest['chunks'] if chunk['stats']]
+    if not chunk_stats:
+        return None
+
+    def combine(key, stat, fn):
+        return fn(np.array([c[key][stat] for c in chunk_stats]), axis=0)
+
+    count = combine('X', 'count', np.sum)
+    mean = combine('X', 'sum', np.sum) / count
+    variance = np.maximum(combine('X', 'sum_sq', np.sum) / count - mean ** 2, 0)
+    return {
+        'X': {'count': count.tolist(),
+              'mean': mean.tolist(),
+              'std': np.sqrt(variance).tolist(),
+              'min': combine('X', 'min', np.min).tolist(),
+              'max': combine('X', 'max', np.max).tolist()},
+        'y': {'labeled_pixels': combine('y', 'labeled_pixels', np.sum).tolist(),
+              'max_label': combine('y', 'max_label', np.max).tolist()},
+    }
+
+
+def make_training_data_streaming(direc_name,
+                                 dataset_dir,
+                                 channel_names,
+                                 dimensionality,
+                                 training_direcs=None,
+                                 raw_image_direc='raw',
+                                 annotation_direc='annotated',
+                                 annotation_name='feature',
+                                 reshape_size=None,
+                                 num_workers=None,
+                                 append=False,
+                                 **kwargs):
+    """
+    Read all images in training directories and write them, one training
+    directory at a time, into uncompressed X.npy and y.npy files in
+    dataset_dir.  Only a single training directory is held in memory, so
+    datasets larger than memory can be built.  Progress is recorded in
+    dataset_dir/manifest.json after each training directory, and calling
+    this function again with the same arguments resumes an interrupted build.
+    With append=True, the training directories that are not yet in an
+    existing dataset are added to the end of X.npy and y.npy, which are
+    grown in place, so only the new directories are read and written.
+    Per-channel statistics of X and label counts of y are cached in the
+    manifest for each training directory.
+    # Arguments
+        direc_name: directory containing folders of training data
+        dataset_dir: directory where X.npy, y.npy and manifest.json are saved
+        channel_names: Loads all raw images with a channel_name in the filename
+        dimensionality: dimensionality of the data, 2 or 3
+        training_direcs: directories of images located inside direc_name.
+                         If None, all directories in direc_name are used.
+        raw_image_direc: directory name inside each training dir with raw images
+        annotation_direc: directory name inside each training dir with masks
+        annotation_name: Loads all masks with annotation_name in the filename
+        reshape_size: If provided, will reshape the images to the given size
+        num_workers: number of threads decoding images
+        append: if True, add the training directories to the existing dataset
+                in dataset_dir, which must have been built with the same
+                arguments (other than training_direcs)
+        kwargs: num_frames and montage_mode for 3D data
+    # Returns
+        manifest: dict of the completed dataset manifest
+    """
+    config = _get_training_data_config(
+        direc_name, channel_names, dimensionality,
+        training_direcs=training_direcs,
+        raw_image_direc=raw_image_direc,
+        annotation_direc=annotation_direc,
+        annotation_name=annotation_name,
+        reshape_size=reshape_size,
+        **kwargs)
+    training_direcs = config['training_direcs']
+
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    X_path = os.path.join(dataset_dir, 'X.npy')
+    y_path = os.path.join(dataset_dir, 'y.npy')
+
+    manifest = read_dataset_manifest(dataset_dir)
+    if manifest is not None and append:
+        config = _append_training_chunks(dataset_dir, manifest, config)
+
+    if manifest is not None:
+        if manifest['config'] != config:
+            raise ValueError('{} already contains a dataset built with different '
+                             'arguments'.format(dataset_dir))
+        if manifest['complete']:
+            print('Dataset in {} is already complete'.format(dataset_dir))
+            return manifest
+
+        print('Resuming dataset in {} after {} of {} training directories'.format(
+            dataset_dir, len(manifest['completed']), len(manifest['chunks'])))
+        X = np.load(X_path, mmap_mode='r+')
+        y = np.load(y_path, mmap_mode='r+')
+
+    else:
+        image_size, chunks, X_shape, y_shape, y_dtype = _plan_training_chunks(
+            config, training_direcs)
+
+        X = np.lib.format.open_memmap(X_path, mode='w+', dtype=K.floatx(), shape=X_shape)
+        y = np.lib.format.open_memmap(y_path, mode='w+', dtype=y_dtype, shape=y_shape)
+
+        manifest = {
+            'config': config,
+            'image_size': list(image_size),
+            'chunks': chunks,
+            'completed': [],
+            'complete': False,
+            'X': {'file': 'X.npy', 'shape': list(X_shape), 'dtype': str(X.dtype)},
+            'y': {'file': 'y.npy', 'shape': list(y_shape), 'dtype': str(y.dtype)},
+        }
+        write_dataset_manifest(dataset_dir, manifest)
+
+    completed = set(manifest['completed'])
+    for chunk in manifest['chunks']:
+        if chunk['direc'] in completed:
+            continue
+
+        _write_training_direc(config, chunk, X, y, manifest['image_size'],
+                              num_workers=num_workers)
+        X.flush()
+        y.flush()
+        chunk['stats'] = _get_chunk_stats(X, y, chunk, config['data_format'])
+
+        # only mark the directory as completed once its data is on disk
+        manifest['completed'].append(chunk['direc'])
+        write_dataset_manifest(dataset_dir, manifest)
+
+    manifest['stats'] = _get_dataset_stats(X, y, manifest)
+    manifest['complete'] = True
+    write_dataset_manifest(dataset_dir, manifest)
+    del X, y
+    return manifest
+
+
+def _build_training_shard(config, shard, shard_dir, image_size, num_workers=None):
+    """Load the training directories of a single shard into its X and y
+    .npy files.  Runs in a worker process of make_training_data_sharded.
+    The shard is written to temporary files that are renamed when complete,
+    so an existing shard file is always a complete shard.
+    # Arguments
+        config: dict of the dataset arguments
+        shard: dict of the shard files, shapes and training directories
+        shard_dir: directory where the shard is saved
+        image_size: size of the images
+        num_workers: number of threads decoding images
+    # Returns
+        dict of the shard
+    """
+    # worker processes do not inherit the Keras configuration when spawned
+    K.set_image_data_format(config['data_format'])
+
+    arrays = {}
+    for key in ('X', 'y'):
+        temp_path = os.path.join(shard_dir, '{}.tmp'.format(shard[key]))
+        arrays[key] = np.lib.format.open_memmap(
+            temp_path, mode='w+', dtype=shard['dtype'][key],
+            shape=tuple(shard['shape'][key]))
+
+    for chunk in shard['chunks']:
+        _write_training_direc(config, chunk, arrays['X'], arrays['y'],
+                              image_size, num_workers=num_workers)
+
+    for key in ('X', 'y'):
+        arrays[key].flush()
+        temp_path = arrays[key].filename
+        del arrays[key]
+        os.replace(temp_path, os.path.join(shard_dir, shard[key]))
+    return shard
+
+
+def make_training_data_sharded(direc_name,
+                               shard_dir,
+                               channel_names,
+                               dimensionality,
+                               num_shards=None,
+                               num_processes=None,
+                               training_direcs=None,
+                               raw_image_direc='raw',
+                               annotation_direc='annotated',
+                               annotation_name='feature',
+                               reshape_size=None,
+                               num_workers=None,
+                               **kwargs):
+    """
+    Read all images in training directories and write them into a sharded
+    dataset, building the shards in parallel worker processes.  The
+    training directories are split into num_shards contiguous groups, and
+    each worker process loads, tiles and relabels its groups into its own
+    X-#####.npy and y-#####.npy files.  The result has the same layout as
+    shard_dataset, so it is read with get_shard_data or get_data (which
+    concatenate the shards virtually), or merged with merge_shards.
+    Calling this function again with the same arguments only builds the
+    shards that were not completed.
+    # Arguments
+        direc_name: directory containing folders of training data
+        shard_dir: directory where the shards and index.json are saved
+        channel_names: Loads all raw images with a channel_name in the filename
+        dimensionality: dimensionality of the data, 2 or 3
+        num_shards: number of shards, at most the number of training directories.
+                    Defaults to num_processes.
+        num_processes: number of worker processes.  Defaults to the number of CPUs.
+        training_direcs: directories of images located inside direc_name.
+                         If None, all directories in direc_name are used.
+        raw_image_direc: directory name inside each training dir with raw images
+        annotation_direc: directory name inside each training dir with masks
+        annotation_name: Loads all masks with annotation_name in the filename
+        reshape_size: If provided, will reshape the images to the given size
+        num_workers: number of threads decoding images in each worker process
+        kwargs: num_frames and montage_mode for 3D data
+    # Returns
+        dict of the dataset index
+    """
+    config = _get_training_data_config(
+        direc_name, channel_names, dimensionality,
+        training_direcs=training_direcs,
+        raw_image_direc=raw_image_direc,
+        annotation_direc=annotation_direc,
+        annotation_name=annotation_name,
+        reshape_size=reshape_size,
+        **kwargs)
+    training_direcs = config['training_direcs']
+
+    if num_processes is None:
+        num_processes = os.cpu_count() or 1
+    if num_shards is None:
+        num_shards = num_processes
+    num_shards = max(1, min(int(num_shards), len(training_direcs)))
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    manifest = read_dataset_manifest(shard_dir)
+    if manifest is not None:
+        if manifest['config'] != config or manifest['num_shards'] != num_shards:
+            raise ValueError('{} already contains a dataset built with different '
+                             'arguments'.format(shard_dir))
+        index = read_dataset_index(shard_dir)
+        if index is not None:
+            print('Dataset in {} is already complete'.format(shard_dir))
+            return index
+
+    else:
+        image_size, chunks, X_shape, y_shape, y_dtype = _plan_training_chunks(
+            config, training_direcs)
+
+        shards = []
+        splits = np.array_split(np.arange(len(chunks)), num_shards)
+        for shard_num, split in enumerate(splits):
+            # chunks are stored relative to the start of their shard
+            shard_chunks = [chunks[i] for i in split]
+            start = shard_chunks[0]['start']
+            num_samples = shard_chunks[-1]['stop'] - start
+            shards.append({
+                'start': start,
+                'num_samples': num_samples,
+                'X': 'X-{:05d}.npy'.format(shard_num),
+                'y': 'y-{:05d}.npy'.format(shard_num),
+                'shape': {'X': [num_samples] + list(X_shape[1:]),
+                          'y': [num_samples] + list(y_shape[1:])},
+                'dtype': {'X': K.floatx(), 'y': str(y_dtype)},
+                'chunks': [{'direc': c['direc'],
+                            'start': c['start'] - start,
+                            'stop': c['stop'] - start} for c in shard_chunks],
+            })
+
+        manifest = {
+            'config': config,
+            'image_size': image_size,
+            'num_samples': X_shape[0],
+            'num_shards': num_shards,
+            'shards': shards,
+        }
+        write_dataset_manifest(shard_dir, manifest)
+
+    pending = [shard for shard in manifest['shards']
+               if not all(os.path.isfile(os.path.join(shard_dir, shard[key]))
+                          for key in ('X', 'y'))]
+    if pending:
+        print('Building {} of {} shards in {}'.format(
+            len(pending), num_shards, shard_dir))
+
+    if num_processes == 1 or len(pending) <= 1:
+        for shard in pending:
+            _build_training_shard(config, shard, shard_dir, manifest['image_size'],
+                                  num_workers=num_workers)
+    else:
+        with ProcessPoolExecutor(min(num_processes, len(pending))) as executor:
+            futures = [executor.submit(_build_training_shard, config, shard, shard_dir,
+                                       manifest['image_size'], num_workers=num_workers)
+                       for shard in pending]
+            for future in futures:
+                future.result()  # raises any exception of the worker
+
+    shards = manifest['shards']
+    index = {
+        'num_samples': manifest['num_samples'],
+        'num_shards': num_shards,
+        'seed': None,
+        'shards': [{key: shard[key] for key in ('start', 'num_samples', 'X', 'y')}
+                   for shard in shards],
+        'X': {'sample_shape': shards[0]['shape']['X'][1:], 'dtype': shards[0]['dtype']['X']},
+        'y': {'sample_shape': shards[0]['shape']['y'][1:], 'dtype': shards[0]['dtype']['y']},
+    }
+    # the index is written last and marks the sharded dataset as complete
+    _write_json(os.path.join(shard_dir, 'index.json'), index)
+    return index
+
+
+def merge_shards(shard_dir, dataset_dir, chunk_bytes=2 ** 28):
+    """Concatenate the shards of a sharded dataset into a single X.npy and
+    y.npy in dataset_dir, one chunk of samples at a time.  Only needed for
+    tools that expect a single file, as get_shard_data and get_data read
+    sharded datasets directly.
+    # Arguments
+        shard_dir: directory created by shard_dataset or make_training_data_sharded
+        dataset_dir: directory where X.npy and y.npy are saved
+        chunk_bytes: approximate number of bytes of X copied at a time
+    # Returns
+        dataset_dir
+    """
+    index = read_dataset_index(shard_dir)
+    if index is None:
+        raise FileNotFoundError('{} is not a sharded dataset, '
+                                'index.json not found'.format(shard_dir))
+
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    sample_bytes = max(1, int(np.prod(index['X']['sample_shape'])) *
+                       np.dtype(index['X']['dtype']).itemsize)
+    chunk_size = max(1, int(chunk_bytes // sample_bytes))
+
+    for key in ('X', 'y'):
+        npy_path = os.path.join(dataset_dir, '{}.npy'.format(key))
+        temp_path = '{}.tmp'.format(npy_path)
+        out = np.lib.format.open_memmap(
+            temp_path, mode='w+', dtype=index[key]['dtype'],
+            shape=(index['num_samples'],) + tuple(index[key]['sample_shape']))
+        for shard in index['shards']:
+            arr = np.load(os.path.join(shard_dir, shard[key]), mmap_mode='r')
+            for i in range(0, len(arr), chunk_size):
+                start = shard['start'] + i
+                out[start:start + len(arr[i:i + chunk_size])] = arr[i:i + chunk_size]
+            del arr
+        out.flush()
+        del out
+        os.replace(temp_path, npy_path)
+
+    return dataset_dir
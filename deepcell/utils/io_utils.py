@@ -30,7 +30,14 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import json
 import os
+import re
+import struct
+import threading
+import zlib
 
 import numpy as np
 from skimage.io import imread
@@ -38,6 +45,8 @@ from skimage.external import tifffile as tiff
 from skimage.external.tifffile import TiffFile
 from tensorflow.python.keras import backend as K
 
+from deepcell import settings
+from deepcell.utils.misc_utils import get_lossless_dtype
 from deepcell.utils.misc_utils import sorted_nicely
 
 
@@ -52,70 +61,938 @@ def get_immediate_subdirs(directory):
     return sorted([d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))])
 
 
-def get_image(file_name):
+class ImageCache(object):
+    """Thread-safe in-memory cache of decoded images, keyed by path, mtime
+    and decoder.  The least recently used images are evicted once the cache
+    exceeds max_bytes.  Cached images are read-only, as they are shared.
+    # Arguments:
+        max_bytes: size limit of the cache
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, file_name, decode, decoder_name=None):
+        """Get the decoded image of a file, decoding it on a cache miss
+        # Arguments:
+            file_name: path to the image file
+            decode: function of the file path, returns the decoded image
+            decoder_name: name of decode in the cache key.  If None, uses
+                          the qualified name of decode.
+        # Returns:
+            the read-only decoded image
+        """
+        if decoder_name is None:
+            decoder_name = '{}.{}'.format(decode.__module__, decode.__name__)
+        file_name = os.path.abspath(file_name)
+        key = (file_name, os.stat(file_name).st_mtime_ns, decoder_name)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                return img
+
+        # decode outside the lock, so other threads can read the cache
+        img = np.asarray(decode(file_name))
+        img.setflags(write=False)
+        if img.nbytes <= self.max_bytes:
+            with self._lock:
+                if key not in self._images:
+                    self._images[key] = img
+                    self.nbytes += img.nbytes
+                self._evict()
+        return img
+
+    def _evict(self):
+        """Drop the least recently used images until the cache fits in
+        max_bytes.  Callers must hold the lock."""
+        while self._images and self.nbytes > self.max_bytes:
+            _, img = self._images.popitem(last=False)
+            self.nbytes -= img.nbytes
+
+    def resize(self, max_bytes):
+        """Change the size limit of the cache, evicting images if needed"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drop every cached image"""
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+
+_IMAGE_CACHE = ImageCache(settings.IMAGE_CACHE_MAX_BYTES)
+
+
+def get_cached_image(file_name, decode=None, decoder_name=None, cache=True):
+    """Decode an image through the process-wide ImageCache, whose size is
+    settings.IMAGE_CACHE_MAX_BYTES (set by the DEEPCELL_IMAGE_CACHE_MAX_BYTES
+    environment variable, 0 disables the cache).
+    # Arguments:
+        file_name: path to the image file
+        decode: function of the file path, returns the decoded image.
+                Defaults to decoding the file in its native dtype.
+        decoder_name: name of decode in the cache key
+        cache: if False, decode the image without the cache, e.g. for
+               images that are only read once
+    # Returns:
+        the decoded image, read-only if it is cached
+    """
+    if decode is None:
+        decode = _decode_image
+    if _IMAGE_CACHE.max_bytes != settings.IMAGE_CACHE_MAX_BYTES:
+        _IMAGE_CACHE.resize(settings.IMAGE_CACHE_MAX_BYTES)
+    if not cache or not _IMAGE_CACHE.max_bytes:
+        return decode(file_name)
+    return _IMAGE_CACHE.get(file_name, decode, decoder_name=decoder_name)
+
+
+def _decode_tiff_page(file_name, page):
+    """Decode a single page of a TIFF file in its native dtype"""
+    with TiffFile(file_name) as tif:
+        return tif.pages[page].asarray()
+
+
+def _decode_image(file_name):
+    """Decode an image file in its native dtype"""
+    ext = os.path.splitext(file_name.lower())[-1]
+    if ext == '.tif' or ext == '.tiff':
+        with TiffFile(file_name) as tif:
+            return tif.asarray()
+    return imread(file_name)
+
+
+def get_image(file_name, native_dtype=False, cache=True):
+    """
+    Read image from file and load into a writable numpy array.
+    Decoded images are shared through the process-wide image cache, and
+    cached images are copied before they are returned.
+    # Arguments:
+        file_name: path to the image file
+        native_dtype: if True, keep the dtype of the file instead of float32
+        cache: if False, decode the image without the image cache
+    """
+    img = get_cached_image(file_name, cache=cache)
+    if not native_dtype:
+        return img.astype('float32')
+    return img if img.flags.writeable else img.copy()
+
+
+# TIFF tags needed to locate the strips or tiles of a page
+_TIFF_TAGS = {
+    256: 'width',
+    257: 'length',
+    258: 'bits_per_sample',
+    259: 'compression',
+    273: 'strip_offsets',
+    277: 'samples_per_pixel',
+    278: 'rows_per_strip',
+    279: 'strip_byte_counts',
+    284: 'planar_config',
+    317: 'predictor',
+    322: 'tile_width',
+    323: 'tile_length',
+    324: 'tile_offsets',
+    325: 'tile_byte_counts',
+    339: 'sample_format',
+}
+
+# struct formats of the integer TIFF field types
+_TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+
+# compressions that can be decoded one strip or tile at a time
+_TIFF_COMPRESSIONS = {1: None, 8: zlib.decompress, 32946: zlib.decompress}
+
+
+def _read_tiff_header(fh):
+    """Read the header of a TIFF or BigTIFF file
+    # Arguments:
+        fh: TIFF file opened in binary mode
+    # Returns:
+        header: byteorder ('<' or '>'), struct formats of the entry counts
+                and offsets, and the offset of the first page
+    """
+    fh.seek(0)
+    header = fh.read(8)
+    byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byteorder is None:
+        raise ValueError('{} is not a TIFF file'.format(fh.name))
+
+    version = struct.unpack(byteorder + 'H', header[2:4])[0]
+    if version == 42:
+        count_format, offset_format = 'H', 'I'
+        offset = struct.unpack(byteorder + 'I', header[4:8])[0]
+    elif version == 43:  # BigTIFF
+        count_format, offset_format = 'Q', 'Q'
+        offset = struct.unpack(byteorder + 'Q', fh.read(8))[0]
+    else:
+        raise ValueError('{} is not a TIFF file'.format(fh.name))
+    return byteorder, count_format, offset_format, offset
+
+
+def _get_tiff_entry_format(header):
+    """struct format of a single IFD entry"""
+    byteorder, _, offset_format, _ = header
+    offset_size = struct.calcsize(offset_format)
+    return byteorder + 'HH' + offset_format + '{}s'.format(offset_size)
+
+
+def _iter_tiff_ifds(fh, header):
+    """Follow the chain of pages of a TIFF file, reading only the location
+    and size of each page's IFD (image file directory).
+    # Arguments:
+        fh: TIFF file opened in binary mode
+        header: header of the file, from _read_tiff_header
+    # Yields:
+        offset and number of entries of the IFD of each page
+    """
+    byteorder, count_format, offset_format, offset = header
+    count_size = struct.calcsize(count_format)
+    offset_size = struct.calcsize(offset_format)
+    entry_size = struct.calcsize(_get_tiff_entry_format(header))
+    while offset:
+        fh.seek(offset)
+        num_entries = struct.unpack(byteorder + count_format, fh.read(count_size))[0]
+        fh.seek(offset + count_size + num_entries * entry_size)
+        next_offset = struct.unpack(byteorder + offset_format, fh.read(offset_size))[0]
+        yield offset, num_entries
+        offset = next_offset
+
+
+def _parse_tiff_tags(fh, header, ifd_offset, num_entries):
+    """Parse the tags in _TIFF_TAGS from the IFD of a page
+    # Returns:
+        tags: dict of tag name to tuple of values
+    """
+    byteorder, count_format, offset_format, _ = header
+    offset_size = struct.calcsize(offset_format)
+    entry_format = _get_tiff_entry_format(header)
+    entry_size = struct.calcsize(entry_format)
+
+    fh.seek(ifd_offset + struct.calcsize(count_format))
+    entries = fh.read(num_entries * entry_size)
+    tags = {}
+    for i in range(num_entries):
+        code, dtype, count, value = struct.unpack_from(entry_format, entries, i * entry_size)
+        if code not in _TIFF_TAGS or dtype not in _TIFF_TYPES:
+            continue
+
+        value_format = byteorder + '{}{}'.format(count, _TIFF_TYPES[dtype])
+        value_size = struct.calcsize(value_format)
+        if value_size > offset_size:
+            # the values do not fit in the entry, which holds their offset
+            fh.seek(struct.unpack(byteorder + offset_format, value)[0])
+            value = fh.read(value_size)
+        tags[_TIFF_TAGS[code]] = struct.unpack(value_format, value[:value_size])
+
+    return tags
+
+
+def _read_tiff_tags(fh, page=0):
+    """Read the tags of a single page of a TIFF or BigTIFF file
+    # Arguments:
+        fh: TIFF file opened in binary mode
+        page: index of the page
+    # Returns:
+        byteorder: '<' or '>'
+        tags: dict of tag name to tuple of values, for the tags in _TIFF_TAGS
+    """
+    header = _read_tiff_header(fh)
+    for i, (ifd_offset, num_entries) in enumerate(_iter_tiff_ifds(fh, header)):
+        if i == page:
+            return header[0], _parse_tiff_tags(fh, header, ifd_offset, num_entries)
+    raise IndexError('{} has fewer than {} pages'.format(fh.name, page + 1))
+
+
+def get_num_pages(file_name):
+    """Count the pages of a multi-page TIFF file from the chain of page
+    headers, without reading any image data.  Other images have 1 page.
+    # Arguments:
+        file_name: path to the image file
+    # Returns:
+        number of pages in the file
+    """
+    ext = os.path.splitext(file_name.lower())[-1]
+    if ext != '.tif' and ext != '.tiff':
+        return 1
+    with open(file_name, 'rb') as fh:
+        return sum(1 for _ in _iter_tiff_ifds(fh, _read_tiff_header(fh)))
+
+
+def _get_layout_from_tags(byteorder, tags):
+    """Get the layout of the strips or tiles of a TIFF page from its tags.
+    Returns None if the page cannot be read one strip or tile at a time
+    (e.g. LZW or JPEG compression)."""
+    samples = tags.get('samples_per_pixel', (1,))[0]
+    bits = set(tags.get('bits_per_sample', (1,)))
+    sample_format = set(tags.get('sample_format', (1,)))
+    compression = tags.get('compression', (1,))[0]
+    predictor = tags.get('predictor', (1,))[0]
+    planar_config = tags.get('planar_config', (1,))[0]
+
+    if len(bits) != 1 or len(sample_format) != 1:
+        return None
+
+    bits, sample_format = bits.pop(), sample_format.pop()
+    if (bits not in {8, 16, 32, 64} or sample_format not in {1, 2, 3} or
+            compression not in _TIFF_COMPRESSIONS or
+            predictor not in {1, 2} or (predictor == 2 and sample_format == 3)):
+        return None
+
+    kind = {1: 'u', 2: 'i', 3: 'f'}[sample_format]
+    dtype = np.dtype('{}{}{}'.format(byteorder, kind, bits // 8))
+
+    length, width = tags['length'][0], tags['width'][0]
+    if 'tile_offsets' in tags:
+        chunk_shape = (tags['tile_length'][0], tags['tile_width'][0])
+        offsets, byte_counts = tags['tile_offsets'], tags['tile_byte_counts']
+    else:
+        chunk_shape = (min(tags.get('rows_per_strip', (length,))[0], length), width)
+        offsets, byte_counts = tags['strip_offsets'], tags['strip_byte_counts']
+
+    return {
+        'shape': (length, width, samples),
+        'dtype': dtype,
+        'chunk_shape': chunk_shape,
+        'tiled': 'tile_offsets' in tags,
+        'offsets': offsets,
+        'byte_counts': byte_counts,
+        'planar': samples > 1 and planar_config == 2,
+        'compression': compression,
+        'predictor': predictor,
+    }
+
+
+def _get_tiff_layout(file_name, page=0):
+    """Get the layout of the strips or tiles of a TIFF page.
+    Returns None if the page cannot be read one strip or tile at a time."""
+    with open(file_name, 'rb') as fh:
+        byteorder, tags = _read_tiff_tags(fh, page=page)
+    return _get_layout_from_tags(byteorder, tags)
+
+
+def _get_tiff_layouts(file_name, frame_range=None):
+    """Get the layouts of the pages in frame_range of a TIFF file,
+    following the chain of pages only once.
+    # Arguments:
+        file_name: path to the TIFF file
+        frame_range: (start, stop) pages to read.  If None, all pages.
+    # Returns:
+        list of the layout of each page, None for unsupported pages
+    """
+    start, stop = (0, None) if frame_range is None else frame_range
+    layouts = []
+    with open(file_name, 'rb') as fh:
+        header = _read_tiff_header(fh)
+        for i, (ifd_offset, num_entries) in enumerate(_iter_tiff_ifds(fh, header)):
+            if stop is not None and i >= stop:
+                break
+            if i >= start:
+                tags = _parse_tiff_tags(fh, header, ifd_offset, num_entries)
+                layouts.append(_get_layout_from_tags(header[0], tags))
+    return layouts
+
+
+def _read_tiff_region(file_name, layout, row_range, col_range):
+    """Read a window of a TIFF page, decoding only the strips or tiles that
+    intersect it.  Uncompressed, contiguous pages are memory-mapped."""
+    length, width, samples = layout['shape']
+    dtype = layout['dtype']
+    row_start, row_stop = row_range
+    col_start, col_stop = col_range
+
+    offsets, byte_counts = layout['offsets'], layout['byte_counts']
+    is_contiguous = all(offsets[i] + byte_counts[i] == offsets[i + 1]
+                        for i in range(len(offsets) - 1))
+    if layout['compression'] == 1 and not layout['tiled'] and is_contiguous:
+        if layout['planar']:
+            img = np.memmap(file_name, dtype=dtype, mode='r', offset=offsets[0],
+                            shape=(samples, length, width))
+            return np.moveaxis(img[:, row_start:row_stop, col_start:col_stop], 0, -1)
+        img = np.memmap(file_name, dtype=dtype, mode='r', offset=offsets[0],
+                        shape=layout['shape'])
+        return img[row_start:row_stop, col_start:col_stop]
+
+    decompress = _TIFF_COMPRESSIONS[layout['compression']]
+    chunk_rows, chunk_cols = layout['chunk_shape']
+    chunks_across = -(-width // chunk_cols)
+    chunks_per_plane = chunks_across * -(-length // chunk_rows)
+    region = np.empty((row_stop - row_start, col_stop - col_start, samples), dtype=dtype)
+
+    # planar pages store each sample in its own set of chunks
+    if layout['planar']:
+        planes = [(s, s + 1) for s in range(samples)]
+    else:
+        planes = [(0, samples)]
+
+    with open(file_name, 'rb') as fh:
+        for plane, (sample_start, sample_stop) in enumerate(planes):
+            chunk_samples = sample_stop - sample_start
+            for chunk_row in range(row_start // chunk_rows, -(-row_stop // chunk_rows)):
+                for chunk_col in range(col_start // chunk_cols, -(-col_stop // chunk_cols)):
+                    index = plane * chunks_per_plane + chunk_row * chunks_across + chunk_col
+                    fh.seek(offsets[index])
+                    data = fh.read(byte_counts[index])
+                    if decompress is not None:
+                        data = decompress(data)
+
+                    # the last strip may have fewer rows
+                    chunk = np.frombuffer(data, dtype=dtype)
+                    rows = min(chunk_rows, chunk.size // (chunk_cols * chunk_samples))
+                    chunk = chunk[:rows * chunk_cols * chunk_samples]
+                    chunk = chunk.reshape(rows, chunk_cols, chunk_samples)
+                    if layout['predictor'] == 2:
+                        # undo horizontal differencing
+                        chunk = np.cumsum(chunk, axis=1, dtype=dtype)
+
+                    # copy the intersection of the chunk and the window
+                    top, left = chunk_row * chunk_rows, chunk_col * chunk_cols
+                    r0, r1 = max(row_start, top), min(row_stop, top + rows)
+                    c0, c1 = max(col_start, left), min(col_stop, left + chunk_cols, width)
+                    region[r0 - row_start:r1 - row_start,
+                           c0 - col_start:c1 - col_start,
+                           sample_start:sample_stop] = chunk[r0 - top:r1 - top,
+                                                             c0 - left:c1 - left]
+
+    return region
+
+
+def _clip_window(row_range, col_range, length, width):
+    """Clip a ((row_start, row_stop), (col_start, col_stop)) window to the
+    size of an image, a range of None selects the full axis."""
+    row_range = (0, length) if row_range is None else row_range
+    col_range = (0, width) if col_range is None else col_range
+    row_range = tuple(int(np.clip(r, 0, length)) for r in row_range)
+    col_range = tuple(int(np.clip(c, 0, width)) for c in col_range)
+    return row_range, col_range
+
+
+def _read_tiff_page(file_name, layout, row_range=None, col_range=None):
+    """Read a window of a TIFF page from its layout"""
+    row_range, col_range = _clip_window(row_range, col_range, *layout['shape'][:2])
+    img = _read_tiff_region(file_name, layout, row_range, col_range)
+    return img[..., 0] if layout['shape'][2] == 1 else img
+
+
+def _crop_image(img, row_range=None, col_range=None):
+    """Crop a decoded image to a window"""
+    row_range, col_range = _clip_window(row_range, col_range, *img.shape[:2])
+    return img[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+
+
+def get_image_region(file_name, row_range=None, col_range=None, page=0, native_dtype=False,
+                     cache=True):
+    """
+    Read a window of an image from file and load into numpy array.
+    Uncompressed TIFF pages are memory-mapped, and only the strips or tiles
+    of a TIFF page that intersect the window are read and decoded
+    (uncompressed or deflate compressed).  Other files are fully decoded
+    before cropping.
+    # Arguments:
+        file_name: path to the image file
+        row_range: (start, stop) rows of the window.  If None, all rows.
+        col_range: (start, stop) columns of the window.  If None, all columns.
+        page: index of the page of a multi-page TIFF file
+        native_dtype: if True, keep the dtype of the file instead of float32
+        cache: if False, fully decoded images bypass the image cache
+    # Returns:
+        numpy array of the window, with shape (rows, cols) or
+        (rows, cols, samples) for multi-sample images
+    """
+    ext = os.path.splitext(file_name.lower())[-1]
+    layout = None
+    if ext == '.tif' or ext == '.tiff':
+        layout = _get_tiff_layout(file_name, page=page)
+
+    if layout is not None:
+        img = _read_tiff_page(file_name, layout, row_range, col_range)
+    else:
+        # fall back to decoding the full image
+        if ext == '.tif' or ext == '.tiff':
+            img = get_cached_image(file_name, lambda f: _decode_tiff_page(f, page),
+                                   decoder_name='tiff_page_{}'.format(page), cache=cache)
+        else:
+            img = get_cached_image(file_name, cache=cache)
+        img = _crop_image(img, row_range, col_range)
+
+    return img if native_dtype else np.float32(img)
+
+
+def get_image_shape(file_name, page=0):
+    """
+    Get the shape of an image without decoding it.  The shape of a TIFF
+    page is read from its header, other formats are decoded through the
+    image cache.
+    # Arguments:
+        file_name: path to the image file
+        page: index of the page of a multi-page TIFF file
+    # Returns:
+        shape of the image, (rows, cols) or (rows, cols, samples)
     """
-    Read image from file and load into numpy array
+    ext = os.path.splitext(file_name.lower())[-1]
+    if ext == '.tif' or ext == '.tiff':
+        layout = _get_tiff_layout(file_name, page=page)
+        if layout is not None:
+            length, width, samples = layout['shape']
+            return (length, width) if samples == 1 else (length, width, samples)
+        with TiffFile(file_name) as tif:
+            return tuple(tif.pages[page].shape)
+    return get_cached_image(file_name).shape
+
+
+def get_image_dtype(file_name, page=0):
+    """
+    Get the dtype of an image without decoding it.  The dtype of a TIFF
+    page is read from its header, other formats are decoded through the
+    image cache.
+    # Arguments:
+        file_name: path to the image file
+        page: index of the page of a multi-page TIFF file
+    # Returns:
+        numpy dtype of the image
     """
     ext = os.path.splitext(file_name.lower())[-1]
     if ext == '.tif' or ext == '.tiff':
-        return np.float32(TiffFile(file_name).asarray())
-    return np.float32(imread(file_name))
+        layout = _get_tiff_layout(file_name, page=page)
+        if layout is not None:
+            return np.dtype(layout['dtype'].newbyteorder('='))
+        with TiffFile(file_name) as tif:
+            return np.dtype(tif.pages[page].dtype)
+    return get_cached_image(file_name).dtype
 
 
-def nikon_getfiles(direc_name, channel_name):
+def get_image_stack(file_name, frame_range=None, row_range=None, col_range=None,
+                    native_dtype=False, out=None, cache=True):
+    """
+    Read a range of frames of a multi-page TIFF stack into a numpy array.
+    Only the pages in frame_range are read, and each page is read like
+    get_image_region, so only the window of each page is decoded.
+    Other images are read as a stack of a single frame.
+    # Arguments:
+        file_name: path to the image file
+        frame_range: (start, stop) pages to read.  If None, all pages.
+        row_range: (start, stop) rows of the window.  If None, all rows.
+        col_range: (start, stop) columns of the window.  If None, all columns.
+        native_dtype: if True, keep the dtype of the file instead of float32
+        out: optional array to read the frames into, e.g. a view of a
+             preallocated array.  native_dtype is ignored.
+        cache: if False, fully decoded images bypass the image cache
+    # Returns:
+        numpy array of the stack, with shape (frames, rows, cols) or
+        (frames, rows, cols, samples) for multi-sample images
+    """
+    ext = os.path.splitext(file_name.lower())[-1]
+    is_tiff = ext == '.tif' or ext == '.tiff'
+    layouts = _get_tiff_layouts(file_name, frame_range) if is_tiff else [None]
+    if not layouts:
+        raise IndexError('{} has no pages in the frame range {}'.format(
+            file_name, frame_range))
+
+    if all(layout is not None for layout in layouts):
+        # pages are only read when they are copied into the stack
+        pages = (_read_tiff_page(file_name, layout, row_range, col_range)
+                 for layout in layouts)
+    elif is_tiff:
+        # fall back to decoding the full pages
+        start = 0 if frame_range is None else frame_range[0]
+        pages = (get_image_region(file_name, row_range, col_range, page=start + i,
+                                  native_dtype=True, cache=cache)
+                 for i in range(len(layouts)))
+    else:
+        pages = [_crop_image(get_cached_image(file_name, cache=cache), row_range, col_range)]
+
+    for i, page in enumerate(pages):
+        if out is None:
+            dtype = page.dtype if native_dtype else np.dtype('float32')
+            out = np.empty((len(layouts),) + page.shape, dtype=dtype)
+        out[i] = page
+    return out
+
+
+def nikon_getfiles(direc_name, channel_name, manifest=None):
     """
     Return all image filenames in direc_name with
-    channel_name in the filename
+    channel_name in the filename.
+    If a FileManifest is given, the directory listing is read from it.
+    """
+    imglist = listdir(direc_name, manifest=manifest)
+    return filter_channel_files(imglist, channel_name)
+
+
+def filter_channel_files(imglist, channel_name):
+    """
+    Return the filenames in imglist with channel_name in the filename,
+    sorted in natural order.  Allows one directory listing to be shared
+    between several channels.
     """
-    imglist = os.listdir(direc_name)
     imgfiles = [i for i in imglist if channel_name in i]
     imgfiles = sorted_nicely(imgfiles)
     return imgfiles
 
 
-def get_image_sizes(data_location, channel_names):
-    """Get the first image inside the data_location and return its shape"""
+def get_image_sizes(data_location, channel_names, manifest=None):
+    """Get the first image inside the data_location and return its shape.
+    For multi-page stacks, this is the shape of a single page.
+    If a FileManifest is given, the shape is read from it, otherwise
+    TIFF shapes are read from the file header."""
     img_list_channels = []
     for channel in channel_names:
-        img_list_channels.append(nikon_getfiles(data_location, channel))
-    img_temp = np.asarray(get_image(os.path.join(data_location, img_list_channels[0][0])))
-    return img_temp.shape
+        img_list_channels.append(nikon_getfiles(data_location, channel, manifest=manifest))
+    img_path = os.path.join(data_location, img_list_channels[0][0])
+    if manifest is not None:
+        entry = manifest.get_entry(img_path)
+        # entries without pages were recorded with the shape of the full stack
+        if entry is not None and entry['shape'] is not None and entry.get('pages'):
+            return tuple(entry['shape'])
+    return get_image_shape(img_path)
 
 
-def get_images_from_directory(data_location, channel_names):
+def listdir(direc_name, manifest=None):
     """
-    Read all images from directory with channel_name in the filename
-    Return them in a numpy array
+    List the entries of direc_name, like os.listdir.
+    If a FileManifest is given and it contains direc_name, the listing is
+    read from the manifest instead of the filesystem.
     """
-    data_format = K.image_data_format()
-    img_list_channels = []
-    for channel in channel_names:
-        img_list_channels.append(nikon_getfiles(data_location, channel))
+    if manifest is not None:
+        imglist = manifest.listdir(direc_name)
+        if imglist is not None:
+            return imglist
+    return os.listdir(direc_name)
 
-    img_temp = np.asarray(get_image(os.path.join(data_location, img_list_channels[0][0])))
 
-    n_channels = len(channel_names)
-    all_images = []
+def _read_image_header(file_name):
+    """Get the shape and dtype of the first page of an image, and its number
+    of pages.  TIFF files are read from their headers, other formats are
+    decoded."""
+    ext = os.path.splitext(file_name.lower())[-1]
+    if ext in {'.tif', '.tiff'}:
+        with TiffFile(file_name) as tif:
+            page = tif.pages[0]
+            return tuple(page.shape), str(np.dtype(page.dtype)), len(tif.pages)
+    img = get_cached_image(file_name)
+    return img.shape, str(img.dtype), 1
 
-    for stack_iteration in range(len(img_list_channels[0])):
-        if data_format == 'channels_first':
-            shape = (1, n_channels, img_temp.shape[0], img_temp.shape[1])
-        else:
-            shape = (1, img_temp.shape[0], img_temp.shape[1], n_channels)
 
-        all_channels = np.zeros(shape, dtype=K.floatx())
+def _parse_frame(file_name):
+    """Split a filename into its channel and frame index, which is the
+    last number in the filename (e.g. nuclear_005.tif -> (nuclear, 5))"""
+    stem = os.path.splitext(file_name)[0]
+    numbers = list(re.finditer('[0-9]+', stem))
+    if not numbers:
+        return stem, None
+    last = numbers[-1]
+    channel = (stem[:last.start()] + stem[last.end():]).strip('_-. ')
+    return channel, int(last.group())
+
+
+# subdirectory of a FileManifest's root where the manifest is saved
+_MANIFEST_DIR = '.deepcell'
+
+
+class FileManifest(object):
+    """Persistent index of every file below a root directory, recording each
+    file's path, channel, frame index, shape and dtype (of the first page),
+    number of pages and mtime.
+    Directories are scanned in parallel.  Rescans are incremental: only
+    directories whose mtime changed are listed again, and only new or
+    modified files have their headers read again.
+    The manifest is saved in its own subdirectory of root, which is not
+    scanned, so saving it does not change the mtime of any directory it
+    indexes.
+    # Arguments:
+        root: root directory of the training data
+        manifest_path: JSON file where the manifest is saved.
+                       Defaults to root/.deepcell/manifest.json
+        image_extensions: extensions of the files whose shape and dtype
+                          are recorded
+    """
+
+    def __init__(self,
+                 root,
+                 manifest_path=None,
+                 image_extensions=('.tif', '.tiff', '.png', '.jpg', '.jpeg')):
+        self.root = os.path.abspath(root)
+        if manifest_path is None:
+            manifest_path = os.path.join(self.root, _MANIFEST_DIR, 'manifest.json')
+        self.manifest_path = manifest_path
+
+        # the manifest and its directory are never part of the manifest
+        manifest_path = os.path.abspath(manifest_path)
+        self._excluded = {manifest_path, '{}.tmp'.format(manifest_path),
+                          os.path.join(self.root, _MANIFEST_DIR)}
+        self.image_extensions = set(image_extensions)
+        self.directories = {}
+
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('root') == self.root:
+                self.directories = manifest['directories']
+
+    def _relpath(self, path):
+        relpath = os.path.relpath(os.path.abspath(path), self.root)
+        return '' if relpath == '.' else relpath.replace(os.sep, '/')
+
+    def _scan_directory(self, relpath):
+        """Scan a single directory, reusing the previous scan if unchanged"""
+        direc = os.path.join(self.root, relpath)
+        mtime = os.stat(direc).st_mtime_ns
+        previous = self.directories.get(relpath)
+        if previous is not None and previous['mtime'] == mtime:
+            return previous
+
+        previous_files = previous['files'] if previous is not None else {}
+        files, subdirs = {}, []
+        for entry in os.scandir(direc):
+            if os.path.abspath(entry.path) in self._excluded:
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+                continue
+
+            file_mtime = entry.stat().st_mtime_ns
+            old = previous_files.get(entry.name)
+            if old is not None and old['mtime'] == file_mtime:
+                files[entry.name] = old
+                continue
+
+            channel, frame = _parse_frame(entry.name)
+            shape, dtype, pages = None, None, None
+            if os.path.splitext(entry.name.lower())[-1] in self.image_extensions:
+                shape, dtype, pages = _read_image_header(entry.path)
+            files[entry.name] = {
+                'path': '/'.join(p for p in (relpath, entry.name) if p),
+                'channel': channel,
+                'frame': frame,
+                'shape': list(shape) if shape is not None else None,
+                'dtype': dtype,
+                'pages': pages,
+                'mtime': file_mtime,
+            }
+
+        return {'mtime': mtime, 'files': files, 'subdirs': sorted(subdirs)}
+
+    def scan(self, num_workers=None):
+        """Scan the root directory, one level of subdirectories at a time
+        # Arguments:
+            num_workers: number of threads scanning directories.
+                         If None, uses the ThreadPoolExecutor default.
+        # Returns:
+            self, with the updated manifest
+        """
+        directories = {}
+        level = ['']
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            while level:
+                scanned = list(executor.map(self._scan_directory, level))
+                next_level = []
+                for relpath, entry in zip(level, scanned):
+                    directories[relpath] = entry
+                    next_level.extend('/'.join(p for p in (relpath, d) if p)
+                                      for d in entry['subdirs'])
+                level = next_level
+
+        # directories that no longer exist are dropped
+        self.directories = directories
+        return self
+
+    def save(self):
+        """Atomically save the manifest to manifest_path"""
+        manifest = {'root': self.root, 'directories': self.directories}
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        if not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        temp_path = '{}.tmp'.format(self.manifest_path)
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def listdir(self, direc_name):
+        """List the files and subdirectories of direc_name, like os.listdir.
+        Returns None if direc_name is not in the manifest."""
+        entry = self.directories.get(self._relpath(direc_name))
+        if entry is None:
+            return None
+        return list(entry['files']) + list(entry['subdirs'])
+
+    def get_entry(self, file_name):
+        """Get the manifest entry of a file, or None if it is not in the manifest"""
+        direc, name = os.path.split(self._relpath(file_name))
+        entry = self.directories.get(direc)
+        if entry is None:
+            return None
+        return entry['files'].get(name)
+
+    def get_files(self, direc_name, channel_name):
+        """Get the entries of every file in direc_name with channel_name in
+        the filename, sorted like nikon_getfiles."""
+        imglist = self.listdir(direc_name)
+        if imglist is None:
+            return []
+        entries = self.directories[self._relpath(direc_name)]['files']
+        return [entries[f] for f in filter_channel_files(imglist, channel_name)
+                if f in entries]
+
+
+def build_file_manifest(root, manifest_path=None, num_workers=None):
+    """Scan (or incrementally rescan) root and save its FileManifest
+    # Arguments:
+        root: root directory of the training data
+        manifest_path: JSON file where the manifest is saved.
+                       Defaults to root/.deepcell/manifest.json
+        num_workers: number of threads scanning directories
+    # Returns:
+        manifest: the updated FileManifest
+    """
+    manifest = FileManifest(root, manifest_path=manifest_path)
+    manifest.scan(num_workers=num_workers)
+    manifest.save()
+    return manifest
+
 
-        for j in range(n_channels):
-            img_path = os.path.join(data_location, img_list_channels[j][stack_iteration])
-            channel_img = get_image(img_path)
-            if data_format == 'channels_first':
-                all_channels[0, j, :, :] = channel_img
-            else:
-                all_channels[0, :, :, j] = channel_img
+class ImageDirectoryIterator(object):
+    """Lazily read every image in a directory with channel_name in the
+    filename, in the same order as get_images_from_directory.  Images are
+    only read when requested, so long acquisitions are processed with
+    constant memory.  While iterating, the next `prefetch` items are read
+    in background threads.  If a channel has a single multi-page TIFF stack,
+    each of its pages is an image.
+    # Arguments:
+        data_location: directory of images with channel_names in the filename
+        channel_names: list of channel names to load for each image
+        batch_size: if None, yield each image with a batch size of 1.
+                    Otherwise, yield batches of up to batch_size images.
+        prefetch: number of items read ahead while iterating
+        num_workers: number of threads reading the prefetched items
+        region: optional ((row_start, row_stop), (col_start, col_stop))
+                window of each image to read
+        manifest: optional FileManifest used to list data_location
+    """
+
+    def __init__(self,
+                 data_location,
+                 channel_names,
+                 batch_size=None,
+                 prefetch=2,
+                 num_workers=1,
+                 region=None,
+                 manifest=None):
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('`batch_size` must be a positive integer. '
+                             'Got {}'.format(batch_size))
+        self.data_location = data_location
+        self.channel_names = channel_names
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.num_workers = num_workers
+        self.region = (None, None) if region is None else region
+
+        self.img_list_channels = [nikon_getfiles(data_location, channel, manifest=manifest)
+                                  for channel in channel_names]
+        self.img_pages_channels = [self._get_pages(img_list)
+                                   for img_list in self.img_list_channels]
+        self.num_images = len(self.img_pages_channels[0])
+
+    def _get_pages(self, img_list):
+        """Get the (filename, page, layout) of each image of a channel.  A
+        channel with a single multi-page stack has one image per page, and
+        the layouts of its pages are read once, following the chain of pages
+        only once.  Images without a layout are read with get_image_region."""
+        if len(img_list) == 1:
+            ext = os.path.splitext(img_list[0].lower())[-1]
+            if ext == '.tif' or ext == '.tiff':
+                layouts = _get_tiff_layouts(os.path.join(self.data_location, img_list[0]))
+                return [(img_list[0], page, layout) for page, layout in enumerate(layouts)]
+        return [(img, 0, None) for img in img_list]
+
+    def __len__(self):
+        if self.batch_size is None:
+            return self.num_images
+        return -(-self.num_images // self.batch_size)
+
+    def _get_image_indices(self, index):
+        if self.batch_size is None:
+            return [index]
+        start = index * self.batch_size
+        return list(range(start, min(start + self.batch_size, self.num_images)))
+
+    def _read_images(self, indices):
+        """Read the images of each index into a single array"""
+        data_format = K.image_data_format()
+        images = None
+        for b, i in enumerate(indices):
+            for j, img_pages in enumerate(self.img_pages_channels):
+                img_file, page, layout = img_pages[i]
+                img_path = os.path.join(self.data_location, img_file)
+                # each image is read once, so it bypasses the image cache
+                if layout is not None:
+                    channel_img = _read_tiff_page(img_path, layout, *self.region)
+                else:
+                    channel_img = get_image_region(img_path, *self.region, page=page,
+                                                   native_dtype=True, cache=False)
+                if images is None:
+                    # all images are assumed to have the shape of the first
+                    n_channels = len(self.img_list_channels)
+                    if data_format == 'channels_first':
+                        shape = (len(indices), n_channels) + channel_img.shape
+                    else:
+                        shape = (len(indices),) + channel_img.shape + (n_channels,)
+                    images = np.zeros(shape, dtype=K.floatx())
+
+                if data_format == 'channels_first':
+                    images[b, j, :, :] = channel_img
+                else:
+                    images[b, :, :, j] = channel_img
+        return images
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index {} is out of range for {} items'.format(index, len(self)))
+        return self._read_images(self._get_image_indices(index))
 
-        all_images.append(all_channels)
+    def __iter__(self):
+        if not self.prefetch:
+            for index in range(len(self)):
+                yield self[index]
+            return
 
-    return all_images
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        futures = collections.deque()
+        try:
+            for index in range(len(self)):
+                futures.append(executor.submit(self.__getitem__, index))
+                # read the current item and up to `prefetch` items ahead
+                if len(futures) > self.prefetch:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+def get_images_from_directory(data_location, channel_names, region=None):
+    """
+    Read all images from directory with channel_name in the filename
+    Return them in a numpy array
+    If region ((row_start, row_stop), (col_start, col_stop)) is given,
+    only that window of each image is read.
+    A channel with a single multi-page TIFF stack is read one page per image.
+    Use ImageDirectoryIterator to read the images lazily instead.
+    """
+    return list(ImageDirectoryIterator(data_location, channel_names,
+                                       prefetch=0, region=region))
 
 
 def save_model_output(output,
@@ -170,3 +1047,115 @@ def save_model_output(output,
                 out_file_path = os.path.join(output_dir, batch_dir, cnnout_name)
                 tiff.imsave(out_file_path, feature.astype('int32'))
         print('Saved {} frames to {}'.format(output.shape[1], output_dir))
+
+
+def _get_imagej_dtype(stack):
+    """Get the dtype to save a stack as an ImageJ hyperstack: the smallest
+    lossless dtype if ImageJ reads it (uint8 or uint16), otherwise float32."""
+    dtype = get_lossless_dtype(stack)
+    if dtype == np.bool_:
+        return np.dtype('uint8')
+    if dtype in (np.dtype('uint8'), np.dtype('uint16')):
+        return dtype
+    return np.dtype('float32')
+
+
+def _save_stack(file_name, stack, axes, compress=0, imagej=False):
+    """Save a stack of images as a single multi-page TIFF file with the
+    smallest lossless dtype, using BigTIFF if it exceeds 4 GB.
+    If imagej, the stack is saved as an ImageJ hyperstack, in a dtype
+    that ImageJ reads (see _get_imagej_dtype).  ImageJ does not read
+    BigTIFF, so larger hyperstacks are written contiguously instead."""
+    if imagej:
+        stack = stack.astype(_get_imagej_dtype(stack), copy=False)
+        tiff.imsave(file_name, stack, imagej=True, compress=compress,
+                    photometric='minisblack', metadata={'axes': axes})
+        return file_name
+
+    stack = stack.astype(get_lossless_dtype(stack), copy=False)
+    bigtiff = stack.nbytes > 2 ** 32 - 2 ** 25  # leave room for the metadata
+    # minisblack, so stacks of 3 or 4 frames are not saved as RGB(A) images
+    tiff.imsave(file_name, stack, bigtiff=bigtiff, compress=compress,
+                photometric='minisblack', metadata={'axes': axes})
+    return file_name
+
+
+def save_model_output_stacks(output,
+                             output_dir,
+                             feature_name='',
+                             channel=None,
+                             hyperstack=False,
+                             compress=0,
+                             num_workers=None,
+                             data_format=None):
+    """Save model output as multi-page TIFF stacks in the provided directory.
+    Each channel of each batch is saved as one stack of all its frames, or
+    with hyperstack=True all channels of a batch are saved in one ImageJ
+    hyperstack, which ImageJ and Fiji open with its frames and channels.
+    Stacks are saved with the smallest lossless dtype and are compressed in
+    parallel, one file per thread.  ImageJ only reads uint8, uint16 and
+    float32 images, so hyperstacks of other values are saved as float32.
+    # Arguments:
+        output: output of model. Expects channel to have its own axis
+        output_dir: directory to save the model output stacks
+        feature_name: optional description to start each output filename
+        channel: if given, only saves this channel
+        hyperstack: if True, save all channels of a batch in a single
+                    ImageJ hyperstack
+        compress: zlib compression level of the pages, from 0 (uncompressed)
+                  to 9
+        num_workers: number of threads compressing files
+        data_format: 'channels_first' or 'channels_last'
+    # Returns:
+        list of the paths of the saved files
+    """
+    if data_format is None:
+        data_format = K.image_data_format()
+    channel_axis = 1 if data_format == 'channels_first' else -1
+    z_axis = 2 if data_format == 'channels_first' else 1
+
+    if channel is not None and not 0 <= channel < output.shape[channel_axis]:
+        raise ValueError('`channel` must be in the range of the output '
+                         'channels. Got ', channel)
+
+    if not os.path.isdir(output_dir):
+        raise FileNotFoundError('{} is not a valid output_dir'.format(
+            output_dir))
+
+    # If 2D, convert to 3D with only one z-axis
+    if output.ndim == 4:
+        output = np.expand_dims(output, axis=z_axis)
+
+    # move the channels of each batch to (frames, channels, rows, cols)
+    if data_format == 'channels_first':
+        output = np.swapaxes(output, 1, 2)
+    else:
+        output = np.moveaxis(output, -1, 2)
+
+    channels = range(output.shape[2]) if channel is None else [channel]
+    prefix = '{}_'.format(feature_name) if feature_name else ''
+
+    jobs = []
+    for b in range(output.shape[0]):
+        # If multiple batches of results, create a numbered subdirectory
+        batch_dir = os.path.join(output_dir, str(b) if output.shape[0] > 1 else '')
+        if not os.path.isdir(batch_dir):
+            os.makedirs(batch_dir)
+
+        if hyperstack:
+            file_name = os.path.join(batch_dir, '{}features.tif'.format(prefix))
+            jobs.append((file_name, output[b][:, list(channels)], 'ZCYX'))
+        else:
+            for c in channels:
+                file_name = os.path.join(batch_dir, '{}feature_{}.tif'.format(prefix, c))
+                jobs.append((file_name, output[b, :, c], 'ZYX'))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_save_stack, f, stack, axes, compress=compress,
+                                   imagej=hyperstack)
+                   for f, stack, axes in jobs]
+        saved = [future.result() for future in futures]
+
+    print('Saved {} stacks of {} frames to {}'.format(
+        len(saved), output.shape[1], output_dir))
+    return saved
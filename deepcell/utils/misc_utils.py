@@ -32,8 +32,39 @@ from __future__ import division
 
 import re
 
+import numpy as np
+
 
 def sorted_nicely(l):
     convert = lambda text: int(text) if text.isdigit() else text
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(l, key=alphanum_key)
+
+
+def get_lossless_dtype(arr):
+    """Get the smallest dtype that holds every value of arr without loss.
+    Integer (and integer-valued float) arrays get the smallest integer dtype
+    of their range, other float arrays get float32 if it is exact.
+    # Arguments:
+        arr: numpy array
+    # Returns:
+        the smallest lossless numpy dtype
+    """
+    arr = np.asarray(arr)
+    if arr.dtype == np.bool_ or arr.size == 0:
+        return arr.dtype
+
+    if arr.dtype.kind == 'f' and not np.array_equal(arr, np.round(arr)):
+        if arr.dtype.itemsize > 4 and np.array_equal(arr, arr.astype('float32')):
+            return np.dtype('float32')
+        return arr.dtype
+
+    if arr.dtype.kind not in {'u', 'i', 'f'}:
+        return arr.dtype
+
+    low, high = arr.min(), arr.max()
+    for dtype in ('uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'uint64', 'int64'):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return arr.dtype
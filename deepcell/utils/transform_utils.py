@@ -30,14 +30,21 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import hashlib
+import json
+import os
+
 import numpy as np
 from scipy import ndimage
 from skimage.measure import label
 from skimage.measure import regionprops
 from skimage.morphology import ball, disk
-from skimage.morphology import binary_erosion, binary_dilation
+from skimage.morphology import binary_erosion
 from tensorflow.python.keras import backend as K
 
+from deepcell import settings
+from deepcell.utils.misc_utils import get_lossless_dtype
+
 
 def deepcell_transform(maskstack, dilation_radius=None, data_format=None):
     """
@@ -46,7 +53,7 @@ def deepcell_transform(maskstack, dilation_radius=None, data_format=None):
         maskstack: label masks of uniquely labeled instances
         dilation_radius:  width to enlarge the edge feature of each instance
     # Returns:
-        deepcell_stacks: masks of:
+        deepcell_stacks: uint8 masks of:
         [background_edge_feature, interior_edge_feature, interior_feature, background]
     """
     if data_format is None:
@@ -59,46 +66,50 @@ def deepcell_transform(maskstack, dilation_radius=None, data_format=None):
 
     maskstack = np.squeeze(maskstack, axis=channel_axis)
 
-    # Detect the edges and interiors
-    new_masks = np.zeros(maskstack.shape)
-    edge_masks = np.zeros(maskstack.shape)
+    # Detect the edges and interiors with label-aware erosion: a pixel is in
+    # the interior of its cell if its whole neighborhood has the same label.
+    # A minimum and a maximum filter classify every pixel of the stack at
+    # once, in O(pixels) time regardless of the number of cells, where eroding
+    # each cell separately takes O(cells * pixels).  The footprint has a
+    # leading axis of size 1, so images of the batch are never compared.
+    # For these radius 1 footprints, mode='nearest' counts pixels outside the
+    # image as part of the cell, like the border of binary_erosion.
     strel = ball(1) if maskstack.ndim > 3 else disk(1)
-    for cell_label in np.unique(maskstack):
-        if cell_label != 0:
-            for i in range(maskstack.shape[0]):
-                # get the cell interior
-                img = maskstack[i] == cell_label
-                img = binary_erosion(img, strel)
-                new_masks[i] += img
-
-    interior_masks = np.multiply(new_masks, maskstack)
-    edge_masks = (maskstack - interior_masks > 0).astype('int')
-    interior_masks = (interior_masks > 0).astype('int')
+    footprint = strel[np.newaxis].astype('bool')
+    new_masks = ndimage.minimum_filter(maskstack, footprint=footprint, mode='nearest')
+    new_masks = new_masks == maskstack
+    max_labels = ndimage.maximum_filter(maskstack, footprint=footprint, mode='nearest')
+    new_masks &= max_labels == maskstack
+    del max_labels
+    new_masks &= maskstack != 0
+
+    # Features are boolean masks, so no other temporary is larger than
+    # one byte per pixel.
+    foreground = maskstack > 0
+    edge_masks = foreground & ~new_masks
+    interior_masks = foreground & new_masks
 
     # dilate the background masks and subtract from all edges for background-edges
-    dilated_background = np.zeros(maskstack.shape)
-    for i in range(maskstack.shape[0]):
-        background = (maskstack[i] == 0).astype('int')
-        dilated_background[i] = binary_dilation(background, strel)
+    dilated_background = ndimage.binary_dilation(maskstack == 0, structure=footprint)
 
-    background_edge_masks = (edge_masks - dilated_background > 0).astype('int')
+    background_edge_masks = edge_masks & ~dilated_background
 
     # edges that are not background-edges are interior-edges
-    interior_edge_masks = (edge_masks - background_edge_masks > 0).astype('int')
+    interior_edge_masks = edge_masks & ~background_edge_masks
 
     if dilation_radius:
         dil_strel = ball(dilation_radius) if maskstack.ndim > 3 else disk(dilation_radius)
+        dil_footprint = dil_strel[np.newaxis].astype('bool')
         # Thicken cell edges to be more pronounced
-        for i in range(edge_masks.shape[0]):
-            interior_edge_masks[i] = binary_dilation(interior_edge_masks[i], selem=dil_strel)
-            background_edge_masks[i] = binary_dilation(background_edge_masks[i], selem=dil_strel)
+        interior_edge_masks = ndimage.binary_dilation(interior_edge_masks, structure=dil_footprint)
+        background_edge_masks = ndimage.binary_dilation(background_edge_masks,
+                                                        structure=dil_footprint)
 
         # Thin the augmented edges by subtracting the interior features.
-        interior_edge_masks = (interior_edge_masks - interior_masks > 0).astype('int')
-        background_edge_masks = (background_edge_masks - interior_masks > 0).astype('int')
+        interior_edge_masks &= ~interior_masks
+        background_edge_masks &= ~interior_masks
 
-    background_masks = (1 - background_edge_masks - interior_edge_masks - interior_masks > 0)
-    background_masks = background_masks.astype('int')
+    background_masks = ~(background_edge_masks | interior_edge_masks | interior_masks)
 
     all_stacks = [
         background_edge_masks,
@@ -107,7 +118,7 @@ def deepcell_transform(maskstack, dilation_radius=None, data_format=None):
         background_masks
     ]
 
-    deepcell_stacks = np.stack(all_stacks, axis=channel_axis)
+    deepcell_stacks = np.stack(all_stacks, axis=channel_axis).astype('uint8')
     return deepcell_stacks
 
 
@@ -257,3 +268,112 @@ def transform_matrix_offset_center(matrix, x, y):
     ])
     transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
     return transform_matrix
+
+
+class TransformCache(object):
+    """On-disk cache of transformed training targets.
+    Each entry is keyed by a hash of the labels together with the transform,
+    its arguments and the version of the cache, and is saved as a .npy file
+    in the smallest lossless dtype, so it can be memory-mapped.  Once the
+    cache holds more than max_bytes, the least recently used entries are
+    deleted.
+    # Arguments:
+        cache_dir: directory of the cached entries
+        max_bytes: maximum total size of the cached entries
+    """
+
+    # Version of the cached entries, part of every key.  Bump it whenever
+    # deepcell_transform, the watershed transform or the stored layout of
+    # the entries changes, so entries of older versions are never returned.
+    version = 1
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self, y, transform, **kwargs):
+        """Get the key of the transform of y with the given arguments"""
+        y = np.ascontiguousarray(y)
+        key = hashlib.sha1()
+        key.update(json.dumps({
+            'version': self.version,
+            'shape': y.shape,
+            'dtype': y.dtype.str,
+            'transform': transform,
+            'kwargs': kwargs,
+        }, sort_keys=True, default=str).encode('utf-8'))
+        key.update(y.reshape(-1).view(np.uint8))
+        return key.hexdigest()
+
+    def _get_paths(self, key):
+        path = os.path.join(self.cache_dir, key)
+        return '{}.npy'.format(path), '{}.json'.format(path)
+
+    def get(self, key, mmap_mode=None):
+        """Load a cached entry
+        # Arguments:
+            key: key of the entry
+            mmap_mode: if not None, memory-map the entry in its stored dtype
+        # Returns:
+            the cached array in its original dtype, or None if not cached
+        """
+        array_path, meta_path = self._get_paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            arr = np.load(array_path, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark the entry as recently used
+        os.utime(array_path, None)
+        if mmap_mode is not None:
+            return arr
+        return arr.astype(meta['dtype'], copy=False)
+
+    def put(self, key, arr):
+        """Save an entry in its smallest lossless dtype, then evict the least
+        recently used entries until the cache fits in max_bytes."""
+        arr = np.asarray(arr)
+        array_path, meta_path = self._get_paths(key)
+
+        # write to temporary files first, so readers never see partial entries
+        temp_path = '{}.{}.tmp.npy'.format(array_path[:-4], os.getpid())
+        np.save(temp_path, arr.astype(get_lossless_dtype(arr), copy=False))
+        with open('{}.tmp'.format(meta_path), 'w') as f:
+            json.dump({'dtype': arr.dtype.str, 'shape': arr.shape}, f)
+        os.replace('{}.tmp'.format(meta_path), meta_path)
+        os.replace(temp_path, array_path)
+
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy') and '.tmp' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            for stale_path in (path, '{}.json'.format(path[:-4])):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass  # already evicted by another process
+            total_bytes -= size
+
+
+def get_transform_cache():
+    """Get the TransformCache in settings.TRANSFORM_CACHE_DIR
+    (set by the DEEPCELL_TRANSFORM_CACHE_DIR environment variable),
+    or None if transforms are not cached."""
+    if not settings.TRANSFORM_CACHE_DIR:
+        return None
+    return TransformCache(settings.TRANSFORM_CACHE_DIR,
+                          max_bytes=settings.TRANSFORM_CACHE_MAX_BYTES)
@@ -10,7 +10,7 @@ Code for creating montages of 3D image stacks to aid image annotaters
 Import python packages
 """
 
-from deepcell import get_image, get_images_from_directory
+from deepcell import get_image, ImageDirectoryIterator
 import numpy as np
 import skimage as sk
 import os
@@ -42,7 +42,7 @@ for cell_type, number_of_sets, channel_name in zip(cell_types, list_of_number_of
 		if os.path.isdir(save_direc) is False:
 			os.mkdir(save_direc)
 
-		images = get_images_from_directory(directory, [channel_name])
+		images = ImageDirectoryIterator(directory, [channel_name])
 
 		print(directory, images[0].shape)
 
@@ -56,9 +56,11 @@ for cell_type, number_of_sets, channel_name in zip(cell_types, list_of_number_of
 		for i in range(4):
 			for j in range(4):
 				list_of_cropped_images = []
-				for stack_number in range(number_of_images):
-					img = images[stack_number][0,:,:,0]
-					cropped_image = img[i*crop_size_x:(i+1)*crop_size_x, j*crop_size_y:(j+1)*crop_size_y]
+				# only read the cropped region of each image
+				region = ((i*crop_size_x, (i+1)*crop_size_x), (j*crop_size_y, (j+1)*crop_size_y))
+				cropped_images = ImageDirectoryIterator(directory, [channel_name], region = region)
+				for stack_number, cropped_image in enumerate(cropped_images):
+					cropped_image = cropped_image[0,:,:,0]
 					cropped_image_name = 'set_' + str(set_number) + '_x_' + str(i) + '_y_' + str(j) + '_slice_' + str(stack_number) + '.png'
 					cropped_folder_name = os.path.join(direc, save_stack_subdirec, 'set_' + str(set_number) + '_x_' + str(i) + '_y_' + str(j))
 
@@ -10,7 +10,7 @@ Code for adjusting the contrast of images to aid image annotaters
 Import python packages
 """
 
-from deepcell import get_image, get_images_from_directory
+from deepcell import get_image, ImageDirectoryIterator
 import numpy as np
 import skimage as sk
 import os
@@ -27,7 +27,7 @@ directory = "/media/vanvalen/fe0ceb60-f921-4184-a484-b7de12c1eea6/eTK133/HeLa_C6
 save_directory = os.path.join("/media/vanvalen/fe0ceb60-f921-4184-a484-b7de12c1eea6/eTK133/HeLa_C6_Site_0/", "Processed")
 channel_names = ["channel001", "channel001"]
 
-images = get_images_from_directory(directory, channel_names)
+images = ImageDirectoryIterator(directory, channel_names)
 
 print images[0].shape
 
@@ -37,9 +37,9 @@ number_of_images = len(images)
 Adjust contrast
 """
 
-for j in xrange(number_of_images):
+for j, image in enumerate(images):
 	print "Processing image " + str(j+1) + " of " + str(number_of_images)
-	image = np.array(images[j], dtype = 'float')
+	image = np.array(image, dtype = 'float')
 	phase_image = image[0,0,:,:]
 	nuclear_image = image[0,1,:,:]
 
@@ -10,7 +10,7 @@ Code for adjusting the contrast of images to aid image annotaters
 Import python packages
 """
 
-from deepcell import get_image, get_images_from_directory
+from deepcell import get_image, ImageDirectoryIterator
 import numpy as np
 import skimage as sk
 import os
@@ -49,7 +49,7 @@ for cell_type, number_of_sets, channel_name in zip(cell_types, list_of_number_of
 		if os.path.isdir(save_direc) is False:
 			os.mkdir(save_direc)
 
-		images = get_images_from_directory(directory, [channel_name])
+		images = ImageDirectoryIterator(directory, [channel_name])
 
 		print directory, images[0].shape
 
@@ -59,9 +59,9 @@ for cell_type, number_of_sets, channel_name in zip(cell_types, list_of_number_of
 		Adjust contrast
 		"""
 
-		for j in xrange(number_of_images):
+		for j, image in enumerate(images):
 			print "Processing image " + str(j+1) + " of " + str(number_of_images)
-			image = np.array(images[j], dtype = 'float')
+			image = np.array(image, dtype = 'float')
 			nuclear_image = image[0,0,:,:]
 
 			"""
@@ -31,13 +31,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 import numpy as np
 
+from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.preprocessing.image import array_to_img
 from tensorflow.python.keras.preprocessing.image import img_to_array
 from tensorflow.python.platform import test
 
 from deepcell import image_generators
+from deepcell import settings
+from deepcell.utils.data_utils import IndexedArray
 
 
 def _generate_test_images():
@@ -132,6 +137,42 @@ class TestTransformMasks(test.TestCase):
             mask, transform='deepcell', data_format='channels_first')
         self.assertEqual(mask_transform.shape, (5, num_classes, 10, 30, 30))
 
+    def test_packed_one_hot_array(self):
+        for data_format in ('channels_last', 'channels_first'):
+            channel_axis = 1 if data_format == 'channels_first' else -1
+            mask = np.random.randint(3, size=(5, 10, 30, 30))
+            mask = np.expand_dims(mask, axis=channel_axis)
+            y = image_generators._transform_masks(
+                mask, transform='deepcell', dilation_radius=1, data_format=data_format)
+            self.assertEqual(y.dtype, np.uint8)
+
+            # targets are stored with one byte per pixel, and unpacked when indexed
+            packed = image_generators._PackedOneHotArray(y, channel_axis)
+            self.assertEqual(packed.shape, y.shape)
+            self.assertEqual(packed.packed.nbytes, y.nbytes // 4)
+            self.assertAllEqual(packed[2], y[2])
+            self.assertAllEqual(packed[1, :, 2:5], y[1, :, 2:5])
+            self.assertAllEqual(packed[[0, 3]], y[[0, 3]])
+
+    def test_transform_cache(self):
+        cache_dir = os.path.join(self.get_temp_dir(), 'transform_cache')
+        self.addCleanup(setattr, settings, 'TRANSFORM_CACHE_DIR', settings.TRANSFORM_CACHE_DIR)
+        settings.TRANSFORM_CACHE_DIR = cache_dir
+
+        mask = np.random.randint(3, size=(5, 30, 30, 1))
+        for _ in range(2):  # compute, then load from the cache
+            mask_transform = image_generators._transform_masks(
+                mask, transform='watershed', data_format='channels_last',
+                distance_bins=4, erosion_width=1)
+            self.assertEqual(mask_transform.shape, (5, 30, 30, 4))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        settings.TRANSFORM_CACHE_DIR = None
+        expected = image_generators._transform_masks(
+            mask, transform='watershed', data_format='channels_last',
+            distance_bins=4, erosion_width=1)
+        self.assertAllEqual(mask_transform, expected)
+
     def test_watershed_transform(self):
         distance_bins = 4
         erosion_width = 1
@@ -716,6 +757,24 @@ class TestFullyConvDataGenerator(test.TestCase):
             generator = image_generators.ImageFullyConvDataGenerator(
                 zoom_range=(2, 2, 2))
 
+    def test_fully_conv_data_generator_native_dtype(self):
+        generator = image_generators.ImageFullyConvDataGenerator(
+            rotation_range=90.,
+            horizontal_flip=True,
+            data_format='channels_last')
+
+        # integer images are neither copied nor converted until sampled
+        X = np.random.randint(2 ** 16, size=(8, 10, 10, 1)).astype('uint16')
+        train_dict = {
+            'X': IndexedArray(X, np.arange(4, 8)),
+            'y': np.random.randint(2, size=(4, 10, 10, 1)),
+        }
+        iterator = generator.flow(train_dict, batch_size=4)
+        self.assertIs(iterator.x, train_dict['X'])
+        x, y = next(iterator)
+        self.assertEqual(x.dtype, np.dtype(K.floatx()))
+        self.assertEqual(x.shape, (4, 10, 10, 1))
+
     def test_fully_conv_data_generator_fit(self):
         generator = image_generators.ImageFullyConvDataGenerator(
             featurewise_center=True,
@@ -30,7 +30,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import asyncio
+import os
+import shutil
+
 import numpy as np
+from skimage.external import tifffile as tiff
 
 from tensorflow.python import keras
 from tensorflow.python.platform import test
@@ -130,5 +135,222 @@ class RunningTests(test.TestCase):
         padded = running.get_padding_layers(model)
         self.assertEqual(len(padded), n_skips + 1)
 
+    def test_get_padded_tile(self):
+        win = 5
+        # test channels_last
+        X = np.random.random((2, 20, 30, 3))
+        pad_width = ((0, 0), (win, win), (win, win), (0, 0))
+        for padding, mode in (('reflect', 'reflect'), ('zero', 'constant')):
+            padded = np.pad(X, pad_width, mode=mode)
+            for row_range, col_range in (((-win, 10), (-win, 15)),
+                                         ((5, 20 + win), (10, 30 + win)),
+                                         ((-win, 20 + win), (-win, 30 + win))):
+                tile = running.get_padded_tile(X, row_range, col_range, padding,
+                                               data_format='channels_last')
+                expected = padded[:, row_range[0] + win:row_range[1] + win,
+                                  col_range[0] + win:col_range[1] + win, :]
+                self.assertAllEqual(tile, expected)
+
+        # test channels_first and reusing the output buffer
+        X = np.random.random((2, 3, 20, 30))
+        padded = np.pad(X, ((0, 0), (0, 0), (win, win), (win, win)), mode='reflect')
+        out = np.zeros((2, 3, 10 + 2 * win, 15 + 2 * win))
+        for i in range(2):
+            for j in range(2):
+                row_range = (i * 10 - win, (i + 1) * 10 + win)
+                col_range = (j * 15 - win, (j + 1) * 15 + win)
+                tile = running.get_padded_tile(X, row_range, col_range, 'reflect',
+                                               out=out, data_format='channels_first')
+                self.assertIs(tile, out)
+                self.assertAllEqual(tile, padded[:, :, i * 10:(i + 1) * 10 + 2 * win,
+                                                 j * 15:(j + 1) * 15 + 2 * win])
+
+        # test bad output buffer shape
+        with self.assertRaises(ValueError):
+            running.get_padded_tile(X, (0, 10), (0, 10), 'zero', out=out,
+                                    data_format='channels_first')
+
+    def test_process_whole_image_pyramid(self):
+        keras.backend.set_image_data_format('channels_last')
+        field = 3
+        X = np.random.random((2, 64, 64, 1))
+
+        model = keras.models.Sequential()
+        model.add(keras.layers.Conv2D(3, (1, 1), input_shape=(18, 18, 1)))
+
+        # test level selection picks the fewest crops that match the scale
+        self.assertListEqual(running.get_pyramid_levels(
+            X, model, scale=1, receptive_field=field), [4])
+        self.assertListEqual(running.get_pyramid_levels(
+            X, model, scale=.5, receptive_field=field, num_levels=3), [2, 1])
+
+        # test native scale matches process_whole_image
+        expected = running.process_whole_image(
+            model, X, num_crops=4, receptive_field=field, padding='reflect')
+        output = running.process_whole_image_pyramid(
+            model, X, scale=1, receptive_field=field, padding='reflect')
+        self.assertAllClose(output, expected, atol=1e-5)
+
+        # test output is mapped back to native resolution
+        output = running.process_whole_image_pyramid(
+            model, X, scale=.5, receptive_field=field, padding='reflect', num_levels=2)
+        self.assertEqual(output.shape, (2, 64, 64, 3))
+
+        # test coarser levels are weighted by their scale mismatch
+        levels = []
+        for num_crops in (2, 1):
+            tile = 16 * num_crops
+            resized = running.resize_images(X, (tile, tile))
+            level = running.process_whole_image(
+                model, resized, num_crops=num_crops, receptive_field=field, padding='reflect')
+            levels.append(running.resize_images(level, (64, 64)))
+        # level 1 has half the scale of level 0: a mismatch of 50%
+        expected = (levels[0] + .2 * levels[1]) / 1.2
+        self.assertAllClose(output, expected, atol=1e-5)
+
+        # test receptive field larger than the model input
+        with self.assertRaises(ValueError):
+            running.get_pyramid_levels(X, model, receptive_field=61)
+
+    def test_run_model_on_directory(self):
+        keras.backend.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        output_dir = os.path.join(temp_dir, 'output')
+        os.makedirs(output_dir)
+        n_images, img_w, img_h = 5, 30, 30
+        for i in range(n_images):
+            for channel in ('nuclear', 'phase'):
+                img = np.random.random((img_w, img_h)).astype('float32')
+                tiff.imsave(os.path.join(temp_dir, '{}_{}.tif'.format(channel, i)), img)
+
+        model = keras.models.Sequential()
+        model.add(keras.layers.Conv2D(3, (1, 1), input_shape=(None, None, 2)))
+
+        expected = running.run_model_on_directory(
+            temp_dir, ['nuclear', 'phase'], output_dir, model,
+            win_x=0, win_y=0, split=False, save=False)
+        self.assertEqual(len(expected), n_images)
+
+        # test batches of images, including a final partial batch
+        for split in (False, True):
+            outputs = running.run_model_on_directory(
+                temp_dir, ['nuclear', 'phase'], output_dir, model,
+                win_x=0, win_y=0, split=split, save=True, batch_size=2)
+            self.assertEqual(len(outputs), n_images)
+            for output, expected_output in zip(outputs, expected):
+                self.assertEqual(output.shape, (img_w, img_h, 3))
+                self.assertAllClose(output, expected_output, atol=1e-5)
+        self.assertEqual(len(os.listdir(output_dir)), n_images * 3)
+
+        # test saving without keeping the outputs
+        shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        outputs = running.run_model_on_directory(
+            temp_dir, ['nuclear', 'phase'], output_dir, model, win_x=0, win_y=0,
+            split=False, batch_size=2, prefetch=0, return_outputs=False)
+        self.assertIsNone(outputs)
+        self.assertEqual(len(os.listdir(output_dir)), n_images * 3)
+
+        # test bad batch_size
+        with self.assertRaises(ValueError):
+            running.run_model_on_directory(
+                temp_dir, ['nuclear', 'phase'], output_dir, model,
+                win_x=0, win_y=0, split=False, batch_size=0)
+
+    def test_run_models_on_directory(self):
+        keras.backend.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        output_dir = os.path.join(temp_dir, 'output')
+        os.makedirs(output_dir)
+        n_images, img_w, img_h = 3, 30, 30
+        for i in range(n_images):
+            img = np.random.random((img_w, img_h)).astype('float32')
+            tiff.imsave(os.path.join(temp_dir, 'nuclear_{}.tif'.format(i)), img)
+
+        def model_fn(input_shape, n_features):
+            model = keras.models.Sequential()
+            model.add(keras.layers.Conv2D(n_features, (1, 1), input_shape=input_shape))
+            return model
+
+        n_members = 4
+        list_of_weights = []
+        for i in range(n_members):
+            weights_path = os.path.join(temp_dir, 'weights_{}.h5'.format(i))
+            model_fn((img_w, img_h, 1), 3).save_weights(weights_path)
+            list_of_weights.append(weights_path)
+
+        kwargs = {
+            'n_features': 3,
+            'win_x': 0,
+            'win_y': 0,
+            'image_size_x': img_w,
+            'image_size_y': img_h,
+            'save': False,
+        }
+        for split in (False, True):
+            n_tiles = 4 if split else 1
+            expected = running.run_models_on_directory(
+                temp_dir, ['nuclear'], output_dir, model_fn, list_of_weights,
+                split=split, **kwargs)
+            self.assertEqual(expected.shape, (n_images, img_w, img_h, 3))
+
+            # test adaptive mode evaluates every member if tiles never converge
+            output, counts = running.run_models_on_directory_adaptive(
+                temp_dir, ['nuclear'], output_dir, model_fn, list_of_weights,
+                split=split, tolerance=0, **kwargs)
+            self.assertAllClose(output, expected, atol=1e-5)
+            self.assertAllEqual(counts, np.full((n_images, n_tiles), n_members))
+
+            # test adaptive mode stops once every tile has converged
+            for criterion in ('mean', 'variance'):
+                output, counts = running.run_models_on_directory_adaptive(
+                    temp_dir, ['nuclear'], output_dir, model_fn, list_of_weights,
+                    split=split, tolerance=np.inf, min_members=2,
+                    criterion=criterion, **kwargs)
+                self.assertEqual(output.shape, expected.shape)
+                self.assertAllEqual(counts, np.full((n_images, n_tiles), 2))
+
+        # test bad criterion
+        with self.assertRaises(ValueError):
+            running.run_models_on_directory_adaptive(
+                temp_dir, ['nuclear'], output_dir, model_fn, list_of_weights,
+                criterion='bad', **kwargs)
+
+        # test images of different shapes
+        img = np.random.random((img_w + 2, img_h)).astype('float32')
+        tiff.imsave(os.path.join(temp_dir, 'nuclear_{}.tif'.format(n_images)), img)
+        with self.assertRaises(ValueError):
+            running.run_models_on_directory_adaptive(
+                temp_dir, ['nuclear'], output_dir, model_fn, list_of_weights, **kwargs)
+
+    def test_async_model_runner(self):
+        keras.backend.set_image_data_format('channels_last')
+        n_crops, field = 4, 11
+        X = np.random.random((2, 40, 40, 1))
+        input_shape = running.get_cropped_input_shape(X, n_crops, field)
+
+        model = keras.models.Sequential()
+        model.add(keras.layers.Conv2D(3, (1, 1), input_shape=input_shape))
+
+        expected = running.process_whole_image(
+            model, X, num_crops=n_crops, receptive_field=field, padding='zero')
+
+        runner = running.AsyncModelRunner(model, max_concurrent=2)
+        self.addCleanup(runner.shutdown)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        # test concurrent whole image predictions on a shared model
+        coros = [runner.process_whole_image(X, num_crops=n_crops, receptive_field=field,
+                                            padding='zero', timeout=60)
+                 for _ in range(3)]
+        outputs = loop.run_until_complete(asyncio.gather(*coros))
+        for output in outputs:
+            self.assertAllClose(output, expected)
+
+        # test bad max_concurrent
+        with self.assertRaises(ValueError):
+            running.AsyncModelRunner(model, max_concurrent=0)
+
 if __name__ == '__main__':
     test.main()
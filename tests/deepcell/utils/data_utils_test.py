@@ -28,18 +28,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import os
 
 import numpy as np
 from tensorflow.python.keras import backend as K
 from tensorflow.python.platform import test
+from skimage.external import tifffile as tiff
 
+from deepcell import settings
 from deepcell.utils.data_utils import get_data
+from deepcell.utils.data_utils import ConcatenatedArray
+from deepcell.utils.data_utils import IndexedArray
+from deepcell.utils.data_utils import TiledArray
+from deepcell.utils.data_utils import load_images_into
+from deepcell.utils.data_utils import load_training_images_3d
+from deepcell.utils.data_utils import load_annotated_images_3d
+from deepcell.utils.data_utils import make_training_data
+from deepcell.utils.data_utils import make_training_data_sharded
+from deepcell.utils.data_utils import make_training_data_streaming
+from deepcell.utils.data_utils import merge_shards
+from deepcell.utils.data_utils import read_dataset_manifest
+from deepcell.utils.data_utils import write_dataset_manifest
 from deepcell.utils.data_utils import sample_label_matrix
 from deepcell.utils.data_utils import sample_label_movie
 from deepcell.utils.data_utils import get_max_sample_num_list
 from deepcell.utils.data_utils import trim_padding
+from deepcell.utils.data_utils import compact_labels
 from deepcell.utils.data_utils import relabel_movie
+from deepcell.utils.data_utils import relabel_movies
+from deepcell.utils.data_utils import read_dataset_index
+from deepcell.utils.data_utils import shard_dataset
+from deepcell.utils.data_utils import get_shard_data
+from deepcell.utils.data_utils import get_split_data
+from deepcell.utils.data_utils import load_dataset
 from deepcell.utils.data_utils import reshape_movie
 from deepcell.utils.data_utils import reshape_matrix
 
@@ -69,6 +91,413 @@ class TestDataUtils(test.TestCase):
         with self.assertRaises(KeyError):
             _, _ = get_data(bad_file)
 
+        # test lazy mode gives the same split as memory-mapped views
+        train_dict, test_dict = get_data(good_file, test_size=test_size, seed=0)
+        lazy_train, lazy_test = get_data(good_file, test_size=test_size, seed=0, lazy=True)
+        self.assertIsInstance(lazy_train['X'], IndexedArray)
+        self.assertIsInstance(lazy_train['X'].array, np.memmap)
+        self.assertEqual(lazy_train['X'].shape, train_dict['X'].shape)
+        self.assertEqual(lazy_test['y'].shape, test_dict['y'].shape)
+        self.assertAllEqual(lazy_train['X'][0], train_dict['X'][0])
+        self.assertAllEqual(lazy_train['y'][1:3, ..., 0], train_dict['y'][1:3, ..., 0])
+        self.assertAllEqual(lazy_train['X'][..., 0], train_dict['X'][..., 0])
+        self.assertAllEqual(lazy_test['y'][0, ..., 1:], test_dict['y'][0, ..., 1:])
+        self.assertAllEqual(np.asarray(lazy_train['X']), train_dict['X'])
+        self.assertAllEqual(np.asarray(lazy_test['y']), test_dict['y'])
+
+        # test dataset directories are loaded lazily
+        dataset_dir = os.path.join(temp_dir, 'good_npy')
+        self.assertTrue(os.path.isfile(os.path.join(dataset_dir, 'X.npy')))
+        lazy_train, _ = get_data(dataset_dir, test_size=test_size, seed=0)
+        self.assertIsInstance(lazy_train['X'], IndexedArray)
+
+        with self.assertRaises(KeyError):
+            _, _ = get_data(bad_file, lazy=True)
+
+    def test_get_split_data(self):
+        X = np.random.random((10, 8, 8, 1))
+        y = np.random.randint(3, size=(10, 8, 8, 1))
+
+        temp_dir = self.get_temp_dir()
+        data_file = os.path.join(temp_dir, 'split_me.npz')
+        np.savez(data_file, X=X, y=y)
+        train_dict, test_dict = get_data(data_file, test_size=.2, seed=0)
+
+        # the split is saved on the first call and memory-mapped afterwards
+        for _ in range(2):
+            cached_train, cached_test = get_split_data(data_file, test_size=.2, seed=0)
+            self.assertIsInstance(cached_train['X'], np.memmap)
+            self.assertAllEqual(cached_train['X'], train_dict['X'])
+            self.assertAllEqual(cached_test['y'], test_dict['y'])
+        split_dir = os.path.join(temp_dir, 'split_me_split')
+        self.assertTrue(os.path.isfile(os.path.join(split_dir, 'X_train.npy')))
+
+        # cached arrays are copy-on-write
+        cached_train['X'][0] = 0
+        cached_train, _ = get_split_data(data_file, test_size=.2, seed=0)
+        self.assertAllEqual(cached_train['X'], train_dict['X'])
+
+        # a different split replaces the cached split
+        cached_train, cached_test = get_split_data(data_file, test_size=.5, seed=0)
+        self.assertEqual(len(cached_train['X']), 5)
+        self.assertEqual(len(cached_test['X']), 5)
+
+    def test_load_dataset(self):
+        temp_dir = self.get_temp_dir()
+        mirror_dir = os.path.join(temp_dir, 'mirror')
+        os.makedirs(mirror_dir)
+        expected = {}
+        for name in ('first', 'second'):
+            mirror_file = os.path.join(mirror_dir, '{}.npz'.format(name))
+            np.savez(mirror_file, X=np.random.random((10, 8, 8, 1)),
+                     y=np.random.randint(3, size=(10, 8, 8, 1)))
+            with open(mirror_file, 'rb') as f:
+                file_hash = hashlib.md5(f.read()).hexdigest()
+            train_dict, test_dict = get_data(mirror_file, test_size=.2, seed=0)
+            expected[name] = (file_hash, train_dict, test_dict)
+
+        # datasets are copied from the mirror, both under the same name
+        cache_dir = os.path.join(temp_dir, 'keras')
+        mirror = settings.DATASETS_MIRROR_DIR
+        settings.DATASETS_MIRROR_DIR = mirror_dir
+        try:
+            for name in ('first', 'first', 'second', 'first'):
+                file_hash, train_dict, test_dict = expected[name]
+                cached_train, cached_test = load_dataset(
+                    'dataset.npz', origin='https://example.com/{}.npz'.format(name),
+                    file_hash=file_hash, test_size=.2, seed=0, cache_dir=cache_dir)
+                self.assertIsInstance(cached_train['X'], np.memmap)
+                self.assertAllEqual(cached_train['X'], train_dict['X'])
+                self.assertAllEqual(cached_test['y'], test_dict['y'])
+        finally:
+            settings.DATASETS_MIRROR_DIR = mirror
+
+        split_dir = os.path.join(cache_dir, 'datasets', 'dataset_split')
+        self.assertTrue(os.path.isfile(os.path.join(split_dir, 'split.json')))
+
+    def test_shard_dataset(self):
+        X = np.random.random((10, 8, 8, 1)).astype('float32')
+        y = np.random.randint(3, size=(10, 8, 8, 1))
+
+        temp_dir = self.get_temp_dir()
+        data_file = os.path.join(temp_dir, 'shard_me.npz')
+        np.savez(data_file, X=X, y=y)
+
+        shard_dir = os.path.join(temp_dir, 'shards')
+        index = shard_dataset(data_file, shard_dir, num_shards=3, seed=1)
+        self.assertEqual(read_dataset_index(shard_dir), index)
+        self.assertEqual(index['num_samples'], 10)
+        self.assertListEqual([s['num_samples'] for s in index['shards']], [4, 3, 3])
+        self.assertListEqual(index['X']['sample_shape'], [8, 8, 1])
+
+        # shuffled shards hold every sample exactly once
+        shards_X = np.concatenate([np.load(os.path.join(shard_dir, s['X']))
+                                   for s in index['shards']])
+        order = np.random.RandomState(1).permutation(10)
+        self.assertAllEqual(shards_X, X[order])
+
+        # each worker only loads its own shards
+        train_dict, test_dict = get_shard_data(shard_dir, rank=1, num_workers=2,
+                                               test_size=.25, seed=0)
+        self.assertEqual(len(train_dict['X']) + len(test_dict['X']), 3)
+        worker_X = np.concatenate([np.asarray(train_dict['X']), np.asarray(test_dict['X'])])
+        self.assertAllEqual(np.sort(worker_X, axis=0), np.sort(X[order[4:7]], axis=0))
+
+        train_dict, test_dict = get_shard_data(shard_dir, rank=0, num_workers=2,
+                                               test_size=.25, seed=0)
+        self.assertIsInstance(train_dict['X'].array, ConcatenatedArray)
+        self.assertEqual(len(train_dict['X']) + len(test_dict['X']), 7)
+
+        # get_data reads every shard
+        train_dict, test_dict = get_data(shard_dir, test_size=.2, seed=0)
+        self.assertEqual(len(train_dict['y']), 8)
+        self.assertEqual(len(test_dict['y']), 2)
+
+        with self.assertRaises(ValueError):
+            get_shard_data(shard_dir, rank=2, num_workers=2)
+        with self.assertRaises(ValueError):
+            get_shard_data(shard_dir, rank=0, num_workers=4)
+        with self.assertRaises(ValueError):
+            shard_dataset(data_file, shard_dir, num_shards=11)
+
+    def test_concatenated_array(self):
+        arrays = [np.arange(6).reshape(3, 2), np.arange(6, 14).reshape(4, 2)]
+        expected = np.concatenate(arrays)
+        concat = ConcatenatedArray(arrays)
+        self.assertEqual(concat.shape, expected.shape)
+        self.assertEqual(len(concat), 7)
+        self.assertAllEqual(concat[3], expected[3])
+        self.assertAllEqual(concat[-1], expected[-1])
+        self.assertAllEqual(concat[1:5], expected[1:5])
+        self.assertAllEqual(concat[[6, 0, 4]], expected[[6, 0, 4]])
+        self.assertAllEqual(concat[2:4, 1], expected[2:4, 1])
+        self.assertAllEqual(concat[..., 1], expected[..., 1])
+        self.assertAllEqual(concat[5, ...], expected[5, ...])
+        self.assertAllEqual(np.asarray(concat), expected)
+
+        with self.assertRaises(IndexError):
+            concat[7]
+        with self.assertRaises(ValueError):
+            ConcatenatedArray([np.zeros((2, 3)), np.zeros((2, 4))])
+
+    def test_load_images_into(self):
+        temp_dir = self.get_temp_dir()
+        images = np.random.random((6, 30, 30)).astype('float32')
+        jobs = []
+        for i, image in enumerate(images):
+            image_file = os.path.join(temp_dir, 'image_{}.tif'.format(i))
+            tiff.imsave(image_file, image)
+            jobs.append(((i // 3, Ellipsis, i % 3), image_file))
+
+        for num_workers in (None, 1, 4):
+            X = np.zeros((2, 30, 30, 3), dtype='float32')
+            X = load_images_into(X, jobs, num_workers=num_workers)
+            for i, image in enumerate(images):
+                self.assertAllEqual(X[i // 3, :, :, i % 3], image)
+
+        # test loading a window of each image
+        X = np.zeros((2, 10, 20, 3), dtype='float32')
+        X = load_images_into(X, jobs, region=((5, 15), (10, 30)))
+        for i, image in enumerate(images):
+            self.assertAllEqual(X[i // 3, :, :, i % 3], image[5:15, 10:30])
+
+        # test decoding errors are raised
+        with self.assertRaises(Exception):
+            bad_jobs = [((0, Ellipsis, 0), os.path.join(temp_dir, 'missing.tif'))]
+            load_images_into(X, bad_jobs, num_workers=2)
+
+    def test_load_images_3d_from_stacks(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        frames = np.random.random((5, 20, 20)).astype('float32')
+        labels = np.random.randint(5, size=(5, 20, 20)).astype('int32')
+
+        # the same movie as per-frame files and as multi-page stacks
+        for direc in ('frames', 'stacks'):
+            os.makedirs(os.path.join(temp_dir, direc, 'raw'))
+            os.makedirs(os.path.join(temp_dir, direc, 'annotated'))
+        for i in range(5):
+            tiff.imsave(os.path.join(temp_dir, 'frames', 'raw', 'nuclear_{}.tif'.format(i)),
+                        frames[i])
+            tiff.imsave(os.path.join(temp_dir, 'frames', 'annotated', 'feature_{}.tif'.format(i)),
+                        labels[i])
+        tiff.imsave(os.path.join(temp_dir, 'stacks', 'raw', 'nuclear.tif'), frames)
+        tiff.imsave(os.path.join(temp_dir, 'stacks', 'annotated', 'feature.tif'), labels)
+
+        X = load_training_images_3d(temp_dir, ['frames', 'stacks'], 'raw', ['nuclear'],
+                                    image_size=(20, 20), num_frames=3, num_workers=2)
+        y = load_annotated_images_3d(temp_dir, ['frames', 'stacks'], 'annotated', 'feature',
+                                     image_size=(20, 20), num_frames=3, num_workers=2)
+        for b in range(2):
+            self.assertAllEqual(X[b, ..., 0], frames[:3])
+            self.assertAllEqual(y[b, ..., 0], labels[:3])
+        # labels are loaded in the smallest dtype that holds them
+        self.assertEqual(y.dtype, np.dtype('uint8'))
+
+        # test a window of the stacks
+        X = load_training_images_3d(temp_dir, ['stacks'], 'raw', ['nuclear'],
+                                    image_size=(10, 5), num_frames=5,
+                                    region=((5, 15), (0, 5)))
+        self.assertAllEqual(X[0, ..., 0], frames[:, 5:15, :5])
+
+    def test_make_training_data_streaming(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        direc_name = os.path.join(temp_dir, 'training_data')
+        training_direcs = ['set{}'.format(i) for i in range(3)]
+        for direc in training_direcs:
+            for subdir in ('raw', 'annotated'):
+                os.makedirs(os.path.join(direc_name, direc, subdir))
+            for channel in ('nuclear', 'phase'):
+                img = np.random.random((40, 40)).astype('float32')
+                tiff.imsave(os.path.join(direc_name, direc, 'raw', channel + '.tif'), img)
+            mask = np.random.randint(10, size=(40, 40)).astype('int32')
+            tiff.imsave(os.path.join(direc_name, direc, 'annotated', 'feature_0.tif'), mask)
+
+        npz_file = os.path.join(temp_dir, 'data.npz')
+        make_training_data(direc_name, npz_file, ['nuclear', 'phase'], 2,
+                           training_direcs=training_direcs, reshape_size=16)
+        expected = np.load(npz_file)
+
+        dataset_dir = os.path.join(temp_dir, 'dataset')
+        manifest = make_training_data_streaming(
+            direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+            training_direcs=training_direcs, reshape_size=16)
+        self.assertTrue(manifest['complete'])
+        self.assertListEqual(manifest['completed'], training_direcs)
+        self.assertListEqual(manifest['X']['shape'], list(expected['X'].shape))
+        X = np.load(os.path.join(dataset_dir, 'X.npy'), mmap_mode='r')
+        y = np.load(os.path.join(dataset_dir, 'y.npy'), mmap_mode='r')
+        self.assertAllEqual(X, expected['X'])
+        self.assertAllEqual(y, expected['y'])
+
+        # test resuming after an interruption only loads unfinished directories
+        manifest['complete'] = False
+        manifest['completed'] = training_direcs[:1]
+        write_dataset_manifest(dataset_dir, manifest)
+        y = np.load(os.path.join(dataset_dir, 'y.npy'), mmap_mode='r+')
+        y[manifest['chunks'][1]['start']:] = 0
+        y.flush()
+        del y
+
+        make_training_data_streaming(
+            direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+            training_direcs=training_direcs, reshape_size=16)
+        self.assertTrue(read_dataset_manifest(dataset_dir)['complete'])
+        self.assertAllEqual(np.load(os.path.join(dataset_dir, 'y.npy')), expected['y'])
+
+        # test resuming with different arguments
+        with self.assertRaises(ValueError):
+            make_training_data_streaming(
+                direc_name, dataset_dir, ['nuclear'], 2,
+                training_direcs=training_direcs, reshape_size=16)
+
+    def test_make_training_data_streaming_label_dtype(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        direc_name = os.path.join(temp_dir, 'training_data')
+        training_direcs = ['set0', 'set1']
+        for direc, dtype, max_label in zip(training_direcs, ('uint8', 'uint16'), (10, 300)):
+            for subdir in ('raw', 'annotated'):
+                os.makedirs(os.path.join(direc_name, direc, subdir))
+            img = np.random.random((40, 40)).astype('float32')
+            tiff.imsave(os.path.join(direc_name, direc, 'raw', 'nuclear.tif'), img)
+            mask = np.random.randint(max_label, size=(40, 40)).astype(dtype)
+            tiff.imsave(os.path.join(direc_name, direc, 'annotated', 'feature_0.tif'), mask)
+
+        # the labels of later directories need a wider dtype than the first
+        dataset_dir = os.path.join(temp_dir, 'dataset')
+        make_training_data_streaming(direc_name, dataset_dir, ['nuclear'], 2,
+                                     training_direcs=training_direcs)
+        y = np.load(os.path.join(dataset_dir, 'y.npy'))
+        self.assertEqual(y.dtype, np.dtype('uint16'))
+        self.assertEqual(y.max(), 299)
+
+    def test_make_training_data_streaming_append(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        direc_name = os.path.join(temp_dir, 'training_data')
+        training_direcs = ['set{}'.format(i) for i in range(3)]
+        for direc in training_direcs:
+            for subdir in ('raw', 'annotated'):
+                os.makedirs(os.path.join(direc_name, direc, subdir))
+            for channel in ('nuclear', 'phase'):
+                img = np.random.random((40, 40)).astype('float32')
+                tiff.imsave(os.path.join(direc_name, direc, 'raw', channel + '.tif'), img)
+            mask = np.random.randint(10, size=(40, 40)).astype('uint16')
+            tiff.imsave(os.path.join(direc_name, direc, 'annotated', 'feature_0.tif'), mask)
+
+        npz_file = os.path.join(temp_dir, 'data.npz')
+        make_training_data(direc_name, npz_file, ['nuclear', 'phase'], 2,
+                           training_direcs=training_direcs, reshape_size=16)
+        expected = np.load(npz_file)
+
+        dataset_dir = os.path.join(temp_dir, 'dataset')
+        make_training_data_streaming(
+            direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+            training_direcs=training_direcs[:2], reshape_size=16)
+
+        # only the new directory is built and appended
+        manifest = make_training_data_streaming(
+            direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+            training_direcs=training_direcs[1:], reshape_size=16, append=True)
+        self.assertTrue(manifest['complete'])
+        self.assertListEqual(manifest['completed'], training_direcs)
+        self.assertListEqual(manifest['config']['training_direcs'], training_direcs)
+        X = np.load(os.path.join(dataset_dir, 'X.npy'))
+        y = np.load(os.path.join(dataset_dir, 'y.npy'))
+        self.assertAllEqual(X, expected['X'])
+        self.assertAllEqual(y, expected['y'])
+        self.assertListEqual(manifest['X']['shape'], list(X.shape))
+
+        # the cached statistics cover the whole dataset
+        stats = manifest['stats']
+        self.assertAllClose(stats['X']['mean'], X.mean(axis=(0, 1, 2)))
+        self.assertAllClose(stats['X']['std'], X.std(axis=(0, 1, 2)), atol=1e-6)
+        self.assertAllClose(stats['X']['max'], X.max(axis=(0, 1, 2)))
+        self.assertListEqual(stats['y']['labeled_pixels'], [np.count_nonzero(y)])
+        self.assertListEqual(stats['y']['max_label'], [int(y.max())])
+
+        # test appending with different arguments
+        with self.assertRaises(ValueError):
+            make_training_data_streaming(
+                direc_name, dataset_dir, ['phase', 'nuclear'], 2,
+                training_direcs=training_direcs, reshape_size=16, append=True)
+        with self.assertRaises(ValueError):
+            make_training_data_streaming(
+                direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+                training_direcs=training_direcs, reshape_size=20, append=True)
+
+        # test appending labels that do not fit leaves the dataset unchanged
+        for subdir in ('raw', 'annotated'):
+            os.makedirs(os.path.join(direc_name, 'wide', subdir))
+        for channel in ('nuclear', 'phase'):
+            img = np.random.random((40, 40)).astype('float32')
+            tiff.imsave(os.path.join(direc_name, 'wide', 'raw', channel + '.tif'), img)
+        mask = np.random.randint(2 ** 17, size=(40, 40)).astype('uint32')
+        tiff.imsave(os.path.join(direc_name, 'wide', 'annotated', 'feature_0.tif'), mask)
+        with self.assertRaises(ValueError):
+            make_training_data_streaming(
+                direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+                training_direcs=['wide'], reshape_size=16, append=True)
+        self.assertDictEqual(read_dataset_manifest(dataset_dir), manifest)
+        self.assertAllEqual(np.load(os.path.join(dataset_dir, 'y.npy')), y)
+
+    def test_make_training_data_sharded(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        direc_name = os.path.join(temp_dir, 'training_data')
+        training_direcs = ['set{}'.format(i) for i in range(5)]
+        for direc in training_direcs:
+            for subdir in ('raw', 'annotated'):
+                os.makedirs(os.path.join(direc_name, direc, subdir))
+            for channel in ('nuclear', 'phase'):
+                img = np.random.random((40, 40)).astype('float32')
+                tiff.imsave(os.path.join(direc_name, direc, 'raw', channel + '.tif'), img)
+            mask = np.random.randint(10, size=(40, 40)).astype('int32')
+            tiff.imsave(os.path.join(direc_name, direc, 'annotated', 'feature_0.tif'), mask)
+
+        dataset_dir = os.path.join(temp_dir, 'dataset')
+        make_training_data_streaming(
+            direc_name, dataset_dir, ['nuclear', 'phase'], 2,
+            training_direcs=training_direcs, reshape_size=16)
+        expected_X = np.load(os.path.join(dataset_dir, 'X.npy'))
+        expected_y = np.load(os.path.join(dataset_dir, 'y.npy'))
+
+        shard_dir = os.path.join(temp_dir, 'shards')
+        index = make_training_data_sharded(
+            direc_name, shard_dir, ['nuclear', 'phase'], 2,
+            num_shards=2, num_processes=2,
+            training_direcs=training_direcs, reshape_size=16)
+        self.assertEqual(index['num_shards'], 2)
+        self.assertEqual(index['num_samples'], expected_X.shape[0])
+        self.assertEqual(sum(s['num_samples'] for s in index['shards']), len(expected_X))
+
+        # the shards are read directly, or merged into a single dataset
+        train_dict, test_dict = get_data(shard_dir, test_size=.2, seed=1)
+        self.assertEqual(len(train_dict['X']) + len(test_dict['X']), len(expected_X))
+
+        merged_dir = os.path.join(temp_dir, 'merged')
+        merge_shards(shard_dir, merged_dir)
+        self.assertAllEqual(np.load(os.path.join(merged_dir, 'X.npy')), expected_X)
+        self.assertAllEqual(np.load(os.path.join(merged_dir, 'y.npy')), expected_y)
+
+        # test resuming only builds missing shards
+        os.remove(os.path.join(shard_dir, 'index.json'))
+        os.remove(os.path.join(shard_dir, index['shards'][1]['y']))
+        make_training_data_sharded(
+            direc_name, shard_dir, ['nuclear', 'phase'], 2,
+            num_shards=2, num_processes=1,
+            training_direcs=training_direcs, reshape_size=16)
+        merge_shards(shard_dir, merged_dir)
+        self.assertAllEqual(np.load(os.path.join(merged_dir, 'y.npy')), expected_y)
+
+        # test resuming with different arguments
+        with self.assertRaises(ValueError):
+            make_training_data_sharded(
+                direc_name, shard_dir, ['nuclear'], 2, num_shards=2,
+                training_direcs=training_direcs, reshape_size=16)
+
     def test_get_max_sample_num_list(self):
         K.set_image_data_format('channels_last')
         edge_feature = [1, 0, 0]  # first channel index is cell edge
@@ -136,6 +565,7 @@ class TestDataUtils(test.TestCase):
         self.assertEqual(np.unique(b).size, 2)
         self.assertEqual([np.unique(r).size, np.unique(c).size], [1, 1])
         self.assertEqual(np.unique(l).size, 1)
+        self.assertListEqual([a.dtype for a in (r, c, b, l)], [np.dtype('int16')] * 4)
 
         r, c, b, l = sample_label_matrix(
             y, window_size=(win_x, win_y),
@@ -179,6 +609,7 @@ class TestDataUtils(test.TestCase):
         self.assertEqual(np.unique(b).size, 2)
         self.assertEqual([np.unique(r).size, np.unique(c).size, np.unique(f).size], [1, 1, 1])
         self.assertEqual(np.unique(l).size, 1)
+        self.assertListEqual([a.dtype for a in (f, r, c, b, l)], [np.dtype('int16')] * 5)
 
         f, r, c, b, l = sample_label_movie(
             y, window_size=(win_x, win_y, win_z),
@@ -264,6 +695,34 @@ class TestDataUtils(test.TestCase):
     def test_relabel_movie(self):
         y = np.array([[0, 3, 5], [4, 99, 123]])
         self.assertAllEqual(relabel_movie(y), np.array([[0, 1, 3], [2, 4, 5]]))
+        self.assertEqual(relabel_movie(y.astype('uint16')).dtype, np.dtype('uint16'))
+        self.assertEqual(relabel_movie(y.astype('float32')).dtype, np.dtype('int32'))
+
+        # sparse, large IDs are ranked the same way
+        self.assertAllEqual(relabel_movie(y * 10 ** 8), np.array([[0, 1, 3], [2, 4, 5]]))
+
+    def test_compact_labels(self):
+        y = np.array([[0, 3, 5], [4, 99, 255]], dtype='int32')
+        self.assertEqual(compact_labels(y).dtype, np.dtype('uint8'))
+        self.assertAllEqual(compact_labels(y), y)
+        self.assertEqual(compact_labels(y * 256).dtype, np.dtype('uint16'))
+        self.assertEqual(compact_labels(y * 2 ** 16).dtype, np.dtype('uint32'))
+
+        # negative and non-integer labels are unchanged
+        self.assertEqual(compact_labels(-y).dtype, np.dtype('int32'))
+        self.assertEqual(compact_labels(y.astype('float32')).dtype, np.dtype('float32'))
+
+    def test_relabel_movies(self):
+        y = np.random.randint(0, 20, size=(4, 3, 8, 8, 1))
+        expected = np.stack([relabel_movie(movie) for movie in y])
+        relabeled = relabel_movies(y)
+        self.assertEqual(relabeled.dtype, y.dtype)
+        self.assertAllEqual(relabeled, expected)
+
+        # non-integer labels are relabeled as int32
+        relabeled = relabel_movies(y.astype('float32'))
+        self.assertEqual(relabeled.dtype, np.dtype('int32'))
+        self.assertAllEqual(relabeled, expected)
 
     def test_reshape_movie(self):
         K.set_image_data_format('channels_last')
@@ -284,6 +743,16 @@ class TestDataUtils(test.TestCase):
         self.assertEqual(new_X.shape, (new_batch, 30, new_size, new_size, 3))
         self.assertEqual(new_y.shape, (new_batch, 30, new_size, new_size, 1))
 
+        # test lazy tiles are relabeled like the materialized tiles
+        X = np.random.random((1, 3, 50, 50, 1)).astype('float32')
+        y = np.random.randint(100, size=(1, 3, 50, 50, 1))
+        new_X, new_y = reshape_movie(X, y, 20)
+        lazy_X, lazy_y = reshape_movie(X, y, 20, lazy=True)
+        self.assertIsInstance(lazy_y, TiledArray)
+        self.assertAllEqual(lazy_X[4], X[0, :, 20:40, 20:40])
+        self.assertAllEqual(lazy_y[2:5], new_y[2:5])
+        self.assertAllEqual(new_y[8], relabel_movie(y[0, :, 30:50, 30:50]))
+
         # test reshape to bigger size
         with self.assertRaises(ValueError):
             new_X, new_y = reshape_movie(X, y, 2048)
@@ -338,6 +807,27 @@ class TestDataUtils(test.TestCase):
         self.assertEqual(new_X.shape, (new_batch, new_size, new_size, 3))
         self.assertEqual(new_y.shape, (new_batch, new_size, new_size, 1))
 
+        # test lazy tiles and writing into a memmap
+        X = np.random.random((2, 100, 100, 3)).astype('float32')
+        y = np.random.randint(5, size=(2, 100, 100, 1))
+        new_X, new_y = reshape_matrix(X, y, 30)
+        self.assertEqual(new_X.shape, (32, 30, 30, 3))
+        self.assertAllEqual(new_X[6], X[0, 30:60, 60:90])
+        self.assertAllEqual(new_y[31], y[1, 70:100, 70:100])
+        lazy_X, lazy_y = reshape_matrix(X, y, 30, lazy=True)
+        self.assertIsInstance(lazy_X, TiledArray)
+        self.assertEqual(lazy_X.shape, new_X.shape)
+        self.assertAllEqual(lazy_X[3:9], new_X[3:9])
+        self.assertAllEqual(lazy_y[-1, ..., 0], new_y[-1, ..., 0])
+        self.assertAllEqual(lazy_X[..., 1], new_X[..., 1])
+        self.assertAllEqual(np.asarray(lazy_y), new_y)
+        X_out = np.lib.format.open_memmap(
+            os.path.join(self.get_temp_dir(), 'X_tiles.npy'), mode='w+',
+            dtype=new_X.dtype, shape=new_X.shape)
+        memmap_X, _ = reshape_matrix(X, y, 30, X_out=X_out)
+        self.assertIs(memmap_X, X_out)
+        self.assertAllEqual(memmap_X, new_X)
+
         # test reshape to bigger size
         with self.assertRaises(ValueError):
             new_X, new_y = reshape_matrix(X, y, 2048)
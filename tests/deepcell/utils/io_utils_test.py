@@ -37,12 +37,23 @@ from tensorflow.python.keras.preprocessing.image import array_to_img
 from tensorflow.python.platform import test
 from skimage.external import tifffile as tiff
 
+from deepcell import settings
+from deepcell.utils.io_utils import get_cached_image
 from deepcell.utils.io_utils import get_immediate_subdirs
 from deepcell.utils.io_utils import get_image
+from deepcell.utils.io_utils import get_image_region
+from deepcell.utils.io_utils import get_image_shape
+from deepcell.utils.io_utils import get_image_stack
+from deepcell.utils.io_utils import get_num_pages
 from deepcell.utils.io_utils import nikon_getfiles
+from deepcell.utils.io_utils import filter_channel_files
 from deepcell.utils.io_utils import get_image_sizes
 from deepcell.utils.io_utils import get_images_from_directory
+from deepcell.utils.io_utils import ImageDirectoryIterator
 from deepcell.utils.io_utils import save_model_output
+from deepcell.utils.io_utils import save_model_output_stacks
+from deepcell.utils.io_utils import FileManifest
+from deepcell.utils.io_utils import build_file_manifest
 
 
 def _write_image(filepath, img_w=30, img_h=30):
@@ -86,6 +97,131 @@ class TestIOUtils(test.TestCase):
         test_img = get_image(test_img_path)
         self.assertEqual(np.asarray(test_img).shape, (400, 400))
 
+    def test_get_image_region(self):
+        temp_dir = self.get_temp_dir()
+        img = (np.random.random((100, 130)) * 1000).astype('uint16')
+        rgb = (np.random.random((100, 130, 3)) * 255).astype('uint8')
+
+        files = []
+        for i, kwargs in enumerate(({}, {'compress': 6}, {'tile': (32, 48)},
+                                    {'tile': (32, 48), 'compress': 6})):
+            for name, data in (('img', img), ('rgb', rgb)):
+                file_name = os.path.join(temp_dir, '{}_{}.tif'.format(name, i))
+                tiff.imsave(file_name, data, **kwargs)
+                files.append((file_name, data))
+
+        file_name = os.path.join(temp_dir, 'img.png')
+        array_to_img(rgb, scale=False).save(file_name)
+        files.append((file_name, rgb))
+
+        for file_name, data in files:
+            # test the full image
+            region = get_image_region(file_name)
+            self.assertEqual(region.dtype, np.float32)
+            self.assertAllEqual(region, data)
+            # test windows crossing strip and tile boundaries
+            for row_range, col_range in (((13, 77), (5, 129)), ((64, 65), (47, 49))):
+                region = get_image_region(file_name, row_range, col_range, native_dtype=True)
+                self.assertEqual(region.dtype, data.dtype)
+                self.assertAllEqual(region, data[slice(*row_range), slice(*col_range)])
+            # test windows are clipped to the image
+            region = get_image_region(file_name, (90, 200), (-5, 3))
+            self.assertAllEqual(region, data[90:, :3])
+
+        self.assertEqual(get_image(files[0][0], native_dtype=True).dtype, np.uint16)
+
+    def test_get_cached_image(self):
+        temp_dir = self.get_temp_dir()
+        files = []
+        for i in range(3):
+            file_name = os.path.join(temp_dir, 'cached_{}.tif'.format(i))
+            tiff.imsave(file_name, np.full((10, 10), i, dtype='uint8'))
+            files.append(file_name)
+
+        max_bytes = settings.IMAGE_CACHE_MAX_BYTES
+        try:
+            # room for two 10x10 uint8 images
+            settings.IMAGE_CACHE_MAX_BYTES = 200
+            img = get_cached_image(files[0])
+            self.assertFalse(img.flags.writeable)
+            self.assertIs(get_cached_image(files[0]), img)
+
+            # get_image returns writable copies of cached images
+            native_img = get_image(files[0], native_dtype=True)
+            self.assertIsNot(native_img, img)
+            self.assertTrue(native_img.flags.writeable)
+            self.assertAllEqual(native_img, img)
+
+            # float32 images are copies of the cached image
+            float_img = get_image(files[0])
+            self.assertEqual(float_img.dtype, np.float32)
+            self.assertTrue(float_img.flags.writeable)
+
+            # images read without the cache are writable copies
+            uncached = get_image(files[0], native_dtype=True, cache=False)
+            self.assertIsNot(uncached, img)
+            self.assertTrue(uncached.flags.writeable)
+
+            # the least recently used image is evicted
+            get_cached_image(files[1])
+            get_cached_image(files[2])
+            self.assertIsNot(get_cached_image(files[0]), img)
+
+            # modified files are decoded again
+            img = get_cached_image(files[2])
+            tiff.imsave(files[2], np.full((10, 10), 7, dtype='uint8'))
+            os.utime(files[2], ns=(0, 1))  # make sure the mtime changed
+            self.assertAllEqual(get_cached_image(files[2]), np.full((10, 10), 7))
+
+            # images are decoded every time if the cache is disabled
+            settings.IMAGE_CACHE_MAX_BYTES = 0
+            self.assertIsNot(get_cached_image(files[2]), get_cached_image(files[2]))
+        finally:
+            settings.IMAGE_CACHE_MAX_BYTES = max_bytes
+
+    def test_get_image_shape(self):
+        temp_dir = self.get_temp_dir()
+        for kwargs in ({}, {'compress': 6}):
+            file_name = os.path.join(temp_dir, 'shape.tif')
+            tiff.imsave(file_name, np.zeros((5, 20, 30), dtype='uint16'), **kwargs)
+            self.assertEqual(get_image_shape(file_name), (20, 30))
+            self.assertEqual(get_image_shape(file_name, page=4), (20, 30))
+
+        file_name = os.path.join(temp_dir, 'shape.png')
+        _write_image(file_name, 20, 30)
+        self.assertEqual(get_image_shape(file_name)[:2], (20, 30))
+
+    def test_get_image_stack(self):
+        temp_dir = self.get_temp_dir()
+        stack = (np.random.random((6, 40, 50)) * 1000).astype('uint16')
+        for kwargs in ({}, {'compress': 6}, {'tile': (16, 32)}):
+            file_name = os.path.join(temp_dir, 'stack.tif')
+            tiff.imsave(file_name, stack, **kwargs)
+            self.assertEqual(get_num_pages(file_name), 6)
+
+            frames = get_image_stack(file_name)
+            self.assertEqual(frames.dtype, np.float32)
+            self.assertAllEqual(frames, stack)
+
+            # test reading a range of frames of a window
+            frames = get_image_stack(file_name, (2, 5), (10, 30), (5, 45), native_dtype=True)
+            self.assertEqual(frames.dtype, stack.dtype)
+            self.assertAllEqual(frames, stack[2:5, 10:30, 5:45])
+
+            # test reading into a preallocated array
+            out = np.zeros((2, 40, 50), dtype='float32')
+            get_image_stack(file_name, (4, 10), out=out)
+            self.assertAllEqual(out, stack[4:])
+
+            with self.assertRaises(IndexError):
+                get_image_stack(file_name, (6, 8))
+
+        # test single images are a stack of one frame
+        file_name = os.path.join(temp_dir, 'single.tif')
+        tiff.imsave(file_name, stack[0])
+        self.assertEqual(get_num_pages(file_name), 1)
+        self.assertAllEqual(get_image_stack(file_name), stack[:1])
+
     def test_nikon_getfiles(self):
         temp_dir = self.get_temp_dir()
         for filename in ('channel.tif', 'multi1.tif', 'multi2.tif'):
@@ -98,6 +234,13 @@ class TestIOUtils(test.TestCase):
         no_images = nikon_getfiles(temp_dir, 'bad_channel_name')
         self.assertListEqual(no_images, [])
 
+    def test_filter_channel_files(self):
+        imglist = ['multi10.tif', 'channel.tif', 'multi2.tif', 'multi1.tif']
+        self.assertListEqual(filter_channel_files(imglist, 'channel'), ['channel.tif'])
+        self.assertListEqual(filter_channel_files(imglist, 'multi'),
+                             ['multi1.tif', 'multi2.tif', 'multi10.tif'])
+        self.assertListEqual(filter_channel_files(imglist, 'bad_channel_name'), [])
+
     def test_get_image_sizes(self):
         temp_dir = self.get_temp_dir()
         _write_image(os.path.join(temp_dir, 'image1.png'), 300, 300)
@@ -109,6 +252,55 @@ class TestIOUtils(test.TestCase):
         sizes = get_image_sizes(temp_dir, ['image1', 'image2'])
         self.assertEqual(sizes, (300, 300))
 
+    def test_build_file_manifest(self):
+        temp_dir = self.get_temp_dir()
+        root = os.path.join(temp_dir, 'manifest_root')
+        direcs = [os.path.join(root, 'set0', 'raw'), os.path.join(root, 'set1', 'raw')]
+        for direc in direcs:
+            os.makedirs(direc)
+            for i in range(2):
+                _write_image(os.path.join(direc, 'nuclear_{}.tif'.format(i)), 30, 40)
+            _write_image(os.path.join(direc, 'phase.png'), 30, 40)
+
+        manifest = build_file_manifest(root)
+        self.assertTrue(os.path.isfile(manifest.manifest_path))
+
+        # listings and shapes match the filesystem
+        for direc in direcs:
+            self.assertListEqual(sorted(manifest.listdir(direc)), sorted(os.listdir(direc)))
+            self.assertListEqual(nikon_getfiles(direc, 'nuclear', manifest=manifest),
+                                 nikon_getfiles(direc, 'nuclear'))
+            self.assertEqual(get_image_sizes(direc, ['nuclear'], manifest=manifest),
+                             get_image_sizes(direc, ['nuclear']))
+        self.assertListEqual(sorted(manifest.listdir(root)), ['set0', 'set1'])
+        self.assertIsNone(manifest.listdir(temp_dir))
+
+        entry = manifest.get_entry(os.path.join(direcs[0], 'nuclear_1.tif'))
+        self.assertEqual(entry['path'], 'set0/raw/nuclear_1.tif')
+        self.assertEqual(entry['channel'], 'nuclear')
+        self.assertEqual(entry['frame'], 1)
+        self.assertEqual(tuple(entry['shape']), (30, 40))
+        self.assertEqual(entry['pages'], 1)
+        files = manifest.get_files(direcs[1], 'nuclear')
+        self.assertListEqual([f['frame'] for f in files], [0, 1])
+
+        # rescans reuse unchanged directories and pick up new files
+        loaded = FileManifest(root)
+        self.assertEqual(loaded.directories, manifest.directories)
+        _write_image(os.path.join(direcs[1], 'nuclear_2.tif'), 30, 40)
+        os.utime(direcs[1], ns=(0, 1))  # make sure the mtime changed
+        unchanged = loaded.directories['set0/raw']
+        loaded.scan(num_workers=2)
+        self.assertIs(loaded.directories['set0/raw'], unchanged)
+        self.assertEqual(len(loaded.get_files(direcs[1], 'nuclear')), 3)
+
+        # saving the manifest does not change the directories it indexes
+        loaded.save()
+        root_entry = loaded.directories['']
+        loaded.scan()
+        self.assertIs(loaded.directories[''], root_entry)
+        self.assertListEqual(sorted(loaded.listdir(root)), ['set0', 'set1'])
+
     def test_get_images_from_directory(self):
         temp_dir = self.get_temp_dir()
         _write_image(os.path.join(temp_dir, 'image.png'), 300, 300)
@@ -126,6 +318,49 @@ class TestIOUtils(test.TestCase):
         self.assertEqual(len(img), 1)
         self.assertEqual(img[0].shape, (1, 1, 300, 300))
 
+    def test_image_directory_iterator(self):
+        K.set_image_data_format('channels_last')
+        temp_dir = self.get_temp_dir()
+        for i in range(5):
+            for channel in ('nuclear', 'phase'):
+                _write_image(os.path.join(temp_dir, '{}_{}.tif'.format(channel, i)), 30, 40)
+        expected = np.concatenate(get_images_from_directory(temp_dir, ['nuclear', 'phase']))
+
+        for prefetch in (0, 2):
+            images = ImageDirectoryIterator(temp_dir, ['nuclear', 'phase'], prefetch=prefetch)
+            self.assertEqual(len(images), 5)
+            self.assertEqual(images[0].shape, (1, 30, 40, 2))
+            self.assertAllEqual(np.concatenate(list(images)), expected)
+
+            # test batches, including a final partial batch
+            batches = ImageDirectoryIterator(temp_dir, ['nuclear', 'phase'], batch_size=2,
+                                             prefetch=prefetch, num_workers=2)
+            self.assertEqual(len(batches), 3)
+            self.assertListEqual([len(b) for b in batches], [2, 2, 1])
+            self.assertAllEqual(np.concatenate(list(batches)), expected)
+
+        # test reading a region of each image
+        images = ImageDirectoryIterator(temp_dir, ['nuclear'], region=((5, 15), (0, 20)))
+        self.assertEqual(images[-1].shape, (1, 10, 20, 1))
+        self.assertAllEqual(images[-1][..., 0], expected[-1:, 5:15, :20, 0])
+
+        with self.assertRaises(IndexError):
+            images[5]
+
+        # test each page of multi-page stacks is an image
+        stack_dir = os.path.join(temp_dir, 'stacks')
+        os.makedirs(stack_dir)
+        stacks = np.random.random((2, 5, 30, 30)).astype('float32')
+        for name, stack in zip(('nuclear', 'phase'), stacks):
+            tiff.imsave(os.path.join(stack_dir, '{}.tif'.format(name)), stack)
+        images = ImageDirectoryIterator(stack_dir, ['nuclear', 'phase'], region=((5, 15), None))
+        self.assertEqual(len(images), 5)
+        for i, image in enumerate(images):
+            self.assertAllEqual(image[0, ..., 0], stacks[0, i, 5:15])
+            self.assertAllEqual(image[0, ..., 1], stacks[1, i, 5:15])
+        with self.assertRaises(ValueError):
+            ImageDirectoryIterator(temp_dir, ['nuclear'], batch_size=0)
+
     def test_save_model_output(self):
         temp_dir = self.get_temp_dir()
         batches = 1
@@ -168,5 +403,57 @@ class TestIOUtils(test.TestCase):
             bad_dir = os.path.join(temp_dir, 'test')
             save_model_output(test_output, bad_dir, 'test', channel=None)
 
+    def test_save_model_output_stacks(self):
+        temp_dir = self.get_temp_dir()
+        features = 3
+        img_w, img_h, frames = 30, 30, 5
+        K.set_image_data_format('channels_last')
+
+        # test one stack per channel with the smallest lossless dtype
+        test_output = np.random.randint(0, 300, size=(1, frames, img_w, img_h, features))
+        saved = save_model_output_stacks(test_output, temp_dir, 'stack', compress=1,
+                                         num_workers=2)
+        self.assertEqual(len(saved), features)
+        for c, file_name in enumerate(saved):
+            self.assertEqual(os.path.basename(file_name), 'stack_feature_{}.tif'.format(c))
+            stack = tiff.imread(file_name)
+            self.assertEqual(stack.dtype, np.dtype('uint16'))
+            self.assertAllEqual(stack, test_output[0, ..., c])
+            self.assertAllEqual(get_image_region(file_name, page=2, native_dtype=True),
+                                test_output[0, 2, ..., c])
+
+        # test a hyperstack of one channel of multiple channels_first batches
+        test_output = np.random.random((2, features, frames, img_w, img_h))
+        saved = save_model_output_stacks(test_output, temp_dir, 'hyper', channel=1,
+                                         hyperstack=True, data_format='channels_first')
+        self.assertEqual(len(saved), 2)
+        for b, file_name in enumerate(saved):
+            self.assertEqual(file_name, os.path.join(temp_dir, str(b), 'hyper_features.tif'))
+            with tiff.TiffFile(file_name) as tif:
+                self.assertTrue(tif.is_imagej)
+            stack = tiff.imread(file_name).reshape((frames, 1, img_w, img_h))
+            self.assertEqual(stack.dtype, np.dtype('float32'))
+            self.assertAllClose(stack[:, 0], test_output[b, 1])
+
+        # test hyperstacks are saved in a dtype that ImageJ reads
+        test_output = np.random.randint(-5, 5, size=(1, frames, img_w, img_h, 2))
+        saved = save_model_output_stacks(test_output, temp_dir, 'signed', hyperstack=True)
+        stack = tiff.imread(saved[0]).reshape((frames, 2, img_w, img_h))
+        self.assertEqual(stack.dtype, np.dtype('float32'))
+        self.assertAllEqual(stack, np.moveaxis(test_output[0], -1, 1))
+
+        # test 2D output
+        test_output = np.random.random((1, img_w, img_h, features))
+        saved = save_model_output_stacks(test_output, temp_dir, 'flat', channel=0)
+        self.assertAllEqual(tiff.imread(saved[0]).reshape((img_w, img_h)), test_output[0, ..., 0])
+
+        # test bad channel
+        with self.assertRaises(ValueError):
+            save_model_output_stacks(test_output, temp_dir, channel=features)
+
+        # test no output directory
+        with self.assertRaises(FileNotFoundError):
+            save_model_output_stacks(test_output, os.path.join(temp_dir, 'missing'))
+
 if __name__ == '__main__':
     test.main()
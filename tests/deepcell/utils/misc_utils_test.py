@@ -28,9 +28,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 from tensorflow.python.platform import test
 
 from deepcell.utils.misc_utils import sorted_nicely
+from deepcell.utils.misc_utils import get_lossless_dtype
 
 
 class MiscUtilsTest(test.TestCase):
@@ -44,5 +46,16 @@ class MiscUtilsTest(test.TestCase):
         unsorted = ['test_image_1_1', 'test_image_0_0', 'test_image_1_0']
         self.assertListEqual(expected, sorted_nicely(unsorted))
 
+    def test_get_lossless_dtype(self):
+        self.assertEqual(get_lossless_dtype(np.array([0, 1, 255])), np.uint8)
+        self.assertEqual(get_lossless_dtype(np.array([-1, 1, 127])), np.int8)
+        self.assertEqual(get_lossless_dtype(np.array([0, 1000], dtype='int64')), np.uint16)
+        self.assertEqual(get_lossless_dtype(np.array([-1, 2 ** 20])), np.int32)
+        self.assertEqual(get_lossless_dtype(np.array([0., 1., 3.])), np.uint8)
+        self.assertEqual(get_lossless_dtype(np.array([0.5, 1.], dtype='float64')), np.float32)
+        self.assertEqual(get_lossless_dtype(np.array([0.1, 1.])), np.float64)
+        self.assertEqual(get_lossless_dtype(np.array([True, False])), np.bool_)
+
+
 if __name__ == '__main__':
     test.main()
@@ -28,6 +28,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 import numpy as np
 from skimage.measure import label
 from tensorflow.python.platform import test
@@ -42,6 +44,7 @@ from deepcell.utils.transform_utils import rotate_array_0
 from deepcell.utils.transform_utils import rotate_array_90
 from deepcell.utils.transform_utils import rotate_array_180
 from deepcell.utils.transform_utils import rotate_array_270
+from deepcell.utils.transform_utils import TransformCache
 
 
 def _get_image(img_h=300, img_w=300):
@@ -73,6 +76,19 @@ class TransformUtilsTest(test.TestCase):
             dc_maskstack_dilated[:, :, :, 0].sum() + dc_maskstack_dilated[:, :, :, 1].sum(),
             dc_maskstack[:, :, :, 0].sum() + dc_maskstack[:, :, :, 1].sum())
 
+    def test_deepcell_transform_touching_cells(self):
+        # two touching cells, then a column of background
+        maskstack = np.zeros((1, 4, 7, 1), dtype='int32')
+        maskstack[:, :, 0:3] = 1
+        maskstack[:, :, 3:6] = 2
+        dc_maskstack = deepcell_transform(maskstack, data_format='channels_last')
+
+        expected_columns = [[2, 3], [5], [0, 1, 4], [6]]
+        for feature, columns in enumerate(expected_columns):
+            expected = np.zeros((1, 4, 7), dtype='uint8')
+            expected[:, :, columns] = 1
+            self.assertAllEqual(dc_maskstack[..., feature], expected)
+
     def test_deepcell_transform_3d(self):
         frames = 10
         img_list = []
@@ -218,6 +234,44 @@ class TransformUtilsTest(test.TestCase):
             # Get original labels back from one hots
             self.assertAllEqual(np.argmax(one_hot, -1).reshape(label.shape), label)
 
+    def test_transform_cache(self):
+        cache_dir = os.path.join(self.get_temp_dir(), 'transform_cache')
+        cache = TransformCache(cache_dir)
+        y = np.random.randint(5, size=(2, 30, 30, 1))
+        y_transform = to_categorical(y.ravel()).reshape((2, 30, 30, -1))
+
+        # test keys depend on the labels, transform and arguments
+        key = cache.get_key(y, 'deepcell', dilation_radius=1)
+        self.assertEqual(key, cache.get_key(y.copy(), 'deepcell', dilation_radius=1))
+        self.assertNotEqual(key, cache.get_key(y, 'deepcell', dilation_radius=2))
+        self.assertNotEqual(key, cache.get_key(y, 'watershed', dilation_radius=1))
+        self.assertNotEqual(key, cache.get_key(y + 1, 'deepcell', dilation_radius=1))
+
+        # test keys change with the version of the transforms
+        new_cache = TransformCache(cache_dir)
+        new_cache.version = cache.version + 1
+        self.assertNotEqual(key, new_cache.get_key(y, 'deepcell', dilation_radius=1))
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, y_transform)
+        cached = cache.get(key)
+        self.assertEqual(cached.dtype, y_transform.dtype)
+        self.assertAllEqual(cached, y_transform)
+        # test entries are stored in a compact dtype
+        self.assertEqual(cache.get(key, mmap_mode='r').dtype, np.uint8)
+
+        # test least recently used entries are evicted
+        entry_bytes = os.path.getsize(os.path.join(cache_dir, key + '.npy'))
+        cache.max_bytes = 2 * entry_bytes
+        keys = [key] + [cache.get_key(y, 'deepcell', dilation_radius=r) for r in (2, 3)]
+        cache.put(keys[1], y_transform)
+        os.utime(os.path.join(cache_dir, keys[0] + '.npy'), (0, 0))
+        os.utime(os.path.join(cache_dir, keys[1] + '.npy'), (1, 1))
+        cache.put(keys[2], y_transform)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertIsNotNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
+
     def test_rotate_array_0(self):
         img = _get_image()
         unrotated_image = rotate_array_0(img)